@@ -21,8 +21,10 @@ Tim Greening-Jackson (tim@greening-jackson.com)  21 January 2017
 import logging
 import sys
 import datetime
+import decimal
 import re
 import os
+import contextlib
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG, 
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -31,7 +33,7 @@ logger = logging.getLogger()
 try:
     from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy import Column, Integer, BigInteger
-    from sqlalchemy import String, Date, Time, DateTime, Numeric
+    from sqlalchemy import String, Date, Time, DateTime, Numeric, Boolean
     from sqlalchemy import inspect
 except ModuleNotFoundError:
     logging.error('Can\'t import SQLAlchemy. Aborting.')
@@ -41,6 +43,25 @@ except ModuleNotFoundError:
 Base = declarative_base()
 
 
+@contextlib.contextmanager
+def Snapshot(engine):
+    """
+    Yields a connection to the database in a transaction which sees all of
+    it as it was at one moment, so that several tables can be read
+    consistently. PostgreSQL's default READ COMMITTED takes a new snapshot
+    for each statement, so the transaction is REPEATABLE READ (and read
+    only), and pysqlite doesn't begin a transaction until something's
+    written, so it's begun by hand.
+    """
+    if engine.dialect.name == 'postgresql':
+        engine = engine.execution_options(isolation_level='REPEATABLE READ',
+                                          postgresql_readonly=True)
+    with engine.connect() as connection, connection.begin():
+        if engine.dialect.name == 'sqlite':
+            connection.exec_driver_sql('BEGIN')
+        yield connection
+
+
 class File(Base):
     """
     Class to track files which are loaded
@@ -66,12 +87,24 @@ class File(Base):
     Organisations          = Column(Integer)
     Classifications        = Column(Integer)
     Trailers               = Column(Integer)
-
-    def __init__(self, name, session):
+    # Outcome of a Change-Only Update (None for a full load)
+    Inserts                = Column(Integer)
+    Updates                = Column(Integer)
+    Deletes                = Column(Integer)
+    # Lines committed so far when checkpointing, so that a load can resume
+    LinesDone              = Column(BigInteger)
+    # Whether the number of records matched the Trailer's RECORD_COUNT
+    Verified               = Column(Boolean)
+    # Fingerprint of the file's (uncompressed) contents, to spot duplicates
+    CRC32                  = Column(String(8))
+    Size                   = Column(BigInteger)
+
+    def __init__(self, name, session, fingerprint=(None, None)):
         old = session.query(File).filter(
                 File.FileName == name, 
                 File.SupersededBy == None).all()
         self.FileName = os.path.split(name)[1]
+        self.CRC32, self.Size = fingerprint
         session.add(self)
         session.commit()
         for file in old:
@@ -92,6 +125,10 @@ class File(Base):
         self.Classifications        = counters['32']
         self.MetaData               = counters['29']
         self.Trailers               = counters['99']
+        self.Inserts                = counters.get('I')
+        self.Updates                = counters.get('U')
+        self.Deletes                = counters.get('D')
+        self.Verified               = counters.get('Verified')
         session.commit()
 
     def __repr__(self):
@@ -123,6 +160,7 @@ class Street(Base): # Type 11 records
     Premium tehcnical specification (March 2016)
     """
     __tablename__          = 'streets'
+    NaturalKey             = ('USRN',)
     id                     = Column(Integer, primary_key=True)
     CHANGE_TYPE            = Column(String(1))
     PRO_ORDER              = Column(BigInteger)
@@ -157,6 +195,7 @@ class StreetDescriptor(Base): #Type 15 records
     AddressBase Premium tehcnical specification (March 2016)
     """
     __tablename__          = 'streetdescriptors'
+    NaturalKey             = ('USRN', 'LANGUAGE')
     id                     = Column(Integer, primary_key=True)
     CHANGE_TYPE            = Column(String(1))
     PRO_ORDER              = Column(BigInteger)
@@ -183,6 +222,7 @@ class BLPU(Base): # Type 21
     """
     OSGridRegexp           = re.compile('^([A-Z]{2})(\d{2})(\d{2})$', re.IGNORECASE)
     __tablename__          = 'blpus'
+    NaturalKey             = ('UPRN',)
     id                     = Column(Integer, primary_key=True)
     CHANGE_TYPE            = Column(String(1))
     PRO_ORDER              = Column(BigInteger)
@@ -205,6 +245,9 @@ class BLPU(Base): # Type 21
     ADDRESSBASE_POSTAL     = Column(String(1))
     POSTCODE_LOCATOR       = Column(String(8), index=True)
     MULTI_OCC_COUNT        = Column(BigInteger)
+    # Our own column: the partition the row is in when the table is
+    # partitioned (see Partitions.py)
+    PARTITION_KEY          = Column(String(4))
 
     def __repr__(self):
         return "{} {} {}".format(self.UPRN, self.LATITUDE, self.LONGITUDE)
@@ -215,6 +258,7 @@ class ApplicationCrossReference(Base): # Type 23
     AddressBase Premium tehcnical specification (March 2016)
     """
     __tablename__          = 'appxrefs'
+    NaturalKey             = ('XREF_KEY',)
     id                     = Column(Integer, primary_key=True)
     CHANGE_TYPE            = Column(String(1))
     PRO_ORDER              = Column(BigInteger)
@@ -234,6 +278,7 @@ class LPI(Base): # Type24
     AddressBase Premium tehcnical specification (March 2016)
     """
     __tablename__          = 'lpis'
+    NaturalKey             = ('UPRN', 'LPI_KEY')
     id                     = Column(Integer, primary_key=True)
     CHANGE_TYPE            = Column(String(1))
     PRO_ORDER              = Column(BigInteger)
@@ -260,6 +305,9 @@ class LPI(Base): # Type24
     AREA_NAME              = Column(String(40))
     LEVEL                  = Column(String(30))
     OFFICIAL_FLAG          = Column(String(1))
+    # Our own column: the partition the row is in when the table is
+    # partitioned (see Partitions.py)
+    PARTITION_KEY          = Column(String(4))
 
     def __repr__(self):
         return "{} {} {} {}".format(self.UPRN, self.USRN, 
@@ -271,6 +319,7 @@ class DeliveryPointAddress(Base): # Type 28
     AddressBase Premium tehcnical specification (March 2016)
     """
     __tablename__                   = 'dpaddresses'
+    NaturalKey                      = ('UDPRN',)
     id                              = Column(Integer, primary_key=True)
     CHANGE_TYPE                     = Column(String(1))
     PRO_ORDER                       = Column(BigInteger)
@@ -300,6 +349,9 @@ class DeliveryPointAddress(Base): # Type 28
     END_DATE                        = Column(Date)
     LAST_UPDATE_DATE                = Column(Date)
     ENTRY_DATE                      = Column(Date)
+    # Our own column: the partition the row is in when the table is
+    # partitioned (see Partitions.py)
+    PARTITION_KEY                   = Column(String(4))
 
     def __repr__(self):
         s = "UPRN: {} ".format(self.UPRN)
@@ -348,6 +400,7 @@ class SuccessorCrossReference(Base): # Type 30
     AddressBase Premium tehcnical specification (March 2016)
     """
     __tablename__          = 'succxrefs'
+    NaturalKey             = ('SUCC_KEY',)
     id                     = Column(Integer, primary_key=True)
     CHANGE_TYPE            = Column(String(1))
     PRO_ORDER              = Column(BigInteger)
@@ -365,6 +418,7 @@ class Organisation(Base): # Type 31
     AddressBase Premium tehcnical specification (March 2016)
     """
     __tablename__          = 'organisations'
+    NaturalKey             = ('ORG_KEY',)
     id                     = Column(Integer, primary_key=True)
     CHANGE_TYPE            = Column(String(1))
     PRO_ORDER              = Column(BigInteger)
@@ -386,6 +440,7 @@ class Classification(Base): # Type 32
     AddressBase Premium tehcnical specification (March 2016)
     """
     __tablename__          = 'classifications'
+    NaturalKey             = ('CLASS_KEY',)
     id                     = Column(Integer, primary_key=True)
     CHANGE_TYPE            = Column(String(1))
     PRO_ORDER              = Column(BigInteger)
@@ -400,8 +455,12 @@ class Classification(Base): # Type 32
     ENTRY_DATE             = Column(Date)
     # Our own column replacing the existing text-based one with a
     # number and also doing a look up on the AddressBasedClassifications
-    CLASS_TYPE             = Column(Integer)
-    ABC                    = Column(Integer)
+    # (ClassScheme.id and ClassificationCode.id. See Classifications.py)
+    CLASS_TYPE             = Column(Integer, index=True)
+    ABC                    = Column(Integer, index=True)
+    # Our own column: the partition the row is in when the table is
+    # partitioned (see Partitions.py)
+    PARTITION_KEY          = Column(String(4))
 
     def __repr__(self):
        return "{} {} {} {} (ClassScheme.id={}, ABC.id={})".format(self.UPRN, self.CLASS_KEY, 
@@ -419,6 +478,68 @@ class Trailer(Base): # Type 99
     ENTRY_DATE             = Column(Date)
     TIME_STAMP             = Column(Time)
 
+class Address(Base):
+    """
+    Our own denormalised table of one row per UPRN with its address on one
+    line, built from the DPA (or failing that the LPI and its street), 
+    BLPU, Organisation and Classification records. See Addresses.py.
+    """
+    __tablename__          = 'addresses'
+    id                     = Column(Integer, primary_key=True)
+    UPRN                   = Column(BigInteger, index=True, unique=True)
+    USRN                   = Column(BigInteger)
+    SOURCE                 = Column(String(3)) # DPA or LPI
+    ADDRESS                = Column(String(600))
+    POSTCODE               = Column(String(8), index=True)
+    X_COORDINATE           = Column(Numeric(8, 2))
+    Y_COORDINATE           = Column(Numeric(9, 2))
+    LATITUDE               = Column(Numeric(9, 7))
+    LONGITUDE              = Column(Numeric(8, 7))
+    CLASSIFICATION_CODE    = Column(String(6))
+
+    def __repr__(self):
+        return "{} {}".format(self.UPRN, self.ADDRESS)
+
+class Hierarchy(Base):
+    """
+    Our own closure table of the BLPUs' PARENT_UPRNs: a row for every
+    ancestor of every UPRN with a parent, DEPTH levels up (1 being the
+    parent). So all the units under a building, or everything above a unit,
+    is a single indexed lookup. See Hierarchies.py.
+    """
+    __tablename__          = 'hierarchy'
+    id                     = Column(Integer, primary_key=True)
+    ANCESTOR               = Column(BigInteger, index=True)
+    DESCENDANT             = Column(BigInteger, index=True)
+    DEPTH                  = Column(Integer)
+
+    def __repr__(self):
+        return "{} < {} ({})".format(self.DESCENDANT, self.ANCESTOR, self.DEPTH)
+
+class ClassScheme(Base):
+    """
+    Our own lookup table of the classification schemes (CLASS_SCHEME) of
+    the Classification records, to which Classification.CLASS_TYPE refers.
+    """
+    __tablename__          = 'classschemes'
+    id                     = Column(Integer, primary_key=True)
+    CLASS_SCHEME           = Column(String(60), unique=True)
+
+    def __repr__(self):
+        return "{} {}".format(self.id, self.CLASS_SCHEME)
+
+class ClassificationCode(Base):
+    """
+    Our own lookup table of the AddressBase classification codes (e.g. RD04)
+    to which Classification.ABC refers.
+    """
+    __tablename__          = 'classificationcodes'
+    id                     = Column(Integer, primary_key=True)
+    CODE                   = Column(String(6), unique=True)
+
+    def __repr__(self):
+        return "{} {}".format(self.id, self.CODE)
+
 class RecordType:
     """
     The different types of records which are in the OS data set. Each record 
@@ -439,9 +560,16 @@ class RecordType:
 
     (3) IF YOU WANT TO ADD YOUR OWN ATTRIBUTES THEN PUT THE NAME OF THE 
     ATTRIBUTE IN THE MYFIELDS LIST BELOW AND NAME IT IN LOWER-CASE 
+
+    The keys are the fields of the mapped class's NaturalKey (if it has one)
+    which identify a record when applying Change-Only Updates.
+
+    Each field also has a converter, taken from the type of its column, which
+    turns the string from the CSV into the appropriate Python type. These are
+    worked out once here so that converting a row is a single tight loop.
     """
     regexp   = re.compile('^[A-Z][A-Z_]*$')
-    myfields = ['id', 'CLASS_TYPE', 'ABC']
+    myfields = ['id', 'CLASS_TYPE', 'ABC', 'PARTITION_KEY']
     def __init__(self, name, code, mapping, ignore=False):
         self.name    = name    # e.g. "Header"
         self.code    = code    # e.g. '10' (note is a str not an int!)
@@ -453,6 +581,35 @@ class RecordType:
         for attribute in [a.key for a in inspect(self.mapping).attrs]: 
             if attribute not in RecordType.myfields and RecordType.regexp.match(attribute):
                 self.fields.append(attribute)
+        self.keys    = getattr(self.mapping, 'NaturalKey', ()) # Natural key for COU
+        columns = self.mapping.__table__.columns
+        self.converters = tuple(RecordType.Converter(columns[f].type) for f in self.fields)
+
+    @staticmethod
+    def Converter(coltype):
+        """
+        Returns a function converting a (non-empty) CSV string to a value of 
+        the given SQLAlchemy column type. Dates and times are in ISO format.
+        """
+        if isinstance(coltype, DateTime):
+            return datetime.datetime.fromisoformat
+        if isinstance(coltype, Date):
+            return datetime.date.fromisoformat
+        if isinstance(coltype, Time):
+            return datetime.time.fromisoformat
+        if isinstance(coltype, Integer): # Includes BigInteger
+            return int
+        if isinstance(coltype, Numeric):
+            return decimal.Decimal if coltype.asdecimal else float
+        return str
+
+    def Convert(self, rec):
+        """
+        Returns a tuple of the record's values converted to their column types,
+        with empty fields as None. Malformed values raise a ValueError (or
+        decimal.InvalidOperation for Numeric columns).
+        """
+        return tuple([c(v) if v else None for c, v in zip(self.converters, rec)])
 
     def __repr__(self):
         return "{:28} ({})".format(self.name, self.code)
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Fuzzy address search: matches free-text addresses against the DPA and LPI
+addresses using an inverted index of trigrams (three-character slices of
+each word, e.g. ' HI', 'HIG', 'IGH', 'GH '), so that misspellings, missing
+words and the odd word in the wrong order still find the right UPRNs.
+
+Each DPA and each LPI (with its street and the BLPU's postcode) is a
+"document" formatted as in Addresses.py. The index is held in NumPy arrays
+in the same way as PostcodeIndex: for each trigram the sorted documents
+containing it (postings), plus each document's UPRN and total weight. A
+trigram's weight is its inverse document frequency, so rare ones count
+for more than 'THE' or ' RO'.
+
+A search takes its candidates from the postings of the rarest trigrams of
+the query, keeps the best of them and scores those on all of its trigrams
+by weighted Jaccard similarity, returning the best UPRNs. e.g.
+
+    index = AddressSearch.FromDatabase(engine)
+    index.Search('10 downing stret london sw1a 2aa')  # -> [(uprn, score), ...]
+    index.SearchMany(addresses, workers=8)           # -> [[(uprn, score), ...], ...]
+"""
+
+import re
+import sys
+import logging
+import argparse
+import multiprocessing
+
+from AddressBase import logger, BLPU, LPI, DeliveryPointAddress, StreetDescriptor
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    logging.error('Can\'t import NumPy. Aborting.')
+    sys.exit()
+
+from sqlalchemy import create_engine, select
+
+from BuildAddressBaseTables import CreateRecordTypes, ReadRecords
+from Addresses import FormatDPA, FormatLPI
+
+ChunkDocs = 100000     # Documents gathered into each array while building
+CandidatePostings = 200000 # Postings read to find a query's candidates
+Shortlist = 2000       # Candidates scored on all of the query's trigrams
+SearchIndex = None     # The index of a SearchMany worker process
+
+
+def Grams(text):
+    """
+    Returns the set of trigrams of the words of text, upper-cased with
+    anything other than letters and digits taken as a space.
+    """
+    grams = set()
+    for word in re.sub(r'[^A-Z0-9]+', ' ', (text or '').upper()).split():
+        word = ' {} '.format(word)
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def InitSearch(index):
+    global SearchIndex
+    SearchIndex = index
+
+
+def SearchWorker(job):
+    text, k = job
+    return SearchIndex.Search(text, k)
+
+
+class AddressSearch:
+    """
+    Trigram index of the DPA and LPI addresses. Build it with FromDatabase,
+    FromCSV or FromDocuments, or Load one which was Saved.
+    """
+    def __init__(self, grams, offsets, postings, weights, docweights, uprns):
+        self.grams      = {g: i for i, g in enumerate(grams)} # Trigram -> id
+        self.gramlist   = grams       # Trigrams in id order
+        self.offsets    = offsets     # Start of each trigram's postings, plus the end
+        self.postings   = postings    # Sorted documents of each trigram in turn
+        self.weights    = weights     # Weight (IDF) of each trigram
+        self.docweights = docweights  # Total weight of each document's trigrams
+        self.uprns      = uprns       # UPRN of each document
+
+    @classmethod
+    def FromDocuments(cls, documents):
+        """
+        Builds the index from an iterable of (UPRN, address text).
+        """
+        grams = {}
+        gramchunks, docchunks, uprns = [], [], []
+        gramids, docids = [], []
+        for uprn, text in documents:
+            if uprn is None:
+                continue
+            doc = len(uprns)
+            uprns.append(uprn)
+            ids = [grams.setdefault(g, len(grams)) for g in Grams(text)]
+            gramids += ids
+            docids += [doc] * len(ids)
+            if len(uprns) % ChunkDocs == 0:
+                gramchunks.append(np.array(gramids, dtype=np.int32))
+                docchunks.append(np.array(docids, dtype=np.int32))
+                gramids, docids = [], []
+        gramchunks.append(np.array(gramids, dtype=np.int32))
+        docchunks.append(np.array(docids, dtype=np.int32))
+        gramids, docids = np.concatenate(gramchunks), np.concatenate(docchunks)
+        order = np.lexsort((docids, gramids))
+        postings = docids[order]
+        frequency = np.bincount(gramids, minlength=len(grams))
+        offsets = np.concatenate([[0], np.cumsum(frequency)]).astype(np.int64)
+        weights = np.log((len(uprns) + 1) / (frequency + 1)).astype(np.float32) + 1
+        docweights = np.bincount(docids, weights=weights[gramids], minlength=len(uprns)).astype(np.float32)
+        gramlist = np.array(sorted(grams, key=grams.get), dtype='U3')
+        logger.info("Indexed {:,} addresses with {:,} trigrams".format(len(uprns), len(grams)))
+        return cls(gramlist, offsets, postings, weights, docweights, np.array(uprns, dtype=np.int64))
+
+    @classmethod
+    def FromDatabase(cls, engine):
+        """
+        Builds the index from the dpaddresses and lpis tables (with the
+        streets of the LPIs and postcodes of their BLPUs). The streets and
+        postcodes are looked up in dictionaries, as in FromCSV, rather than
+        joined, since a street or BLPU with several versions would make a
+        document for each.
+        """
+        def Documents():
+            with engine.connect() as connection:
+                streets = {(r.USRN, r.LANGUAGE): r for r in connection.execute(
+                    select(StreetDescriptor.USRN, StreetDescriptor.LANGUAGE, 
+                           StreetDescriptor.STREET_DESCRIPTION, StreetDescriptor.LOCALITY_NAME,
+                           StreetDescriptor.TOWN_NAME).order_by(StreetDescriptor.id)).mappings()}
+                postcodes = dict(connection.execute(select(BLPU.UPRN, BLPU.POSTCODE_LOCATOR)
+                                                    .order_by(BLPU.id)).all())
+                for dpa in connection.execute(select(DeliveryPointAddress.__table__)).mappings():
+                    yield dpa['UPRN'], FormatDPA(dpa)
+                for lpi in connection.execute(select(LPI.__table__)).mappings():
+                    yield lpi['UPRN'], FormatLPI(lpi, streets.get((lpi['USRN'], lpi['LANGUAGE'])),
+                                                 None, postcodes.get(lpi['UPRN']))
+        return cls.FromDocuments(Documents())
+
+    @classmethod
+    def FromCSV(cls, patterns):
+        """
+        Builds the index straight from the CSVs matching patterns (which may
+        be gzipped or zipped). They're read twice: once for the streets and
+        BLPUs' postcodes and then again for the DPAs and LPIs.
+        """
+        RecTypes = CreateRecordTypes()
+        def Record(rec):
+            return dict(zip(RecTypes[rec[0]].fields, rec[1:]))
+        streets, postcodes = {}, {}
+        for rec in ReadRecords(patterns, ('15', '21')):
+            r = Record(rec)
+            if rec[0] == '15':
+                streets[(r['USRN'], r['LANGUAGE'])] = r
+            else:
+                postcodes[r['UPRN']] = r['POSTCODE_LOCATOR']
+        def Documents():
+            for rec in ReadRecords(patterns, ('24', '28')):
+                r = Record(rec)
+                if r['CHANGE_TYPE'] == 'D' or not r['UPRN']:
+                    continue
+                if rec[0] == '28':
+                    yield int(r['UPRN']), FormatDPA(r)
+                else:
+                    yield int(r['UPRN']), FormatLPI(r, streets.get((r['USRN'], r['LANGUAGE'])),
+                                                    None, postcodes.get(r['UPRN']))
+        return cls.FromDocuments(Documents())
+
+    def Save(self, path):
+        """
+        Saves the index to a single (.npz) file.
+        """
+        np.savez(path, grams=self.gramlist, offsets=self.offsets, postings=self.postings,
+                 weights=self.weights, docweights=self.docweights, uprns=self.uprns)
+
+    @classmethod
+    def Load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            return cls(f['grams'], f['offsets'], f['postings'], f['weights'],
+                       f['docweights'], f['uprns'])
+
+    def __len__(self):
+        return len(self.uprns)
+
+    def Search(self, text, k=10):
+        """
+        Returns a list of up to k (UPRN, score) of the addresses best matching
+        text, best first. The score runs from 0 to 1 (an exact match).
+        """
+        ids = np.array(sorted({self.grams[g] for g in Grams(text) if g in self.grams}), dtype=np.int64)
+        if not len(ids):
+            return []
+        starts, ends = self.offsets[ids], self.offsets[ids + 1]
+        # Candidates from the rarest trigrams, as many as the budget allows
+        rare = np.argsort(ends - starts, kind='stable')
+        use = rare[:max(1, np.searchsorted(np.cumsum((ends - starts)[rare]), CandidatePostings, 'right'))]
+        found = np.concatenate([self.postings[starts[i]:ends[i]] for i in use])
+        weights = np.repeat(self.weights[ids[use]], (ends - starts)[use])
+        candidates, inverse = np.unique(found, return_inverse=True)
+        if len(candidates) > Shortlist:
+            best = np.bincount(inverse, weights=weights)
+            candidates = np.sort(candidates[np.argpartition(-best, Shortlist)[:Shortlist]])
+        # Score the shortlist on all the trigrams of the query
+        shared = np.zeros(len(candidates))
+        for i in range(len(ids)):
+            postings = self.postings[starts[i]:ends[i]]
+            at = np.minimum(np.searchsorted(postings, candidates), len(postings) - 1)
+            shared += (postings[at] == candidates) * self.weights[ids[i]]
+        total = self.weights[ids].sum()
+        scores = shared / (total + self.docweights[candidates] - shared)
+        # Best first, and only the best document of each UPRN
+        order = np.argsort(-scores, kind='stable')
+        uprns, first = np.unique(self.uprns[candidates[order]], return_index=True)
+        first = np.sort(first)[:k]
+        return [(int(self.uprns[candidates[order[i]]]), float(scores[order[i]])) for i in first]
+
+    def SearchMany(self, texts, k=10, workers=None):
+        """
+        Searches for each of texts, returning a list of the results of each
+        (see Search), with a pool of that many worker processes (all the
+        CPUs if None).
+        """
+        workers = workers or multiprocessing.cpu_count()
+        if workers < 2:
+            return [self.Search(t, k) for t in texts]
+        with multiprocessing.Pool(workers, InitSearch, (self,)) as pool:
+            return pool.map(SearchWorker, [(t, k) for t in texts], chunksize=256)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Build or search an address search index')
+    parser.add_argument('index',   help='Index file (.npz) to write or search')
+    parser.add_argument('--url',   help='SQLAlchemy URL of the database to build it from')
+    parser.add_argument('--csv',   help='CSV files to build it from instead', nargs='+')
+    parser.add_argument('--query', help='Addresses to search for', nargs='+')
+    parser.add_argument('-k',      help='Number of results per address', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.csv or args.url:
+        index = AddressSearch.FromCSV(args.csv) if args.csv else \
+                AddressSearch.FromDatabase(create_engine(args.url))
+        index.Save(args.index)
+    elif args.query:
+        index = AddressSearch.Load(args.index)
+        for query, results in zip(args.query, index.SearchMany(args.query, args.k)):
+            print(query)
+            for uprn, score in results:
+                print("    {} {:.3f}".format(uprn, score))
+    else:
+        logger.error('Requires --url, --csv or --query. See --help option for details.')
+        sys.exit()
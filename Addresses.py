@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Builds the denormalised addresses table (see AddressBase.Address): one row
+per UPRN with its address formatted on one line, postcode, coordinates and
+classification, so that consumers don't have to join half a dozen tables
+to get an address.
+
+The postal address from the DPA is used where there is one, and otherwise
+the geographic address made up from the LPI and its street. The table can
+either be rebuilt in one go after a load (BuildAddresses) or kept up to
+date file by file, refreshing just the UPRNs each file touched
+(RefreshAddresses). See the --addresses option of BuildAddressBaseTables.
+"""
+
+import sys
+import argparse
+
+from sqlalchemy import create_engine, select
+
+from AddressBase import logger, Address, BLPU, LPI, DeliveryPointAddress
+from AddressBase import StreetDescriptor, Organisation, Classification
+
+AddressChunk = 1000  # UPRNs built at a time
+Sources = ('15', '21', '24', '28', '31', '32') # Record types in an address
+Scheme = 'AddressBase Premium Classification Scheme'
+
+
+def Current(rows):
+    """
+    Returns the current one of several versions of a record: preferably one
+    without an END_DATE, then the latest by PRO_ORDER.
+    """
+    return max(rows, key=lambda r: (r['END_DATE'] is None, r['PRO_ORDER'] or 0))
+
+
+def Number(start, startsuffix, end, endsuffix):
+    """
+    Returns an LPI's start and end numbers and suffixes as e.g. '12A-14'
+    """
+    number = '{}{}'.format(start, startsuffix or '') if start else ''
+    if end:
+        number += '-{}{}'.format(end, endsuffix or '')
+    return number
+
+
+def Join(*parts):
+    return ', '.join(p for p in parts if p)
+
+
+def FormatDPA(dpa):
+    """
+    Returns a DPA's postal address on one line. The building number goes
+    with the first thoroughfare.
+    """
+    streets = [dpa['DEPENDENT_THOROUGHFARE'], dpa['THOROUGHFARE']]
+    streets = [s for s in streets if s] or ['']
+    if dpa['BUILDING_NUMBER']:
+        streets[0] = '{} {}'.format(dpa['BUILDING_NUMBER'], streets[0]).strip()
+    return Join(dpa['ORGANISATION_NAME'], dpa['DEPARTMENT_NAME'],
+                'PO BOX {}'.format(dpa['PO_BOX_NUMBER']) if dpa['PO_BOX_NUMBER'] else None,
+                dpa['SUB_BUILDING_NAME'], dpa['BUILDING_NAME'], *streets,
+                dpa['DOUBLE_DEPENDENT_LOCALITY'], dpa['DEPENDENT_LOCALITY'],
+                dpa['POST_TOWN'], dpa['POSTCODE'])
+
+
+def FormatLPI(lpi, street, organisation, postcode):
+    """
+    Returns the geographic address made up from an LPI, its street
+    descriptor (if any) and organisation (if any) on one line.
+    """
+    sao = Number(lpi['SAO_START_NUMBER'], lpi['SAO_START_SUFFIX'],
+                 lpi['SAO_END_NUMBER'], lpi['SAO_END_SUFFIX'])
+    pao = Number(lpi['PAO_START_NUMBER'], lpi['PAO_START_SUFFIX'],
+                 lpi['PAO_END_NUMBER'], lpi['PAO_END_SUFFIX'])
+    street = street or {}
+    return Join(organisation, lpi['SAO_TEXT'], sao, lpi['PAO_TEXT'],
+                '{} {}'.format(pao, street.get('STREET_DESCRIPTION') or '').strip(),
+                street.get('LOCALITY_NAME'), street.get('TOWN_NAME'), postcode)
+
+
+def Select(connection, table, where, column='UPRN'):
+    """
+    Returns the rows of table (as mappings) selected by where(column),
+    grouped in a dictionary by that column.
+    """
+    groups = {}
+    column = table.__table__.columns[column]
+    for row in connection.execute(select(table.__table__).where(where(column))).mappings():
+        groups.setdefault(row[column.name], []).append(row)
+    return groups
+
+
+def MakeAddresses(connection, where):
+    """
+    Returns the rows of the addresses table for the BLPUs selected by
+    where(column), where column is the UPRN column of each table in turn
+    e.g. lambda c: c.in_(uprns).
+    """
+    blpus = Select(connection, BLPU, where)
+    dpas = Select(connection, DeliveryPointAddress, where)
+    lpis = Select(connection, LPI, where)
+    organisations = Select(connection, Organisation, where)
+    classifications = Select(connection, Classification, where)
+    # Prefer approved (LOGICAL_STATUS 1) English LPIs
+    lpis = {u: max(rows, key=lambda r: (r['LOGICAL_STATUS'] == '1', r['LANGUAGE'] == 'ENG',
+                                        r['END_DATE'] is None, r['PRO_ORDER'] or 0))
+            for u, rows in lpis.items()}
+    usrns = sorted({l['USRN'] for l in lpis.values() if l['USRN']})
+    streets = {}
+    for i in range(0, len(usrns), AddressChunk):
+        chunk = usrns[i:i + AddressChunk]
+        streets.update(Select(connection, StreetDescriptor, lambda c: c.in_(chunk), 'USRN'))
+    rows = []
+    for uprn, versions in blpus.items():
+        blpu = Current(versions)
+        lpi = lpis.get(uprn)
+        classes = classifications.get(uprn, [])
+        scheme = [c for c in classes if (c['CLASS_SCHEME'] or '').startswith(Scheme)]
+        classification = Current(scheme or classes) if classes else None
+        row = {'UPRN': uprn, 'USRN': lpi['USRN'] if lpi else None,
+               'X_COORDINATE': blpu['X_COORDINATE'], 'Y_COORDINATE': blpu['Y_COORDINATE'],
+               'LATITUDE': blpu['LATITUDE'], 'LONGITUDE': blpu['LONGITUDE'],
+               'CLASSIFICATION_CODE': classification['CLASSIFICATION_CODE'] if classification else None}
+        if uprn in dpas:
+            dpa = Current(dpas[uprn])
+            row.update(SOURCE='DPA', ADDRESS=FormatDPA(dpa), POSTCODE=dpa['POSTCODE'])
+        elif lpi:
+            street = None
+            if lpi['USRN'] in streets:
+                street = max(streets[lpi['USRN']], key=lambda s: (s['LANGUAGE'] == lpi['LANGUAGE'],
+                                                                  s['END_DATE'] is None, s['PRO_ORDER'] or 0))
+            organisation = Current(organisations[uprn])['ORGANISATION'] if uprn in organisations else None
+            row.update(SOURCE='LPI', POSTCODE=blpu['POSTCODE_LOCATOR'],
+                       ADDRESS=FormatLPI(lpi, street, organisation, blpu['POSTCODE_LOCATOR']))
+        else:
+            row.update(SOURCE=None, ADDRESS=None, POSTCODE=blpu['POSTCODE_LOCATOR'])
+        rows.append(row)
+    return rows
+
+
+def TouchedUPRNs(connection, touched):
+    """
+    Returns the set of UPRNs whose addresses may have been changed by a file,
+    given the keys it touched (see ImportFile): the UPRNs of its records,
+    plus those of the LPIs on any street whose descriptor it touched.
+    """
+    uprns = set()
+    for code in Sources:
+        if code != '15':
+            uprns.update(int(u) for u in touched.get(code, ()) if u.isdigit())
+    usrns = sorted(int(u) for u in touched.get('15', ()) if u.isdigit())
+    for i in range(0, len(usrns), AddressChunk):
+        chunk = usrns[i:i + AddressChunk]
+        uprns.update(u for u, in connection.execute(
+            select(LPI.UPRN).where(LPI.USRN.in_(chunk)).distinct()))
+    return uprns
+
+
+def RefreshAddresses(connection, uprns):
+    """
+    Rebuilds the addresses of the given UPRNs, in the connection's
+    transaction. Any whose BLPU has gone are deleted.
+    """
+    uprns = sorted(uprns)
+    table = Address.__table__
+    for i in range(0, len(uprns), AddressChunk):
+        chunk = uprns[i:i + AddressChunk]
+        rows = MakeAddresses(connection, lambda c: c.in_(chunk))
+        connection.execute(table.delete().where(table.c.UPRN.in_(chunk)))
+        if rows:
+            connection.execute(table.insert(), rows)
+    logger.info("Refreshed the addresses of {:,} UPRNs".format(len(uprns)))
+
+
+def BuildAddresses(engine):
+    """
+    Rebuilds the whole addresses table from the loaded tables in one pass,
+    a range of AddressChunk UPRNs at a time.
+    """
+    table = Address.__table__
+    table.create(bind=engine, checkfirst=True)
+    built = 0
+    with engine.begin() as connection:
+        connection.execute(table.delete())
+        last = -1
+        while True:
+            uprns = connection.execute(select(BLPU.UPRN).where(BLPU.UPRN > last).distinct()
+                                       .order_by(BLPU.UPRN).limit(AddressChunk)).scalars().all()
+            if not uprns:
+                break
+            first, last = uprns[0], uprns[-1]
+            rows = MakeAddresses(connection, lambda c: c.between(first, last))
+            connection.execute(table.insert(), rows)
+            built += len(rows)
+    logger.info("Built {:,} addresses".format(built))
+    return built
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Build the addresses table')
+    parser.add_argument('--url', help='SQLAlchemy URL of the database')
+    args = parser.parse_args()
+
+    if not args.url:
+        logger.error('Requires --url. See --help option for details.')
+        sys.exit()
+    BuildAddresses(create_engine(args.url))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks CreateAddressBaseTables against synthetic data (see
+GenerateTestData) so that each change to the ingest can be measured without
+a licensed OS data set.
+
+A single synthetic file is generated and split into one file per record
+type, and each is then loaded in turn, timing it and measuring the peak
+memory used. By default the database is a scratch SQLite file, but any
+SQLAlchemy URL can be given instead, e.g. a local PostgreSQL with
+
+    python BenchmarkIngest.py --url postgresql://localhost/abpbench --bulk
+
+The results can be saved as a baseline and later runs compared against it.
+"""
+
+import os
+import csv
+import json
+import time
+import logging
+import argparse
+import tempfile
+
+from sqlalchemy import create_engine
+
+import BuildAddressBaseTables
+from BuildAddressBaseTables import CreateAddressBaseTables, CreateRecordTypes
+from BuildAddressBaseTables import PeakMemory
+from GenerateTestData import GenerateFile, ParseMix
+from AddressBase import logger
+
+
+def SplitByRecordType(path, workdir):
+    """
+    Splits a CSV file into one file per record type, returning a dictionary
+    of record type code to (file name, number of rows). The Trailer is left
+    out, as its RECORD_COUNT is of the whole file rather than any of the
+    split ones.
+    """
+    writers = {}
+    try:
+        with open(path, encoding='latin-1', newline='') as f:
+            for row in csv.reader(f):
+                if row[0] == '99':
+                    continue
+                if row[0] not in writers:
+                    name = os.path.join(workdir, 'bench_{}.csv'.format(row[0]))
+                    out = open(name, 'w', encoding='latin-1', newline='')
+                    writers[row[0]] = [out, csv.writer(out), name, 0]
+                w = writers[row[0]]
+                w[1].writerow(row)
+                w[3] += 1
+    finally:
+        for w in writers.values():
+            w[0].close()
+    return {code: (w[2], w[3]) for code, w in writers.items()}
+
+
+def RunBenchmark(url=None, rows=100000, mix=None, workdir=None, seed=0, **options):
+    """
+    Generates rows of synthetic data and loads it, one record type at a time,
+    into the database at url (a scratch SQLite database in workdir if None)
+    with the given CreateAddressBaseTables options. Returns a list of a
+    dictionary of results per record type.
+    """
+    if workdir:
+        os.makedirs(workdir, exist_ok=True)
+    else:
+        workdir = tempfile.mkdtemp(prefix='abpbench')
+    url = url or 'sqlite:///{}'.format(os.path.join(workdir, 'bench.db'))
+    RecTypes = CreateRecordTypes()
+    source = os.path.join(workdir, 'bench.csv')
+    GenerateFile(source, rows, mix, seed=seed)
+    files = SplitByRecordType(source, workdir)
+
+    BuildAddressBaseTables.engine = create_engine(url)
+    results = []
+    rebuild = True
+    for code in sorted(files):
+        name, n = files[code]
+        start = time.time()
+        CreateAddressBaseTables([name], rebuild=rebuild, **options)
+        seconds = time.time() - start
+        rebuild = False
+        peak = PeakMemory()
+        results.append({'code': code, 'name': RecTypes[code].name, 'rows': n,
+                        'seconds': seconds, 'rate': n / seconds if seconds else 0,
+                        'peak': peak})
+    BuildAddressBaseTables.engine.dispose()
+    return results
+
+
+def Report(results, baseline=None):
+    """
+    Prints the results, compared with those of the baseline (if any).
+    """
+    base = {r['code']: r for r in baseline or []}
+    if baseline:
+        base['Total'] = Total(baseline)
+    print("{:34} {:>10} {:>9} {:>12} {:>10} {:>10}".format(
+        'Record type', 'Rows', 'Seconds', 'Rows/sec', 'Peak MB', 'vs base'))
+    for r in results + [Total(results)]:
+        change = ''
+        if r['code'] in base and base[r['code']]['rate']:
+            change = '{:+.1f}%'.format(100 * (r['rate'] / base[r['code']]['rate'] - 1))
+        print("{:34} {:>10,} {:>9.2f} {:>12,.0f} {:>10} {:>10}".format(
+            '{} ({})'.format(r['name'], r['code']) if r['code'] != 'Total' else 'Total',
+            r['rows'], r['seconds'], r['rate'],
+            '{:,.1f}'.format(r['peak'] / 2**20) if r['peak'] else '-', change))
+
+
+def Total(results):
+    rows = sum(r['rows'] for r in results)
+    seconds = sum(r['seconds'] for r in results)
+    peaks = [r['peak'] for r in results if r['peak']]
+    return {'code': 'Total', 'name': 'Total', 'rows': rows, 'seconds': seconds,
+            'rate': rows / seconds if seconds else 0,
+            'peak': max(peaks) if peaks else None}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Benchmark ABP ingest')
+    parser.add_argument('--url',        help='SQLAlchemy URL of the database (default scratch SQLite)')
+    parser.add_argument('--rows',       help='Number of synthetic rows', type=int, default=100000)
+    parser.add_argument('--mix',        help='Record type weights e.g. 21=1,24=1.2,28=0.8')
+    parser.add_argument('--seed',       help='Random seed', type=int, default=0)
+    parser.add_argument('--workdir',    help='Directory for the generated files')
+    parser.add_argument('--save',       help='Save the results as JSON to this file')
+    parser.add_argument('--baseline',   help='Compare against results saved with --save')
+    parser.add_argument('--bulk',       action='store_true')
+    parser.add_argument('--batch-size', type=int, dest='batchsize')
+    parser.add_argument('--pipeline',   type=int, default=0)
+    parser.add_argument('--defer-indexes', action='store_true', dest='deferindexes')
+    parser.add_argument('--verbose',    action='store_true', help='Show the ingest log')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+    results = RunBenchmark(args.url, args.rows, ParseMix(args.mix) if args.mix else None,
+                           workdir=args.workdir, seed=args.seed, bulk=args.bulk,
+                           batchsize=args.batchsize, pipeline=args.pipeline,
+                           deferindexes=args.deferindexes)
+    Report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -3,12 +3,29 @@
 Ingest the OS AddressBase Premium files from CSV.
 """
 import csv
+import io
 import os
+import copy
+import gzip
+import zlib
+import mmap
+import zipfile
+import contextlib
 import glob
 import argparse
 import sys
 import logging
 import getpass
+import multiprocessing
+import time
+import queue
+import threading
+import concurrent.futures
+
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG, 
                     format='%(asctime)s %(levelname)s %(message)s')
@@ -17,7 +34,7 @@ logger = logging.getLogger()
 
 try:
     from sqlalchemy.orm import sessionmaker
-    from sqlalchemy import create_engine
+    from sqlalchemy import create_engine, tuple_, inspect, select
 except ModuleNotFoundError:
     logging.error('Can\'t import SQLAlchemy. Aborting.')
     sys.exit()
@@ -27,8 +44,25 @@ from AddressBase import Header, Street, StreetDescriptor, BLPU
 from AddressBase import ApplicationCrossReference, LPI, MetaData
 from AddressBase import DeliveryPointAddress, SuccessorCrossReference
 from AddressBase import Organisation, Classification
-from AddressBase import Trailer
+from AddressBase import Trailer, Address, Hierarchy, ClassScheme, ClassificationCode
 from AddressBase import logger
+from IngestMetrics import Metrics
+import Addresses
+import Classifications
+import Hierarchies
+import Partitions
+
+engine = None        # Set up from the command line (or by the caller)
+BulkBatchSize = 10000 # Rows per executemany/COPY when bulk loading
+DeleteChunkSize = 400 # Keys per DELETE ... IN when applying COUs
+IndexThreads = 4      # Indexes built at once after a deferred-index load
+PipelineDepth = 4     # Batches queued per pipeline writer before the reader waits
+PipelinePoll = 0.5    # Seconds pipeline stages wait before checking for failure
+ProgressRows = 10000  # Rows between calls of ImportFile's progress callback
+ProgressPoll = 5      # Seconds the parent waits on the workers between progress checks
+WorkerRecTypes = None # RecordTypes of a worker process (see InitWorker)
+WorkerClasses = None  # ClassificationCache of a worker process
+WorkerReading = None  # Rows read by the workers of the files they're still loading
 
 
 def CreateRecordTypes():
@@ -58,103 +92,1314 @@ def CreateObject(rt, rec):
     
     The RecordType object has the mapping (i.e. what class the record maps to) 
     and a list of the fields of that class in order. So all we need to do is 
-    go through the fields in the record and allocate each to the appropriate
-    attribute.
+    go through the (converted) fields in the record and allocate each to the 
+    appropriate attribute.
     
     rt:  RecordType
     rec: The record itself
     """
+    if rt.mapping and not rt.ignore:
+        ob = rt.mapping()
+        for f, v in zip(rt.fields, rt.Convert(rec)):
+            setattr(ob, f, v)
+        return ob
+    return None
+
+
+def CreateRow(rt, rec):
+    """
+    Bulk-load counterpart of CreateObject. Rather than building an SQLAlchemy
+    object it returns a plain tuple of values in the order of rt.fields, 
+    converted to their column types (see RecordType.Convert), or None if the
+    record type isn't imported.
+
+    rt:  RecordType
+    rec: The record itself
+    """
+    if rt.mapping and not rt.ignore:
+        return rt.Convert(rec)
+    return None
+
+
+def Dropped(value):
+    """
+    Converter of a column which isn't being loaded (see RecordFilter)
+    """
+    return None
+
+
+def PostcodeArea(postcode):
+    """
+    Returns the area (the leading letters) of a postcode e.g. 'SW' of 'SW1A 1AA'
+    """
+    postcode = postcode.strip().upper()
+    return postcode[:2] if postcode[1:2].isalpha() else postcode[:1]
+
+
+def Custodian(code):
+    """
+    Returns a LOCAL_CUSTODIAN_CODE without any leading zeros
+    """
+    return str(int(code))
+
+
+class RecordFilter:
+    """
+    Which records, and which of their columns, to import: so that a load of 
+    only a few record types or only part of the country does only that
+    part of the work. Everything is decided on the raw CSV fields, before
+    any row or object is built.
+
+    recordtypes is a list of the record types (codes or names) to import;
+    the others are ignored (see RecordType.ignore). columns is a list of 
+    columns which aren't loaded (left null) in any record type which has
+    them; keys can't be dropped.
+
+    countries, custodians and areas restrict the import to the properties 
+    with the given COUNTRY codes, LOCAL_CUSTODIAN_CODEs and postcode areas.
+    Any record type with a UPRN and all the fields tested (i.e. BLPUs, and
+    DPAs for areas) is tested directly. The UPRNs of the records which pass
+    are remembered, and the other record types with a UPRN (LPIs and so on)
+    are imported if their UPRN has passed, whether or not the BLPUs
+    themselves are being imported. That relies on a property's BLPU
+    being read before its other records, which is the case in OS supplies,
+    where each file has its records in order of type. Records without a
+    UPRN (streets, headers etc.) are all imported.
+    """
+    Filters = {'countries':  ('COUNTRY',),
+               'custodians': ('LOCAL_CUSTODIAN_CODE',),
+               'areas':      ('POSTCODE_LOCATOR', 'POSTCODE')}
+    Converters = {'countries':  str.upper,
+                  'custodians': Custodian,
+                  'areas':      PostcodeArea}
+    Protected = ('CHANGE_TYPE', 'PRO_ORDER', 'UPRN', 'USRN')
+
+    def __init__(self, RecTypes, recordtypes=None, columns=None, 
+                 countries=None, custodians=None, areas=None):
+        names = {rt.name.upper(): code for code, rt in RecTypes.items()}
+        self.recordtypes = None
+        if recordtypes:
+            self.recordtypes = set()
+            for r in recordtypes:
+                code = r if r in RecTypes else names.get(r.upper())
+                if code is None:
+                    raise ValueError("Unknown record type {}".format(r))
+                self.recordtypes.add(code)
+        self.columns = set(columns or ())
+        fields = {f for rt in RecTypes.values() for f in rt.fields}
+        keys = {k for rt in RecTypes.values() for k in rt.keys}
+        for c in self.columns:
+            if c not in fields:
+                raise ValueError("Unknown column {}".format(c))
+            if c in keys or c in RecordFilter.Protected:
+                raise ValueError("Can't drop key column {}".format(c))
+        values = {'countries':  {c.upper() for c in countries or ()},
+                  'custodians': {Custodian(c) for c in custodians or ()},
+                  'areas':      {a.upper() for a in areas or ()}}
+        active = [f for f in RecordFilter.Filters if values[f]]
+        self.uprns = set() # Of the records which passed
+        # For each record type with a UPRN: where the UPRN is and the fields
+        # to test and their allowed values (or None if it can't be tested)
+        self.plans = {}
+        for code, rt in RecTypes.items():
+            if not active or 'UPRN' not in rt.fields:
+                continue
+            tests = []
+            for f in active:
+                field = [n for n in RecordFilter.Filters[f] if n in rt.fields]
+                if not field:
+                    tests = None
+                    break
+                tests.append((rt.fields.index(field[0]) + 1, values[f], RecordFilter.Converters[f]))
+            self.plans[code] = (rt.fields.index('UPRN') + 1, tests)
+
+    def Apply(self, RecTypes):
+        """
+        Returns copies of RecTypes with the record types which aren't wanted
+        ignored and the dropped columns' converters replaced.
+        """
+        applied = {}
+        for code, rt in RecTypes.items():
+            rt = copy.copy(rt)
+            if self.recordtypes is not None and code not in self.recordtypes:
+                rt.ignore = True
+            if self.columns:
+                rt.converters = tuple(Dropped if f in self.columns else c
+                                      for f, c in zip(rt.fields, rt.converters))
+            applied[code] = rt
+        return applied
+
+    def Keep(self, rt, row):
+        """
+        Returns whether a record (as read from the CSV) is to be imported.
+        """
+        plan = self.plans.get(rt.code)
+        if plan is None:
+            return True
+        uprn, tests = plan
+        try:
+            if tests is None:
+                return row[uprn] in self.uprns
+            for i, allowed, convert in tests:
+                if convert(row[i]) not in allowed:
+                    return False
+        except (IndexError, ValueError): # Let ImportFile deal with it
+            return True
+        self.uprns.add(row[uprn])
+        return True
+
+
+def CopyInsert(connection, rt, rows):
+    """
+    Writes a batch of rows to a PostgreSQL table using COPY FROM STDIN, which
+    is very much faster than INSERTing them. The rows are written as CSV,
+    where an unquoted empty field is read by PostgreSQL as NULL.
+    """
+    table = rt.mapping.__table__
+    quote = connection.dialect.identifier_preparer
+    sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        quote.format_table(table),
+        ', '.join(quote.quote(f) for f in rt.fields))
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
     try:
-        if rt.mapping and not rt.ignore:
-            ob = rt.mapping()
-            for f, v in zip(rt.fields, rec):
-                if v:
-                    setattr(ob, f, v)
-                else:
-                    setattr(ob, f, None)
-            return ob
-        return None
-    except KeyError:
-        logger.warning("Got unknown record type '{}'".format(rec[0]))
+        if hasattr(cursor, 'copy_expert'): # psycopg2
+            cursor.copy_expert(sql, buffer)
+        else:                              # psycopg (v3)
+            with cursor.copy(sql) as copy:
+                copy.write(buffer.getvalue())
+    finally:
+        cursor.close()
+
+
+def BulkInsert(connection, rt, rows):
+    """
+    Writes a batch of rows (as returned by CreateRow) to the table onto
+    which rt maps, bypassing the ORM altogether. PostgreSQL gets a COPY,
+    everything else an executemany of a Core insert.
+    """
+    if not rows:
+        return
+    if connection.dialect.name == 'postgresql':
+        CopyInsert(connection, rt, rows)
+    else:
+        connection.execute(rt.mapping.__table__.insert(),
+                           [dict(zip(rt.fields, r)) for r in rows])
+
+
+def ApplyChanges(connection, rt, rows):
+    """
+    Applies a batch of Change-Only Update rows (as returned by CreateRow) to
+    the table onto which rt maps. The rows are taken in PRO_ORDER and only 
+    the last change to each natural key (see RecordType.keys) counts. Every
+    key in the batch has its existing row deleted, and the Inserts and 
+    Updates are then written with BulkInsert - i.e. an update is a 
+    delete followed by an insert, which works the same on any backend.
+
+    Record types without a natural key (Header, MetaData, Trailer) are just
+    inserted.
+    """
+    if not rt.keys:
+        BulkInsert(connection, rt, rows)
+        return
+    keyfields = [rt.fields.index(k) for k in rt.keys]
+    changetype = rt.fields.index('CHANGE_TYPE')
+    proorder = rt.fields.index('PRO_ORDER')
+    latest = {}
+    for r in sorted(rows, key=lambda r: r[proorder] or 0):
+        latest[tuple(r[i] for i in keyfields)] = r
+    table = rt.mapping.__table__
+    columns = [table.c[k] for k in rt.keys]
+    keys = list(latest)
+    for i in range(0, len(keys), DeleteChunkSize):
+        chunk = keys[i:i+DeleteChunkSize]
+        if len(columns) == 1:
+            condition = columns[0].in_([k[0] for k in chunk])
+        else:
+            condition = tuple_(*columns).in_(chunk)
+        connection.execute(table.delete().where(condition))
+    BulkInsert(connection, rt, [r for r in latest.values() if r[changetype] != 'D'])
+
+
+def Classified(Write, classes):
+    """
+    Returns Write (e.g. BulkInsert) with the CLASS_TYPE and ABC of the
+    Classification rows filled in from classes (see Classifications.py),
+    looking up and adding any new ones on the connection writing the rows.
+    """
+    def ClassifiedWrite(connection, rt, rows):
+        if rt.code != '32' or not rows:
+            return Write(connection, rt, rows)
+        classified = copy.copy(rt)
+        classified.fields = rt.fields + list(Classifications.Columns)
+        return Write(connection, classified, classes.Classify(connection, rt.fields, rows))
+    return ClassifiedWrite
+
+
+class Partitioner:
+    """
+    Routes the rows of the partitioned tables (see Partitions.py) to their
+    partitions, by filling in each row's PARTITION_KEY and creating any
+    partitions the rows need before they're written.
+
+    A BLPU's key is its LOCAL_CUSTODIAN_CODE (or, by area, the area of its
+    POSTCODE_LOCATOR) and a DPA's by area the area of its POSTCODE. The
+    other records take the key of their UPRN's BLPU. The BLPUs' keys are 
+    remembered as they're read (Note), since a batch of LPIs can be written
+    before the batch holding their BLPUs. A UPRN whose BLPU isn't in the 
+    file is looked up in the blpus table.
+
+    only is the key of a partition being reloaded (see ReloadPartition).
+    The rows of any other partition are left out.
+    """
+    Fields = {'custodian': ('LOCAL_CUSTODIAN_CODE',),
+              'area':      ('POSTCODE_LOCATOR', 'POSTCODE')}
+    Converters = {'custodian': Custodian,
+                  'area':      PostcodeArea}
+
+    def __init__(self, method, only=None):
+        self.method  = method  # 'custodian' or 'area'
+        self.only    = only
+        self.uprns   = {}      # UPRN -> key of its BLPU
+        self.created = set()   # (table, key) of the partitions made so far
+
+    def Start(self):
+        """
+        Forgets the BLPUs of the last file.
+        """
+        self.uprns = {}
+
+    def Key(self, value):
+        """
+        Returns the partition key of a custodian code or postcode (raw or
+        converted).
+        """
+        try:
+            return Partitions.Key(Partitioner.Converters[self.method](str(value)) if value else None)
+        except ValueError:
+            return Partitions.Unknown
+
+    def Field(self, rt):
+        """
+        Returns the position in rt.fields of the field which gives a 
+        record's key, or None if it takes its BLPU's.
+        """
+        for f in Partitioner.Fields[self.method]:
+            if f in rt.fields:
+                return rt.fields.index(f)
         return None
 
+    def Note(self, rt, row):
+        """
+        Remembers the key of a BLPU (as read from the CSV).
+        """
+        if rt.code != '21':
+            return
+        try:
+            self.uprns[int(row[rt.fields.index('UPRN') + 1])] = self.Key(row[self.Field(rt) + 1])
+        except (IndexError, ValueError): # Let ImportFile deal with it
+            pass
+
+    def Lookup(self, connection, uprns):
+        """
+        Returns a dictionary of the key of each of uprns from the blpus 
+        table (Unknown if it hasn't a BLPU).
+        """
+        keys = {u: Partitions.Unknown for u in uprns}
+        uprns = sorted(u for u in uprns if u is not None)
+        for i in range(0, len(uprns), DeleteChunkSize):
+            keys.update(connection.execute(select(BLPU.UPRN, BLPU.PARTITION_KEY).where(
+                BLPU.UPRN.in_(uprns[i:i+DeleteChunkSize]))).all())
+        return keys
+
+    def Route(self, connection, rt, rows):
+        """
+        Returns the rows (as returned by CreateRow) with their PARTITION_KEY
+        appended, having created any partitions they need.
+        """
+        field = self.Field(rt)
+        if field is None:
+            uprn = rt.fields.index('UPRN')
+            missing = {r[uprn] for r in rows if r[uprn] not in self.uprns}
+            if missing:
+                self.uprns.update(self.Lookup(connection, missing))
+            routed = [r + (self.uprns[r[uprn]],) for r in rows]
+        else:
+            routed = [r + (self.Key(r[field]),) for r in rows]
+        if self.only is not None:
+            routed = [r for r in routed if r[-1] == self.only]
+        table = rt.mapping.__table__
+        new = {r[-1] for r in routed if (table.name, r[-1]) not in self.created}
+        Partitions.CreatePartitions(connection, table, sorted(new))
+        self.created.update((table.name, k) for k in new)
+        return routed
+
+
+def Partitioned(Write, partitions):
+    """
+    Returns Write (e.g. BulkInsert) with the rows of the partitioned tables
+    routed to their partitions by partitions (a Partitioner).
+    """
+    def PartitionedWrite(connection, rt, rows):
+        if rt.mapping not in Partitions.Tables or not rows:
+            return Write(connection, rt, rows)
+        routed = copy.copy(rt)
+        routed.fields = rt.fields + [Partitions.Column]
+        return Write(connection, routed, partitions.Route(connection, rt, rows))
+    return PartitionedWrite
+
+
+def ExpandArchives(files):
+    """
+    Returns the list of sources to import from the list of files. A .zip 
+    file is replaced by a (zip file, member) tuple for each CSV in it so
+    that each is imported (and tracked in the files table) separately. 
+    Anything else - plain or gzipped CSVs - is returned as is.
+    """
+    sources = []
+    for file in files:
+        if file.lower().endswith('.zip'):
+            with zipfile.ZipFile(file) as z:
+                sources += [(file, m) for m in z.namelist() if m.lower().endswith('.csv')]
+        else:
+            sources.append(file)
+    return sources
+
+
+def SourceName(source):
+    """
+    Returns the name under which a source (see ExpandArchives) is recorded in
+    the files table: the base name of the CSV, whether it's on its own, 
+    gzipped or in a zip file. So foo.csv.gz is recorded as foo.csv and won't
+    be imported if foo.csv has been already.
+    """
+    if isinstance(source, tuple):
+        return os.path.split(source[1])[1]
+    name = os.path.split(source)[1]
+    return name[:-3] if name.lower().endswith('.gz') else name
+
+
+def SourceSize(source):
+    """
+    Returns the size in bytes of a source (see ExpandArchives): uncompressed
+    for a zip member, but compressed for a gzipped file as gzip doesn't 
+    reliably record the original size.
+    """
+    if isinstance(source, tuple):
+        with zipfile.ZipFile(source[0]) as z:
+            return z.getinfo(source[1]).file_size
+    return os.path.getsize(source)
+
+
+def Fingerprint(source):
+    """
+    Returns the (CRC-32 as hex, size) of the uncompressed contents of a 
+    source (see ExpandArchives), by which the files table spots files which
+    have been imported already, whatever they're called. Zip files record 
+    both for each member so they cost nothing; plain files are memory-mapped
+    and gzipped ones decompressed in chunks.
+    """
+    if isinstance(source, tuple):
+        with zipfile.ZipFile(source[0]) as z:
+            info = z.getinfo(source[1])
+            return '{:08x}'.format(info.CRC), info.file_size
+    crc, size = 0, 0
+    if source.lower().endswith('.gz'):
+        with gzip.open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+    else:
+        size = os.path.getsize(source)
+        if size:
+            with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                crc = zlib.crc32(m)
+    return '{:08x}'.format(crc), size
+
+
+def Fingerprints(sources):
+    """
+    Returns a dictionary of the Fingerprint of each source, working them out
+    in parallel. (zlib releases the GIL while it works so threads will do.)
+    """
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count()) as pool:
+        return dict(zip(sources, pool.map(Fingerprint, sources)))
+
 
-def CreateAddressBaseTables(patterns, rebuild = False):    
+@contextlib.contextmanager
+def OpenSource(source):
+    """
+    Opens a source (see ExpandArchives) as a text stream for csv.reader,
+    decompressing zip members and gzipped files on the fly rather than 
+    extracting them to disk first.
+    """
+    # Note that at the time of writing the CSVs were encoded in latin-1, rather than utf-8
+    if isinstance(source, tuple):
+        with zipfile.ZipFile(source[0]) as z, z.open(source[1]) as member:
+            yield io.TextIOWrapper(member, encoding='latin-1', newline='')
+    elif source.lower().endswith('.gz'):
+        with gzip.open(source, 'rt', encoding='latin-1', newline='') as f:
+            yield f
+    else:
+        with open(source, encoding='latin-1', newline='') as f:
+            yield f
+
+
+def ReadRecords(patterns, codes):
+    """
+    Yields the records (lists of strings, including the record identifier)
+    of the given record type codes from the CSVs matching patterns, which 
+    may be gzipped or in zip files as for CreateAddressBaseTables. Used to
+    build the various in-memory indexes straight from a supply without 
+    loading it into a database first.
+    """
+    files = []
+    for p in patterns:
+        files += glob.glob(p)
+    for source in ExpandArchives(files):
+        with OpenSource(source) as f:
+            for rec in csv.reader(f):
+                if rec and rec[0] in codes:
+                    yield rec
+
+
+class Pipeline:
+    """
+    The writing half of a pipelined import. The reader (ImportFile) parses and
+    converts rows into batches and Puts them on a bounded queue, from which 
+    one or more writer threads take them and Write them, each over its own 
+    connection and in its own transaction. So parsing in Python and writing
+    in the database go on at the same time.
+    
+    When the queue is full the reader waits for the writers to catch up. If
+    any stage fails the others stop, every writer's transaction is rolled
+    back and the error is raised in the reader. Otherwise Close commits all
+    of the writers' transactions once they've written everything.
+    """
+    def __init__(self, engine, Write, writers):
+        self.Write   = Write # e.g. BulkInsert
+        self.queue   = queue.Queue(PipelineDepth * writers)
+        self.abort   = threading.Event()
+        self.errors  = []
+        self.writers = []
+        for i in range(writers):
+            connection = engine.connect()
+            transaction = connection.begin()
+            thread = threading.Thread(target=self.Writer, args=(connection,), daemon=True)
+            self.writers.append((thread, connection, transaction))
+            thread.start()
+
+    def Writer(self, connection):
+        """
+        Body of a writer thread: writes batches until it gets the None which
+        marks the end of the file or the pipeline is aborted.
+        """
+        try:
+            while not self.abort.is_set():
+                try:
+                    item = self.queue.get(timeout=PipelinePoll)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    return
+                self.Write(connection, *item)
+        except Exception as e:
+            self.errors.append(e)
+            self.abort.set()
+
+    def Enqueue(self, item):
+        while True:
+            if self.abort.is_set():
+                raise self.errors[0] if self.errors else RuntimeError('Pipeline aborted')
+            try:
+                self.queue.put(item, timeout=PipelinePoll)
+                return
+            except queue.Full:
+                continue
+
+    def Put(self, rt, rows):
+        """
+        Queues a batch of rows of the given RecordType to be written, 
+        waiting if the writers are behind.
+        """
+        self.Enqueue((rt, rows))
+
+    def Close(self, commit=True):
+        """
+        Waits for the writers to finish and commits their transactions, or 
+        if commit is False (or a writer failed) rolls them back. A writer's
+        error is raised here unless we were told not to commit anyway.
+        """
+        if commit:
+            try:
+                for w in self.writers:
+                    self.Enqueue(None)
+            except Exception:
+                pass # A writer has failed, which is raised below
+        else:
+            self.abort.set()
+        for thread, connection, transaction in self.writers:
+            thread.join()
+        for thread, connection, transaction in self.writers:
+            if commit and not self.errors:
+                transaction.commit()
+            else:
+                transaction.rollback()
+            connection.close()
+        if commit and self.errors:
+            raise self.errors[0]
+
+
+def ResetPeakMemory():
+    """
+    Resets the process's high-water mark of resident memory so that the
+    peak can be measured per file. Only Linux allows this: elsewhere the
+    peak is that of the process as a whole.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def PeakMemory():
+    """
+    Returns the peak resident memory of the process (in bytes) since the
+    last ResetPeakMemory, or None if we've no way of finding out.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    return None
+
+
+def ImportFile(session, file, RecTypes, bulk=False, batchsize=None, 
+               changeonly=False, pipeline=0, stats=None, progress=None,
+               checkpoint=False, frec=None, touched=None, recordfilter=None,
+               classes=None, partitions=None):
+    """
+    Reads a single CSV file into the database within the session's 
+    transaction, returning a dictionary of the number of each type of 
+    record read (plus the number of errors).
+    
+    If bulk is set, rows are batched up as tuples and written with
+    BulkInsert rather than being added to the session as ORM objects.
+
+    If batchsize is set, the ORM objects are flushed and expunged from the
+    session every batchsize rows so that memory use doesn't grow with the
+    size of the file. (It also sets the size of the bulk batches.) The
+    transaction is still only committed at the end of the file.
+
+    If changeonly is set the file is a Change-Only Update and the batches are
+    applied with ApplyChanges. The counts then also include the number of 
+    each CHANGE_TYPE (I, U and D).
+
+    If pipeline is set, the batches are written by that many writer threads
+    (see Pipeline) while the file is still being read, rather than in the
+    session's transaction. This implies bulk. Change-Only Updates (and 
+    SQLite, which only allows one writer) only ever get one writer so that
+    the changes are applied in order, as do partitioned tables, where 
+    creating a partition locks the whole table.
+
+    If stats is a dictionary it's filled in with the figures for the file
+    for IngestMetrics: rows per record type, seconds spent parsing, building
+    rows/objects and flushing them, rows with the wrong number of fields, 
+    errors and peak memory. progress is called every ProgressRows rows with 
+    the number of rows read so far.
+
+    If checkpoint is set, everything read so far is committed every 
+    batchsize rows and the number of lines done recorded in frec (the file's
+    File row). If frec already has lines done, i.e. an earlier checkpointed
+    load of the file died part way through, those lines are only counted and
+    the load resumes after them, whether or not this load is checkpointing.
+    Checkpointing can't be pipelined, as the writers commit separately.
+
+    Whether or not checkpointing, the number of records is checked against
+    the Trailer's RECORD_COUNT and the result returned in counts['Verified'].
+
+    touched is a dictionary of record type code to a set, to which the UPRN
+    (or USRN if it has none) of each record of that type is added, as read,
+    so that the addresses of those UPRNs can be refreshed afterwards.
+
+    recordfilter (see RecordFilter) picks the record types, columns and 
+    records to import. Records it filters out are counted in 
+    counts['Filtered'].
+
+    classes (a Classifications.ClassificationCache) fills in the CLASS_TYPE
+    and ABC of Classification records.
+
+    partitions (a Partitioner) routes the rows of partitioned tables to 
+    their partitions. This implies bulk.
+    """
+    fname = SourceName(file)
+    counts = {t:0 for t in RecTypes} # Keep track of the numbers of each record
+    counts['Error'] = 0
+    counts['Filtered'] = 0
+    if recordfilter:
+        RecTypes = recordfilter.Apply(RecTypes)
+    start = time.time()
+    clock = time.perf_counter
+    build = flush = 0.0
+    mismatched = 0
+    ResetPeakMemory()
+    pending = []
+    if changeonly:
+        counts.update({'I':0, 'U':0, 'D':0})
+        bulk = True
+    # The lines an earlier checkpointed load committed are in the database
+    # already, so they're skipped whether or not this load is checkpointing
+    skip = (frec.LinesDone or 0) if frec is not None else 0
+    if skip:
+        logger.info("Resuming {} after line {:,}".format(fname, skip))
+    if checkpoint:
+        pipeline = 0
+        batchsize = batchsize or BulkBatchSize
+    if pipeline or partitions:
+        bulk = True
+    if bulk:
+        Write = ApplyChanges if changeonly else BulkInsert
+        if classes:
+            Write = Classified(Write, classes)
+        if partitions:
+            partitions.Start()
+            Write = Partitioned(Write, partitions)
+        batches = {t:[] for t in RecTypes}
+        batchsize = batchsize or BulkBatchSize
+        if pipeline:
+            bind = session.get_bind()
+            if changeonly or partitions or bind.dialect.name == 'sqlite':
+                pipeline = 1
+            writers = Pipeline(bind, Write, pipeline)
+            Flush = writers.Put
+        else:
+            Flush = lambda rt, batch: Write(session.connection(), rt, batch)
+
+    def Checkpoint(lines):
+        """
+        Writes out everything read so far and commits it along with the 
+        number of lines done.
+        """
+        if bulk:
+            for code, batch in batches.items():
+                Flush(RecTypes[code], batch)
+                batches[code] = []
+        else:
+            session.flush()
+            for o in pending:
+                session.expunge(o)
+            del pending[:]
+        frec.LinesDone = lines
+        session.commit()
+
+    if touched is not None:
+        keyfields = {}
+        for code in touched:
+            fields = RecTypes[code].fields
+            keyfields[code] = fields.index('UPRN' if 'UPRN' in fields else 'USRN') + 1
+    recordcount = None # From the Trailer
+    countfield = RecTypes['99'].fields.index('RECORD_COUNT') + 1
+    j = -1
+    try:
+        with OpenSource(file) as f:
+            for j, row in enumerate(csv.reader(f)):
+                if progress and not j % ProgressRows:
+                    progress(j)
+                if row[0] == '99':
+                    recordcount = row[countfield]
+                if touched is not None and row[0] in touched and keyfields[row[0]] < len(row):
+                    touched[row[0]].add(row[keyfields[row[0]]])
+                if j < skip: # Already done by an earlier load
+                    counts[row[0]] += 1
+                    # Remember which UPRNs the filter passed, and the
+                    # partitions of the BLPUs
+                    if recordfilter and not recordfilter.Keep(RecTypes[row[0]], row):
+                        continue
+                    if partitions:
+                        partitions.Note(RecTypes[row[0]], row)
+                    continue
+                if checkpoint and j > skip and not (j - skip) % batchsize:
+                    t = clock()
+                    Checkpoint(j)
+                    flush += clock() - t
+                rt = RecTypes[row[0]]
+                if len(row) != len(rt.fields) + 1:
+                    logger.warning("Got {} fields for {} record at line {} of {}: {}".\
+                           format(len(row)-1, rt.name, j+1, fname, "|".join(row[1:])))
+                    mismatched += 1
+                counts[rt.code] += 1
+                # The filter sees every record, even of the types which are
+                # ignored, so that it knows which UPRNs passed (e.g. from the
+                # BLPUs when only the LPIs are being loaded)
+                if recordfilter and not recordfilter.Keep(rt, row):
+                    if not rt.ignore:
+                        counts['Filtered'] += 1
+                    continue
+                if rt.ignore:
+                    continue
+                if partitions:
+                    partitions.Note(rt, row)
+                t = clock()
+                try:
+                    o = CreateRow(rt, row[1:]) if bulk else CreateObject(rt, row[1:])
+                except (ValueError, ArithmeticError) as e:
+                    logger.warning("Bad value in {} record at line {} of {}: {}".\
+                           format(rt.name, j+1, fname, e))
+                    counts['Error'] += 1
+                    continue
+                finally:
+                    build += clock() - t
+                if bulk:
+                    if o:
+                        if changeonly and rt.keys and o[0] in ('I', 'U', 'D'):
+                            counts[o[0]] += 1 # CHANGE_TYPE is always the first field
+                        batch = batches[rt.code]
+                        batch.append(o)
+                        if len(batch) >= batchsize:
+                            t = clock()
+                            Flush(rt, batch)
+                            flush += clock() - t
+                            batches[rt.code] = []
+                else:
+                    if o:
+                        if classes and rt.code == '32':
+                            classes.ClassifyObject(session.connection(), o)
+                        session.add(o)
+                        if batchsize:
+                            pending.append(o)
+                            if len(pending) >= batchsize:
+                                t = clock()
+                                session.flush()
+                                flush += clock() - t
+                                for o in pending:
+                                    session.expunge(o)
+                                pending = []
+        t = clock()
+        if bulk:
+            for code, batch in batches.items():
+                Flush(RecTypes[code], batch)
+        flush += clock() - t
+    except:
+        if pipeline:
+            writers.Close(commit=False)
+        raise
+    t = clock()
+    if pipeline:
+        writers.Close()
+    flush += clock() - t
+    if checkpoint or skip:
+        frec.LinesDone = j + 1 # All of them, committed with the rest
+    # The Trailer's count is of all the records in the file, including the
+    # Header and Trailer themselves
+    records = sum(counts[t] for t in RecTypes)
+    if recordcount:
+        counts['Verified'] = int(recordcount) == records
+        if not counts['Verified']:
+            logger.error("Read {:,} records from {} but its Trailer says {}".format(
+                records, fname, recordcount))
+    if stats is not None:
+        seconds = time.time() - start
+        stats.update({'file': fname, 'seconds': seconds, 'bytes': SourceSize(file),
+                      'rows': {RecTypes[c].name: counts[c] for c in RecTypes if counts[c]},
+                      'parse': seconds - build - flush, 'build': build, 'flush': flush,
+                      'mismatched': mismatched, 'errors': counts['Error'],
+                      'filtered': counts['Filtered'],
+                      'peak': PeakMemory()})
+    return counts
+
+
+def InitWorker(url, reading):
+    """
+    Initialiser for each process in the worker pool. Every worker has its
+    own engine (and hence connection) as they can't be shared between
+    processes. reading is the shared count of the rows the workers have
+    read of the files they're loading, for the parent's progress reports.
+    """
+    global engine, WorkerRecTypes, WorkerClasses, WorkerReading
+    engine = create_engine(url)
+    WorkerReading = reading
+    WorkerRecTypes = CreateRecordTypes()
+    WorkerClasses = Classifications.ClassificationCache()
+
+
+def Touching(addresses, hierarchy):
+    """
+    Returns the dictionary in which ImportFile is to keep track of the keys
+    of each record type a file touches: those in the addresses if they're
+    being refreshed and the BLPUs if the hierarchy is, or None if neither.
+    """
+    codes = set(Addresses.Sources if addresses else ()) | ({'21'} if hierarchy else set())
+    return {code: set() for code in codes} if codes else None
+
+
+def ImportWorker(job):
+    """
+    Imports a single file in a worker process. The File row has already been
+    created by the parent process so that the skip logic is free of races,
+    so all we need to do is load the file and Update its counts.
+    
+    job: tuple of (file name, File.id, dictionary of ImportFile options,
+    whether to keep track of the UPRNs touched for the addresses table and
+    for the hierarchy)
+
+    Returns the file, its counts, its stats and the keys it touched (see
+    ImportFile).
+    """
+    file, fileid, options, addresses, hierarchy = job
+    session = sessionmaker(bind=engine)()
+    stats = {}
+    touched = Touching(addresses, hierarchy)
+    read = [0]
+
+    def Progress(rows):
+        with WorkerReading.get_lock():
+            WorkerReading.value += rows - read[0]
+        read[0] = rows
+
+    try:
+        frec = session.get(File, fileid)
+        counts = ImportFile(session, file, WorkerRecTypes, stats=stats, frec=frec,
+                            progress=Progress, touched=touched, classes=WorkerClasses,
+                            **options)
+        t = time.perf_counter()
+        session.commit()
+        stats['commit'] = time.perf_counter() - t
+        frec.Update(counts, session)
+    finally:
+        session.close()
+        Progress(0) # The parent counts the file's rows once it's done
+    return file, counts, stats, touched
+
+
+def EngineURL(engine):
+    """
+    Returns the engine's URL as a string including the password (which 
+    str() on newer versions of SQLAlchemy masks) for use by the workers.
+    """
+    url = engine.url
+    if hasattr(url, 'render_as_string'):
+        return url.render_as_string(hide_password=False)
+    return str(url)
+
+
+def DropIndexes(RecTypes):
+    """
+    Drops all the secondary indexes declared on the record types' tables
+    (i.e. the index=True columns in AddressBase.py) which exist in the 
+    database, so that a full load doesn't have to maintain them row by row.
+    """
+    start = time.time()
+    for rt in RecTypes.values():
+        table = rt.mapping.__table__
+        existing = {i['name'] for i in inspect(engine).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                logger.debug("Dropping index {}".format(index.name))
+                index.drop(bind=engine)
+    logger.info("Dropped indexes in {:.1f}s".format(time.time() - start))
+
+
+def CreateIndexes(RecTypes):
+    """
+    Builds any of the secondary indexes declared on the record types' tables
+    which don't exist in the database. Apart from on SQLite, which only
+    allows one writer at a time, they're built IndexThreads at a time, each
+    on its own connection.
+    """
+    start = time.time()
+    indexes = []
+    for rt in RecTypes.values():
+        table = rt.mapping.__table__
+        existing = {i['name'] for i in inspect(engine).get_indexes(table.name)}
+        indexes += [i for i in table.indexes if i.name not in existing]
+
+    def Build(index):
+        t = time.time()
+        index.create(bind=engine)
+        logger.debug("Built index {} in {:.1f}s".format(index.name, time.time() - t))
+
+    threads = 1 if engine.dialect.name == 'sqlite' else IndexThreads
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        for f in [pool.submit(Build, i) for i in indexes]:
+            f.result()
+    logger.info("Built {} indexes in {:.1f}s".format(len(indexes), time.time() - start))
+
+
+def ImportFiles(files, RecTypes, workers, options, metrics=None, addresses=False,
+                hierarchy=False):
+    """
+    Imports each of the files which hasn't already been imported, either
+    one after the other or with a pool of workers (see CreateAddressBaseTables),
+    reporting each to metrics (see IngestMetrics). If addresses is set, the
+    addresses of the UPRNs each file touched are refreshed once it's loaded,
+    and likewise the hierarchy if hierarchy is set.
+    """
+    metrics = metrics or Metrics()
+    classes = Classifications.ClassificationCache()
+    records = 0
+    Session = sessionmaker(bind=engine)
+    session = Session()    
+    try:
+        current = session.query(File).filter(File.SupersededBy == None).all()
+        byname = {f.FileName: f for f in current}
+        byprint = {(f.CRC32, f.Size): f for f in current if f.CRC32}
+        checkpoint = options.get('checkpoint')
+        start = time.time()
+        prints = Fingerprints(files)
+        logger.info("Fingerprinted {} files in {:.1f}s".format(len(files), time.time() - start))
+        todo = []
+        seen = set()
+        changed = []
+        for file in files:
+            fname = SourceName(file)
+            # Check if the contents are already in our list of imports, or 
+            # failing that (for files imported before we kept fingerprints)
+            # the name. A file whose load never finished is loaded again, or
+            # when checkpointing picked up where it left off.
+            frec = byprint.get(prints[file])
+            if frec is None and fname in byname:
+                if byname[fname].CRC32 is None:
+                    frec = byname[fname]
+                elif options.get('changeonly'):
+                    logger.warning('File {} has changed since it was applied. Applying it again.'.format(fname))
+                else:
+                    changed.append(fname)
+            if prints[file] in seen:
+                logger.info('File {} is a duplicate. Skipping.'.format(fname))
+                continue
+            if frec and frec.CreateEnd is not None:
+                logger.info('File {} already imported{}. Skipping.'.format(fname, 
+                    ' as ' + frec.FileName if frec.FileName != fname else ''))
+                continue
+            seen.add(prints[file])
+            todo.append((file, frec))
+        # A full supply file loaded again would go on top of the rows it
+        # loaded last time, so it's up to the user to start again
+        if changed:
+            for fname in changed:
+                logger.error('File {} has changed since it was imported.'.format(fname))
+            logger.error('Reload everything with --overwrite (or apply Change-Only Updates with --cou). Aborting.')
+            sys.exit()
+        metrics.Plan(len(todo), sum(prints[f][1] for f, frec in todo))
+        jobs = []
+        # Iterate through the list of files...
+        for i, (file, frec) in enumerate(todo):
+            fname = SourceName(file)
+            if workers > 1:
+                # Claim the file here rather than in the worker so that two
+                # workers can never both decide to import the same file.
+                frec=frec or File(fname, session, prints[file])
+                session.commit()
+                jobs.append((file, frec.id, options, addresses, hierarchy))
+                continue
+            logger.info("Processing {} ({}/{})".format(fname, i+1, len(todo)))
+            frec=frec or File(fname, session, prints[file])
+            stats = {}
+            touched = Touching(addresses, hierarchy)
+            counts = ImportFile(session, file, RecTypes, stats=stats, frec=frec,
+                                progress=metrics.Progress, touched=touched, classes=classes,
+                                **options)
+            records += sum(counts[t] for t in RecTypes)
+            t = time.perf_counter()
+            session.commit()
+            stats['commit'] = time.perf_counter() - t
+            frec.Update(counts, session)
+            stats['bytes'] = prints[file][1] # Uncompressed, as in the Plan
+            metrics.FileDone(stats)
+            if addresses:
+                RefreshAddresses(session, touched)
+            if hierarchy:
+                RefreshHierarchy(session, touched)
+        if jobs:
+            logger.info("Processing {} files with {} workers".format(len(jobs), workers))
+            engine.dispose() # Don't let the workers inherit our connections
+            reading = multiprocessing.Value('q', 0)
+            try:
+                with multiprocessing.Pool(workers, InitWorker, (EngineURL(engine), reading)) as pool:
+                    results = pool.imap_unordered(ImportWorker, jobs)
+                    for j in range(len(jobs)):
+                        # Report progress every so often while waiting for
+                        # the next file to finish
+                        while True:
+                            try:
+                                file, counts, stats, touched = results.next(ProgressPoll)
+                                break
+                            except multiprocessing.TimeoutError:
+                                metrics.Progress(reading.value)
+                        logger.info("Processed {} ({}/{})".format(SourceName(file), j+1, len(jobs)))
+                        records += sum(counts[t] for t in RecTypes)
+                        stats['bytes'] = prints[file][1]
+                        metrics.FileDone(stats)
+                        if addresses:
+                            RefreshAddresses(session, touched)
+                        if hierarchy:
+                            RefreshHierarchy(session, touched)
+            except:
+                # Forget about any files which didn't finish so they'll be
+                # picked up again next time round. (Unless checkpointing, in 
+                # which case they'll be resumed, as will those an earlier
+                # checkpointed load got part way through.)
+                session.rollback()
+                if checkpoint:
+                    raise
+                session.query(File).filter(File.id.in_([j[1] for j in jobs]), File.CreateEnd == None,
+                                           File.LinesDone == None).delete(synchronize_session=False)
+                session.commit()
+                raise
+        logger.info("Read {} files {:,} records".format(len(todo), records))
+    finally:
+        session.close()
+
+
+def RefreshAddresses(session, touched):
+    """
+    Refreshes the addresses of the UPRNs touched by a file (see ImportFile)
+    once it's been committed. With workers, this is done by the parent as
+    each file finishes so that the refreshes happen one at a time, each 
+    after the data it reads has been committed.
+    """
+    Addresses.RefreshAddresses(session.connection(), 
+                               Addresses.TouchedUPRNs(session.connection(), touched))
+    session.commit()
+
+
+def RefreshHierarchy(session, touched):
+    """
+    Refreshes the hierarchy (see Hierarchies.py) of the UPRNs whose BLPUs
+    a file touched once it's been committed, in the same way as 
+    RefreshAddresses.
+    """
+    Hierarchies.RefreshHierarchy(session.connection(), 
+                                 {int(u) for u in touched.get('21', ()) if u.isdigit()})
+    session.commit()
+
+
+def CreateAddressBaseTables(patterns, rebuild = False, bulk = False, workers = 1,
+                            batchsize = None, changeonly = False, 
+                            deferindexes = False, pipeline = 0,
+                            metricsfile = None, metricsport = None,
+                            checkpoint = False, addresses = None, hierarchy = None,
+                            recordtypes = None, dropcolumns = None, countries = None,
+                            custodians = None, postcodeareas = None, partition = None):    
     """
     Creates the various tables to hold the AddressBase Premium data which are
     read in from a series of CSV files, specified in 'patterns'
     
     patterns is a list of file names e.g. foo.csv or patterns e.g. *.csv.
+    The files may also be gzipped (foo.csv.gz) or zip files of CSVs, which
+    are read without being extracted (see ExpandArchives).
     
     The Linux/Unix shell will automatically glob these from the command
     line, but Windows doesn't so we must manually glob the list...
     
     The rebuild flag causes all the tables to be rebuilt from sratch
+
+    The bulk flag loads the rows with Core executemany (or COPY on 
+    PostgreSQL) rather than creating an ORM object for every row.
+
+    If workers is more than one the files are handed to a pool of that many
+    processes, each of which has its own database connection.
+
+    batchsize streams each file through the session in chunks of that many
+    rows (see ImportFile) to keep memory use flat.
+
+    changeonly applies the files as Change-Only Updates, inserting, updating
+    and deleting records according to their CHANGE_TYPE rather than simply
+    appending them. The files have to be applied in order, so this is always
+    done with a single worker.
+
+    deferindexes drops the secondary indexes before loading and builds them
+    all again afterwards, which is much quicker than maintaining them as
+    each row goes in. It's ignored for Change-Only Updates, which need the
+    indexes to find the records they change.
+
+    pipeline overlaps reading each file with writing it, using that many
+    writer threads on their own connections (see Pipeline). Implies bulk.
+
+    The metrics of the load (see IngestMetrics) are appended as JSON lines
+    to metricsfile and/or served in Prometheus format on metricsport.
+
+    checkpoint commits each file every batchsize rows, recording how far it
+    has got, so that if the load dies it resumes from the last checkpoint
+    the next time it's run rather than starting the file again. It can't be
+    combined with pipeline.
+
+    addresses builds the denormalised addresses table (see Addresses.py):
+    'file' refreshes the addresses of the UPRNs touched by each file as it's
+    loaded, which keeps the table up to date through Change-Only Updates,
+    while 'end' rebuilds the whole table in one pass after the load.
+
+    hierarchy likewise builds the hierarchy table of the BLPUs' PARENT_UPRNs
+    (see Hierarchies.py), file by file or at the end.
+
+    recordtypes (codes or names), dropcolumns, countries (COUNTRY codes),
+    custodians (LOCAL_CUSTODIAN_CODEs) and postcodeareas restrict what's 
+    imported (see RecordFilter). With more than one worker each has its 
+    own idea of which UPRNs have passed, so a property's records should all
+    be in the same file, as they are in OS's geographic (tiled) supplies.
+
+    The CLASS_TYPE and ABC of the Classifications are filled in as they're
+    loaded (see Classifications.py).
+
+    partition ('custodian' or 'area') creates the blpus, lpis, dpaddresses
+    and classifications tables partitioned by LOCAL_CUSTODIAN_CODE or by 
+    postcode area (PostgreSQL only, see Partitions.py). The rows of tables
+    which are already partitioned are always routed to their partitions, 
+    which implies bulk and is done with a single worker.
     """
 
     RecTypes = CreateRecordTypes()
 
+    if partition and engine.dialect.name != 'postgresql':
+        logger.warning("Only PostgreSQL can partition tables. Ignoring --partition")
+        partition = None
+
     # If applicable, drop the tables safely.
     try:
         if rebuild:
             for r in RecTypes:
                 logger.info("Dropping {} table".format(RecTypes[r].name))
                 RecTypes[r].mapping.__table__.drop(bind=engine, checkfirst=True)
+            logger.info("Dropping Address table")
+            Address.__table__.drop(bind=engine, checkfirst=True)
+            logger.info("Dropping Hierarchy table")
+            Hierarchy.__table__.drop(bind=engine, checkfirst=True)
+            logger.info("Dropping classification lookup tables")
+            ClassScheme.__table__.drop(bind=engine, checkfirst=True)
+            ClassificationCode.__table__.drop(bind=engine, checkfirst=True)
             logger.info("Dropping File table")
             File.__table__.drop(bind=engine, checkfirst=True)
     
+        if partition:
+            Partitions.CreatePartitionedTables(engine, partition)
         Base.metadata.create_all(engine)
+        method = Partitions.Method(engine)
         
     except: # As we don't know what connector is being used, we don't know what error will be generated
         logger.error("Can't connect to database with {}".format(engine))
         sys.exit()
+
+    if partition and method != partition:
+        logger.error("The tables aren't partitioned by {}. Rebuild them with --overwrite.".format(partition))
+        sys.exit()
         
     # Now glob the filenames from the list of patterns (principally for Windows installations)
     files = []
     for p in patterns:
         files += glob.glob(p)
+    files = ExpandArchives(files)
         
+    if changeonly and workers > 1:
+        logger.warning("Change-Only Updates must be applied in order. Ignoring --workers")
+        workers = 1
+    if changeonly and deferindexes:
+        logger.warning("Change-Only Updates need the indexes. Ignoring --defer-indexes")
+        deferindexes = False
+    if checkpoint and pipeline:
+        logger.warning("Can't checkpoint a pipelined load. Ignoring --pipeline")
+        pipeline = 0
+    if addresses == 'file' and deferindexes:
+        logger.warning("Refreshing addresses file by file needs the indexes. Building them at the end instead")
+        addresses = 'end'
+    if method and workers > 1:
+        logger.warning("Partitions must be created one at a time. Ignoring --workers")
+        workers = 1
+    if hierarchy == 'file' and deferindexes:
+        logger.warning("Refreshing the hierarchy file by file needs the indexes. Building it at the end instead")
+        hierarchy = 'end'
+    options = {'bulk': bulk, 'batchsize': batchsize, 'changeonly': changeonly,
+               'pipeline': pipeline, 'checkpoint': checkpoint}
+    if recordtypes or dropcolumns or countries or custodians or postcodeareas:
+        try:
+            options['recordfilter'] = RecordFilter(RecTypes, recordtypes, dropcolumns,
+                                                   countries, custodians, postcodeareas)
+        except ValueError as e:
+            logger.error("{}. Aborting.".format(e))
+            sys.exit()
+    if method:
+        options['partitions'] = Partitioner(method)
+
     if len(files):
-        records = 0
-        Session = sessionmaker(bind=engine)
-        session = Session()    
-        imported =[z[0] for z in session.query(File.FileName).filter(File.SupersededBy == None).all()]
-        # Iterate through the list of files...
-        for i, file in enumerate(files):
-            fname = os.path.split(file)[1]
-            # Check if the name is already in our list of imports
-            if fname in imported:
-                logger.info('File {} already imported. Skipping.'.format(fname))
-                continue
-            counts = {t:0 for t in RecTypes} # Keep track of the numbers of each record
-            counts['Error'] = 0
-            logger.info("Processing {} ({}/{})".format(fname, i+1, len(files)))
-            frec=File(fname, session)
-            # Note that at the time of writing the CSVs were encoded in latin-1, rather than utf-8
-            with open(file, encoding='latin-1') as f:
-                for j, row in enumerate(csv.reader(f)):
-                    rt = RecTypes[row[0]]
-                    if len(row) != len(rt.fields) + 1:
-                        logger.warning("Got {} fields for {} record at line {} of {}: {}".\
-                               format(len(row)-1, rt.name, j+1, fname, "|".join(row[1:])))
-                    counts[rt.code] += 1
-                    o = CreateObject(rt, row[1:])
-                    if o:
-                        session.add(o)
-            records += j+1
-            session.commit()
-            frec.Update(counts, session)
-        logger.info("Read {} files {:,} records".format(i+1, records))
-        session.close()
+        if deferindexes:
+            DropIndexes(RecTypes)
+        start = time.time()
+        metrics = Metrics(metricsfile, metricsport)
+        try:
+            ImportFiles(files, RecTypes, workers, options, metrics, addresses == 'file',
+                        hierarchy == 'file')
+        finally:
+            metrics.Close()
+            logger.info("Loaded in {:.1f}s".format(time.time() - start))
+            if deferindexes:
+                CreateIndexes(RecTypes)
+        if addresses == 'end':
+            Addresses.BuildAddresses(engine)
+        if hierarchy == 'end':
+            Hierarchies.BuildHierarchy(engine)
     else:
         logger.warning('Cant find any files')
 
 
+def ReloadPartition(patterns, key, changeonly = False, batchsize = None):
+    """
+    Drops one partition (e.g. a single custodian's) of each of the 
+    partitioned tables (see Partitions.py) and loads it again from the
+    files in patterns, without touching the rest of the tables. Only the 
+    records in that partition are loaded, and the files aren't recorded in
+    the files table. For a database kept up to date with Change-Only 
+    Updates the files are the full supply and then the COUs, in order, 
+    with changeonly set.
+
+    It's all done in one transaction, so if it fails the partition is left
+    as it was, but the tables are locked until it's finished. The addresses
+    and hierarchy tables aren't refreshed. 
+    """
+    method = Partitions.Method(engine)
+    if not method:
+        logger.error("The tables aren't partitioned. Aborting.")
+        sys.exit()
+    key = Partitions.Key(key)
+    RecTypes = CreateRecordTypes()
+    codes = [code for code, rt in RecTypes.items() if rt.mapping in Partitions.Tables]
+    known = [key] if key != Partitions.Unknown else None
+    recordfilter = RecordFilter(RecTypes, codes, custodians=known if method == 'custodian' else None,
+                                areas=known if method == 'area' else None)
+    files = []
+    for p in patterns:
+        files += glob.glob(p)
+    files = ExpandArchives(files)
+    start = time.time()
+    partitions = Partitioner(method, only=key)
+    classes = Classifications.ClassificationCache()
+    session = sessionmaker(bind=engine)()
+    try:
+        Partitions.DropPartition(session.connection(), key)
+        for i, file in enumerate(files):
+            logger.info("Reloading partition {} from {} ({}/{})".format(key, SourceName(file), 
+                                                                       i+1, len(files)))
+            ImportFile(session, file, RecTypes, bulk=True, batchsize=batchsize, 
+                       changeonly=changeonly, recordfilter=recordfilter, classes=classes,
+                       partitions=partitions)
+        session.commit()
+    finally:
+        session.close()
+    logger.info("Reloaded partition {} in {:.1f}s".format(key, time.time() - start))
+
+
 if __name__ == '__main__':
 
     # Parse the command line arguments
     parser = argparse.ArgumentParser('Ingest ABP files')
-    parser.add_argument("files",        help='CSV files to read', nargs = '+')
+    parser.add_argument("files",        help='CSV files to read (may be .zip or .gz)', nargs = '+')
     parser.add_argument('--host',       help='Database hostname or IP address')
     parser.add_argument('--password',   help='Database password')
     parser.add_argument('--username',     help='User name',
@@ -165,6 +1410,42 @@ if __name__ == '__main__':
                         default = 'mysql+mysqlconnector')
     parser.add_argument('--overwrite',  help='Overwrite existing database', 
                         action = "store_true",)
+    parser.add_argument('--workers',    help='Number of files to import in parallel',
+                        type=int, default=1)
+    parser.add_argument('--batch-size', help='Flush to the database every so many rows',
+                        type=int, dest='batchsize')
+    parser.add_argument('--cou',        help='Apply files as Change-Only Updates',
+                        action = "store_true", dest='changeonly')
+    parser.add_argument('--defer-indexes', help='Drop indexes before loading and rebuild them afterwards',
+                        action = "store_true", dest='deferindexes')
+    parser.add_argument('--pipeline',   help='Write while reading, with this many writer threads',
+                        type=int, default=0)
+    parser.add_argument('--metrics-file', help='Append metrics to this JSON-lines file',
+                        dest='metricsfile')
+    parser.add_argument('--metrics-port', help='Serve Prometheus metrics on this port',
+                        type=int, dest='metricsport')
+    parser.add_argument('--checkpoint', help='Commit every batch so that a failed load can resume',
+                        action = "store_true")
+    parser.add_argument('--addresses',  help='Build the addresses table file by file or at the end',
+                        choices=['file', 'end'])
+    parser.add_argument('--hierarchy',  help='Build the PARENT_UPRN hierarchy file by file or at the end',
+                        choices=['file', 'end'])
+    parser.add_argument('--record-types', help='Only import these record types (codes or names)',
+                        nargs='+', dest='recordtypes')
+    parser.add_argument('--drop-columns', help='Don\'t load these columns (leave them null)',
+                        nargs='+', dest='dropcolumns')
+    parser.add_argument('--country',    help='Only import properties with these COUNTRY codes',
+                        nargs='+')
+    parser.add_argument('--custodian',  help='Only import properties with these LOCAL_CUSTODIAN_CODEs',
+                        nargs='+')
+    parser.add_argument('--postcode-area', help='Only import properties in these postcode areas',
+                        nargs='+', dest='postcodearea')
+    parser.add_argument('--partition',  help='Partition the biggest tables by custodian or postcode area (PostgreSQL)',
+                        choices=Partitions.Methods)
+    parser.add_argument('--reload-partition', help='Drop and reload just this custodian\'s (or area\'s) partition',
+                        dest='reloadpartition', metavar='KEY')
+    parser.add_argument('--bulk',       help='Bulk load rows without ORM objects (COPY on PostgreSQL)',
+                        action = "store_true",)
     args = parser.parse_args()
 
     # If we haven't got any credentials then abort
@@ -182,5 +1463,25 @@ if __name__ == '__main__':
     engine = create_engine(connectionstring)
     Session = sessionmaker(bind=engine)
     
+    if args.reloadpartition:
+        ReloadPartition(args.files, args.reloadpartition, changeonly=args.changeonly,
+                        batchsize=args.batchsize)
+        sys.exit()
+
     # Create the tables
-    CreateAddressBaseTables(args.files, rebuild=args.overwrite)
+    CreateAddressBaseTables(args.files, rebuild=args.overwrite, bulk=args.bulk,
+                            workers=args.workers, batchsize=args.batchsize,
+                            changeonly=args.changeonly,
+                            deferindexes=args.deferindexes,
+                            pipeline=args.pipeline,
+                            metricsfile=args.metricsfile,
+                            metricsport=args.metricsport,
+                            checkpoint=args.checkpoint,
+                            addresses=args.addresses,
+                            hierarchy=args.hierarchy,
+                            recordtypes=args.recordtypes,
+                            dropcolumns=args.dropcolumns,
+                            countries=args.country,
+                            custodians=args.custodian,
+                            postcodeareas=args.postcodearea,
+                            partition=args.partition)
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+An index of where each record is in the raw AddressBase Premium CSVs, so
+that a handful of records can be read straight from a supply without
+loading it into a database.
+
+The index maps each (record type, UPRN) - or USRN for streets and their
+descriptors - to the file and byte offset of every record with that key.
+It's built by a single pass over each file, memory-mapped and scanned with
+NumPy a chunk at a time: the newlines give the start of every record, the
+commas the position of its key. The keys are held sorted, as in the other
+indexes, so looking one up is a binary search and reading each record a
+single seek. The records are parsed into dictionaries of their fields
+(see RecordType.fields), converted to their column types.
+
+Only plain CSVs can be indexed, as a gzipped file or zip member has to be
+decompressed from the start to get to an offset. Each record must be on a
+line of its own (as they are in OS supplies). e.g.
+
+    index = CSVIndex.FromFiles(['/data/abp/*.csv'])
+    index.Save('abp.npz')
+    ...
+    index = CSVIndex.Load('abp.npz')
+    index.Records('21', 10000001)     # -> [{'UPRN': 10000001, ...}]
+    set(index.Keys('28')) - set(other.Keys('28'))
+"""
+
+import os
+import csv
+import sys
+import json
+import mmap
+import glob
+import logging
+import argparse
+
+from AddressBase import logger
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    logging.error('Can\'t import NumPy. Aborting.')
+    sys.exit()
+
+from BuildAddressBaseTables import CreateRecordTypes
+
+ScanChunk = 2**26     # Bytes of a file scanned at a time
+KeyStride = 10**13    # Sort key = record type * KeyStride + UPRN (or USRN)
+MaxDigits = 12        # In a UPRN
+
+
+def KeyColumns(RecTypes):
+    """
+    Returns a dictionary of the column of the UPRN (or, for record types
+    without one, the USRN) in the CSV of each record type which has one.
+    """
+    columns = {}
+    for code, rt in RecTypes.items():
+        for key in ('UPRN', 'USRN'):
+            if key in rt.fields:
+                columns[int(code)] = rt.fields.index(key) + 1
+                break
+    return columns
+
+
+def Numbers(buf, starts, ends):
+    """
+    Returns the numbers in buf[starts[i]:ends[i]], or -1 where there isn't
+    one.
+    """
+    lengths = ends - starts
+    values = np.zeros(len(starts), dtype=np.int64)
+    valid = (lengths > 0) & (lengths <= MaxDigits)
+    for j in range(int(lengths[valid].max()) if valid.any() else 0):
+        at = np.flatnonzero(valid & (lengths > j))
+        digits = buf[starts[at] + j].astype(np.int64) - ord('0')
+        valid[at] &= (digits >= 0) & (digits <= 9)
+        values[at] = values[at] * 10 + digits
+    values[~valid] = -1
+    return values
+
+
+def Scan(path, columns):
+    """
+    Returns arrays of the sort key and offset of each record in the CSV
+    file path which has a key.
+    """
+    keys, offsets = [], []
+    size = os.path.getsize(path)
+    if not size:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        data = np.frombuffer(m, dtype=np.uint8)
+        start = 0
+        while start < size:
+            # Up to the last newline in the chunk, so every line is whole,
+            # taking in more of the file if a line's longer than the chunk
+            end = min(start + ScanChunk, size)
+            while end < size:
+                newlines = np.flatnonzero(data[start:end] == ord('\n'))
+                if len(newlines):
+                    end = start + int(newlines[-1]) + 1
+                    break
+                end = min(end + ScanChunk, size)
+            buf = data[start:end]
+            newlines = np.flatnonzero(buf == ord('\n'))
+            lines = np.concatenate([[0], newlines + 1])
+            lines = lines[lines < len(buf) - 2]
+            lineends = np.append(newlines, len(buf))[:len(lines)]
+            commas = np.flatnonzero(buf == ord(','))
+            code = Numbers(buf, lines, lines + 2)
+            first = np.searchsorted(commas, lines) # Each line's first comma
+            for c, column in columns.items():
+                at = np.flatnonzero(code == c)
+                at = at[first[at] + column < len(commas)]
+                fieldstart = commas[first[at] + column - 1] + 1
+                fieldend = commas[first[at] + column]
+                ok = fieldend < lineends[at]
+                key = Numbers(buf, fieldstart[ok], fieldend[ok])
+                found = key >= 0
+                keys.append(c * KeyStride + key[found])
+                offsets.append(start + lines[at[ok][found]])
+            start = end
+        del data, buf # Let go of the map
+    if not keys:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(keys), np.concatenate(offsets).astype(np.int64)
+
+
+class CSVIndex:
+    """
+    Index of the records in a set of CSV files by record type and UPRN (or
+    USRN). Build it with FromFiles, or Load one which was Saved.
+    """
+    def __init__(self, files, keys, fileids, offsets):
+        self.files    = files    # List of (path, size, mtime)
+        self.keys     = keys     # Sorted record type * KeyStride + UPRN/USRN
+        self.fileids  = fileids  # The file of each
+        self.offsets  = offsets  # and where in it the record starts
+        self.RecTypes = CreateRecordTypes()
+        self.handles  = {}
+
+    @classmethod
+    def FromFiles(cls, patterns):
+        """
+        Builds the index of the CSV files matching patterns. Compressed
+        files are skipped.
+        """
+        columns = KeyColumns(CreateRecordTypes())
+        files, keys, fileids, offsets = [], [], [], []
+        for pattern in patterns:
+            for path in sorted(glob.glob(pattern)):
+                if path.lower().endswith(('.zip', '.gz')):
+                    logger.warning("Can't index compressed file {}. Extract it first.".format(path))
+                    continue
+                path = os.path.abspath(path)
+                k, o = Scan(path, columns)
+                logger.info("Indexed {:,} records of {}".format(len(k), path))
+                fileids.append(np.full(len(k), len(files), dtype=np.int32))
+                files.append((path, os.path.getsize(path), os.path.getmtime(path)))
+                keys.append(k)
+                offsets.append(o)
+        if not files:
+            return cls([], np.array([], dtype=np.int64), np.array([], dtype=np.int32),
+                       np.array([], dtype=np.int64))
+        keys, fileids, offsets = np.concatenate(keys), np.concatenate(fileids), np.concatenate(offsets)
+        order = np.lexsort((offsets, fileids, keys))
+        return cls(files, keys[order], fileids[order], offsets[order])
+
+    def Save(self, path):
+        """
+        Saves the index to a single (.npz) file.
+        """
+        np.savez(path, files=json.dumps(self.files), keys=self.keys, fileids=self.fileids,
+                 offsets=self.offsets)
+
+    @classmethod
+    def Load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            return cls([tuple(x) for x in json.loads(str(f['files']))], f['keys'],
+                       f['fileids'], f['offsets'])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def Open(self, fileid):
+        """
+        Returns the memory map of a file, checking that it hasn't changed
+        since it was indexed.
+        """
+        if fileid not in self.handles:
+            path, size, mtime = self.files[fileid]
+            if os.path.getsize(path) != size or os.path.getmtime(path) != mtime:
+                raise ValueError("{} has changed since it was indexed".format(path))
+            with open(path, 'rb') as f:
+                self.handles[fileid] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.handles[fileid]
+
+    def Close(self):
+        for m in self.handles.values():
+            m.close()
+        self.handles = {}
+
+    def Range(self, code, key):
+        """
+        Returns the (first, last + 1) positions in the index of the records
+        of the given type and UPRN (or USRN).
+        """
+        target = int(code) * KeyStride + int(key)
+        return np.searchsorted(self.keys, target, 'left'), np.searchsorted(self.keys, target, 'right')
+
+    def Locate(self, code, key):
+        """
+        Returns a list of the (file, offset) of each record of the given
+        type (e.g. '21') and UPRN (or USRN).
+        """
+        first, last = self.Range(code, key)
+        return [(self.files[f][0], int(o)) for f, o in
+                zip(self.fileids[first:last], self.offsets[first:last])]
+
+    def Read(self, fileid, offset):
+        """
+        Returns the raw fields of the record at offset in a file.
+        """
+        m = self.Open(fileid)
+        end = m.find(b'\n', offset)
+        line = m[offset:end if end >= 0 else len(m)].decode('latin-1') # As OpenSource
+        return next(csv.reader([line]))
+
+    def Records(self, code, key):
+        """
+        Returns a list of the records of the given type (e.g. '21') and
+        UPRN (or USRN), in the order they are in the files, each a
+        dictionary of its fields converted to their column types.
+        """
+        first, last = self.Range(code, key)
+        rt = self.RecTypes[str(code)]
+        return [dict(zip(rt.fields, rt.Convert(self.Read(int(f), int(o))[1:])))
+                for f, o in zip(self.fileids[first:last], self.offsets[first:last])]
+
+    def Keys(self, code):
+        """
+        Returns the sorted array of the distinct UPRNs (or USRNs) of the
+        records of a type, e.g. to compare two supplies.
+        """
+        code = int(code)
+        first = np.searchsorted(self.keys, code * KeyStride, 'left')
+        last = np.searchsorted(self.keys, (code + 1) * KeyStride, 'left')
+        return np.unique(self.keys[first:last] - code * KeyStride)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Index or read records of raw ABP CSV files')
+    parser.add_argument('index', help='Index file (.npz) to write or read')
+    parser.add_argument('--csv', help='CSV files to index', nargs='+')
+    parser.add_argument('--get', help='Record type and UPRN (or USRN) to read', nargs=2,
+                        metavar=('TYPE', 'KEY'))
+    args = parser.parse_args()
+
+    if args.csv:
+        CSVIndex.FromFiles(args.csv).Save(args.index)
+    elif args.get:
+        for record in CSVIndex.Load(args.index).Records(*args.get):
+            print(record)
+    else:
+        logger.error('Requires --csv or --get. See --help option for details.')
+        sys.exit()
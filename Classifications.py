@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Fills in Classification.CLASS_TYPE and Classification.ABC: integer keys of
+the record's classification scheme (in the classschemes table) and, for the
+AddressBase classification scheme, its classification code (in the
+classificationcodes table). So filtering on class is an indexed integer
+comparison rather than string comparisons on CLASS_SCHEME and
+CLASSIFICATION_CODE.
+
+The loader fills them in as the rows are written (see ImportFile), looking
+the keys up in a ClassificationCache, which holds both lookup tables in
+dictionaries and adds any scheme or code it hasn't seen before.
+BackfillClassifications fills them in for everything already loaded, e.g.
+
+    python Classifications.py --url postgresql://...
+
+    abc = session.query(ClassificationCode.id).filter(ClassificationCode.CODE == 'RD04').scalar()
+    session.query(Classification).filter(Classification.ABC == abc)
+"""
+
+import sys
+import argparse
+import threading
+
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.exc import IntegrityError
+
+from AddressBase import logger, Classification, ClassScheme, ClassificationCode
+from Addresses import Scheme
+
+Columns = ('CLASS_TYPE', 'ABC') # Appended to each Classification row by Classify
+
+
+class ClassificationCache:
+    """
+    The classschemes and classificationcodes tables in memory. They're read
+    the first time they're needed, on whichever connection is writing the
+    rows. Anything new is added on a connection of its own and committed
+    straight away, so that other workers adding the same thing don't have
+    to wait for (or deadlock with) the transaction loading the file. If
+    another process has just added it we simply read it back.
+    """
+    def __init__(self):
+        self.schemes = None # CLASS_SCHEME -> ClassScheme.id
+        self.codes   = None # CODE -> ClassificationCode.id
+        self.lock    = threading.Lock() # Pipeline writers share the cache
+
+    def Load(self, connection):
+        self.schemes = dict(connection.execute(select(ClassScheme.CLASS_SCHEME, ClassScheme.id)).all())
+        self.codes = dict(connection.execute(select(ClassificationCode.CODE, ClassificationCode.id)).all())
+
+    def Add(self, connection, column, value):
+        """
+        Adds a scheme or code to its table and returns its id. SQLite only
+        allows one writer, so there it's added in a savepoint of the
+        connection's own transaction instead.
+        """
+        if connection.dialect.name == 'sqlite':
+            return self.Insert(connection, connection.begin_nested, column, value)
+        with connection.engine.connect() as own:
+            return self.Insert(own, own.begin, column, value)
+
+    def Insert(self, connection, begin, column, value):
+        """
+        Inserts a scheme or code in a transaction (or savepoint) started by
+        begin, unless it's already there, and returns its id.
+        """
+        try:
+            with begin():
+                connection.execute(column.table.insert().values({column.name: value}))
+        except IntegrityError: # Someone else got there first
+            pass
+        key = connection.execute(select(column.table.c.id).where(column == value)).scalar()
+        logger.debug("Added {} {} as {}".format(column.name, value, key))
+        return key
+
+    def Keys(self, connection, scheme, code):
+        """
+        Returns the (CLASS_TYPE, ABC) of a Classification with the given
+        CLASS_SCHEME and CLASSIFICATION_CODE. ABC is None if it's not in the
+        AddressBase classification scheme.
+        """
+        with self.lock:
+            if self.schemes is None:
+                self.Load(connection)
+            classtype = abc = None
+            if scheme:
+                classtype = self.schemes.get(scheme)
+                if classtype is None:
+                    classtype = self.schemes[scheme] = self.Add(connection, ClassScheme.CLASS_SCHEME, scheme)
+            if code and (scheme or '').startswith(Scheme):
+                abc = self.codes.get(code)
+                if abc is None:
+                    abc = self.codes[code] = self.Add(connection, ClassificationCode.CODE, code)
+            return classtype, abc
+
+    def Classify(self, connection, fields, rows):
+        """
+        Returns the Classification rows (tuples in the order of fields, as
+        returned by CreateRow) with their CLASS_TYPE and ABC appended.
+        """
+        scheme = fields.index('CLASS_SCHEME')
+        code = fields.index('CLASSIFICATION_CODE')
+        return [r + self.Keys(connection, r[scheme], r[code]) for r in rows]
+
+    def ClassifyObject(self, connection, o):
+        """
+        Fills in the CLASS_TYPE and ABC of a Classification object.
+        """
+        o.CLASS_TYPE, o.ABC = self.Keys(connection, o.CLASS_SCHEME, o.CLASSIFICATION_CODE)
+
+
+def BackfillClassifications(engine):
+    """
+    Fills in CLASS_TYPE and ABC for all the rows of the classifications
+    table: adds any new schemes and codes to the lookup tables and then
+    sets each column with a single UPDATE.
+    """
+    ClassScheme.__table__.create(bind=engine, checkfirst=True)
+    ClassificationCode.__table__.create(bind=engine, checkfirst=True)
+    table = Classification.__table__
+    cache = ClassificationCache()
+    with engine.begin() as connection:
+        pairs = connection.execute(select(table.c.CLASS_SCHEME, table.c.CLASSIFICATION_CODE).distinct()).all()
+        for scheme, code in pairs:
+            cache.Keys(connection, scheme, code)
+        rows = connection.execute(update(table).values(CLASS_TYPE=select(ClassScheme.id).where(
+            ClassScheme.CLASS_SCHEME == table.c.CLASS_SCHEME).scalar_subquery())).rowcount
+        abc = select(ClassificationCode.id).where(
+            ClassificationCode.CODE == table.c.CLASSIFICATION_CODE).scalar_subquery()
+        connection.execute(update(table).values(ABC=abc).where(table.c.CLASS_SCHEME.startswith(Scheme)))
+        connection.execute(update(table).values(ABC=None).where(
+            ~table.c.CLASS_SCHEME.startswith(Scheme) | (table.c.CLASS_SCHEME == None)))
+    logger.info("Classified {:,} rows: {} schemes, {} codes".format(
+        rows, len(cache.schemes), len(cache.codes)))
+    return rows
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Fill in CLASS_TYPE and ABC of the classifications table')
+    parser.add_argument('--url', help='SQLAlchemy URL of the database')
+    args = parser.parse_args()
+
+    if not args.url:
+        logger.error('Requires --url. See --help option for details.')
+        sys.exit()
+    BackfillClassifications(create_engine(args.url))
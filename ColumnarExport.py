@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Exports the tables of AddressBase.py to a columnar format on disk which can
+be memory-mapped, so that analytics can scan whole columns of millions of
+rows as NumPy arrays without going anywhere near the database (or the ORM).
+
+An export is a directory with a manifest.json and a subdirectory per table
+holding a file or two per column:
+
+    <column>.npy        the values, for numbers, dates, times and flags
+                        (see Types), with nulls as 0 (or NaN for floats)
+    <column>.valid.npy  whether each value is not null
+    <column>.offsets.npy and <column>.bytes
+                        for strings: the UTF-8 bytes of all the values one
+                        after the other, and the offset at which each starts
+                        (plus the end), so that value i is
+                        bytes[offsets[i]:offsets[i + 1]]
+
+The reader, ColumnStore, maps the files rather than reading them, so
+opening a column costs nothing and the OS pages it in as it's scanned. e.g.
+
+    ExportTables(engine, 'abp')
+    ...
+    store = ColumnStore('abp')
+    x = store.Column('blpus', 'X_COORDINATE')     # numpy.memmap of float64
+    towns = store.Column('dpaddresses', 'POST_TOWN')  # Strings
+    (towns.Equals('LEEDS') & store.Valid('dpaddresses', 'UPRN')).sum()
+"""
+
+import os
+import sys
+import json
+import logging
+import argparse
+
+from AddressBase import logger, Base, Snapshot
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    logging.error('Can\'t import NumPy. Aborting.')
+    sys.exit()
+
+from sqlalchemy import create_engine, select, func, inspect
+from sqlalchemy import Boolean, BigInteger, Integer, Numeric, Float, Date, DateTime, Time
+
+ExportChunk = 100000  # Rows fetched from the database at a time
+
+# NumPy type of each SQLAlchemy type (the first which matches), and how to
+# turn a value into it. Anything else is a string.
+Types = [(Boolean,    'bool',           bool),
+         (BigInteger, 'int64',          int),
+         (Integer,    'int32',          int),
+         (Float,      'float64',        float),
+         (Numeric,    'float64',        float),
+         (DateTime,   'datetime64[s]',  np.datetime64),
+         (Date,       'datetime64[D]',  np.datetime64),
+         (Time,       'timedelta64[s]', lambda t: np.timedelta64(t.hour * 3600 + t.minute * 60 + t.second, 's'))]
+
+
+def ColumnType(column):
+    """
+    Returns the (NumPy type, converter) of a column, or (None, None) for a
+    string.
+    """
+    for sqltype, dtype, convert in Types:
+        if isinstance(column.type, sqltype):
+            return dtype, convert
+    return None, None
+
+
+def ExportTable(connection, table, path):
+    """
+    Exports a table to the directory path, returning its entry in the
+    manifest.
+    """
+    os.makedirs(path, exist_ok=True)
+    rows = connection.execute(select(func.count()).select_from(table)).scalar()
+    columns = {}
+    outputs = []
+    for column in table.columns:
+        dtype, convert = ColumnType(column)
+        name = os.path.join(path, column.name)
+        valid = np.lib.format.open_memmap(name + '.valid.npy', 'w+', bool, (rows,))
+        if dtype:
+            values = np.lib.format.open_memmap(name + '.npy', 'w+', dtype, (rows,))
+            outputs.append((dtype, convert, values, valid))
+        else:
+            offsets = np.lib.format.open_memmap(name + '.offsets.npy', 'w+', 'int64', (rows + 1,))
+            offsets[0] = 0
+            outputs.append((None, open(name + '.bytes', 'wb'), offsets, valid))
+        columns[column.name] = dtype or 'string'
+    done = 0
+    result = connection.execution_options(yield_per=ExportChunk).execute(
+        select(table).order_by(table.primary_key.columns.values()[0]))
+    for chunk in result.partitions():
+        chunk = chunk[:rows - done] # In case rows have been added since we counted
+        n = len(chunk)
+        for i, (dtype, convert, values, valid) in enumerate(outputs):
+            column = [r[i] for r in chunk]
+            valid[done:done + n] = [v is not None for v in column]
+            if dtype:
+                empty = np.nan if dtype == 'float64' else 0
+                values[done:done + n] = np.array([convert(v) if v is not None else empty for v in column],
+                                                 dtype=dtype)
+            else:
+                encoded = [(v if isinstance(v, str) else str(v)).encode() if v is not None else b''
+                           for v in column]
+                convert.write(b''.join(encoded))
+                values[done + 1:done + n + 1] = values[done] + np.cumsum([len(e) for e in encoded])
+        done += n
+        if done == rows:
+            break
+    for dtype, convert, values, valid in outputs:
+        if not dtype:
+            convert.close()
+            values[done + 1:] = values[done] # In case rows were deleted since we counted
+        values.flush()
+        valid.flush()
+    logger.info("Exported {:,} rows of {}".format(done, table.name))
+    return {'rows': done, 'columns': columns}
+
+
+def ExportTables(engine, path, tables=None):
+    """
+    Exports the named tables (all the tables of AddressBase.py if None) to
+    the directory path, all read from one snapshot of the database (see
+    Snapshot) so they're consistent.
+    """
+    tables = tables or [t.name for t in Base.metadata.sorted_tables]
+    manifest = {'tables': {}}
+    existing = set(inspect(engine).get_table_names())
+    with Snapshot(engine) as connection:
+        for name in tables:
+            if name not in existing:
+                logger.warning("No {} table. Skipping.".format(name))
+                continue
+            manifest['tables'][name] = ExportTable(connection, Base.metadata.tables[name],
+                                                   os.path.join(path, name))
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class Strings:
+    """
+    A column of strings: the UTF-8 bytes of the values and their offsets,
+    both memory-mapped.
+    """
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data    = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode()
+
+    def Lengths(self):
+        """
+        Returns the length in bytes of each value.
+        """
+        return np.diff(self.offsets)
+
+    def Equals(self, value):
+        """
+        Returns a boolean array of which values equal value, comparing bytes
+        only where the lengths match.
+        """
+        value = np.frombuffer(value.encode(), dtype=np.uint8)
+        match = self.Lengths() == len(value)
+        for i, byte in enumerate(value):
+            at = np.flatnonzero(match)
+            match[at] = self.data[self.offsets[at] + i] == byte
+        return match
+
+
+class ColumnStore:
+    """
+    Reads an export written by ExportTables, mapping the columns into memory
+    as they're asked for.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+
+    def Tables(self):
+        return list(self.manifest['tables'])
+
+    def Fields(self, table):
+        return list(self.manifest['tables'][table]['columns'])
+
+    def Rows(self, table):
+        return self.manifest['tables'][table]['rows']
+
+    def Column(self, table, field):
+        """
+        Returns the values of a column: a read-only numpy.memmap, or for
+        strings a Strings.
+        """
+        name = os.path.join(self.path, table, field)
+        rows = self.Rows(table) # The files may be longer if rows went during the export
+        if self.manifest['tables'][table]['columns'][field] != 'string':
+            return np.load(name + '.npy', mmap_mode='r')[:rows]
+        offsets = np.load(name + '.offsets.npy', mmap_mode='r')[:rows + 1]
+        if offsets[-1]:
+            data = np.memmap(name + '.bytes', dtype=np.uint8, mode='r')
+        else: # Can't map an empty file
+            data = np.zeros(0, dtype=np.uint8)
+        return Strings(offsets, data)
+
+    def Valid(self, table, field):
+        """
+        Returns a read-only boolean array of which values of a column aren't
+        null.
+        """
+        return np.load(os.path.join(self.path, table, field + '.valid.npy'), mmap_mode='r')[:self.Rows(table)]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Export ABP tables to columnar files')
+    parser.add_argument('path',     help='Directory to export to')
+    parser.add_argument('--url',    help='SQLAlchemy URL of the database')
+    parser.add_argument('--tables', help='Tables to export (default all)', nargs='+')
+    args = parser.parse_args()
+
+    if not args.url:
+        logger.error('Requires --url. See --help option for details.')
+        sys.exit()
+    ExportTables(create_engine(args.url), args.path, args.tables)
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Generates synthetic OS AddressBase Premium CSV files, for testing and
+benchmarking the ingest without a licensed OS data set.
+
+Every record type in CreateRecordTypes() can be generated, each with the
+right number of fields (taken from RecordType.fields) and values of the
+right type and size for its column. The records hang together in the way
+the real ones do: LPIs, DPAs, Classifications etc. refer to UPRNs of BLPUs
+in the same file, LPIs refer to USRNs of its Streets, some BLPUs have
+parents, and so on. Each file starts with a Header and MetaData record and
+ends with a Trailer whose RECORD_COUNT is correct.
+"""
+
+import csv
+import random
+import datetime
+import argparse
+import sys
+
+from sqlalchemy import Integer, Numeric, Date, Time, DateTime
+
+from BuildAddressBaseTables import CreateRecordTypes
+from AddressBase import logger
+
+# Rough proportions of each record type in a full supply, relative to BLPUs
+DefaultMix = {'11': 0.05, '15': 0.06, '21': 1.0, '23': 1.6, '24': 1.2,
+              '28': 0.8,  '30': 0.02, '31': 0.03, '32': 1.1}
+
+Classes   = ['RD02', 'RD03', 'RD04', 'RD06', 'RH01', 'CR08', 'CO01', 'CE03',
+             'PP', 'LP02', 'ZW99CH', 'RD01', 'RB', 'CH01']
+Towns     = ['LONDON', 'BRISTOL', 'LEEDS', 'CARDIFF', 'YORK', 'BATH', 'EXETER',
+             'NORWICH', 'DERBY', 'SWANSEA', 'READING', 'OXFORD', 'LINCOLN']
+Streets   = ['HIGH', 'CHURCH', 'STATION', 'MILL', 'PARK', 'VICTORIA', 'GREEN',
+             'MANOR', 'KINGS', 'QUEENS', 'NEW', 'SCHOOL', 'NORTH', 'SOUTH']
+Suffixes  = ['STREET', 'ROAD', 'LANE', 'AVENUE', 'CLOSE', 'DRIVE', 'WAY', 'GARDENS']
+Buildings = ['ROSE COTTAGE', 'THE OLD RECTORY', 'MILL HOUSE', 'HOLLY LODGE',
+             'THE BARN', 'CROWN HOUSE', 'ORCHARD VIEW', 'COURT HOUSE']
+Areas     = ['AB', 'B', 'BS', 'CF', 'E', 'EX', 'LS', 'M', 'NR', 'OX', 'SW', 'YO']
+
+# Fixed values of the single-character code fields (and a few others)
+Codes = {'CHANGE_TYPE': 'I', 'LOGICAL_STATUS': '1', 'BLPU_STATE': '2',
+         'RPC': '1', 'COUNTRY': 'E', 'ADDRESSBASE_POSTAL': 'D', 'STATE': '2',
+         'LANGUAGE': 'ENG', 'POSTCODE_TYPE': 'S', 'OFFICIAL_FLAG': 'Y',
+         'USRN_MATCH_INDICATOR': '1', 'STREET_SURFACE': '1', 'RECORD_TYPE': '1',
+         'FILE_TYPE': 'F', 'STREET_CLASSIFICATION': '8', 'NGAZ_FREQ': 'D',
+         'CLASS_SCHEME': 'AddressBase Premium Classification Scheme',
+         'SCHEME_VERSION': '1.0', 'SOURCE': '7666VN',
+         'CO_ORD_SYSTEM': 'British National Grid', 'CO_ORD_UNIT': 'Metres',
+         'CHARACTER_SET': 'ISO 8859-1', 'GAZ_OWNER': 'Ordnance Survey',
+         'CUSTODIAN_NAME': 'ORDNANCE SURVEY', 'LOCAL_CUSTODIAN_CODE': '7655'}
+
+
+class Generator:
+    """
+    Generates the values for the records of a single synthetic file. The
+    keys of the records generated so far (UPRNs, USRNs, postcodes) are
+    remembered so that later records can refer to them.
+    """
+    def __init__(self, seed=0, firstuprn=10000000, firstusrn=20000000):
+        self.random   = random.Random(seed)
+        self.RecTypes = CreateRecordTypes()
+        self.uprns    = []   # UPRNs of the BLPUs so far
+        self.usrns    = []   # USRNs of the Streets so far
+        self.postcode = {}   # UPRN -> postcode
+        self.nextuprn = firstuprn
+        self.nextusrn = firstusrn
+        self.order    = 0    # PRO_ORDER
+        self.keys     = 0    # Sequence for the various 14 character keys
+
+    def Postcode(self):
+        r = self.random
+        return '{}{} {}{}{}'.format(r.choice(Areas), r.randint(1, 29), r.randint(0, 9),
+                                    r.choice('ABDEFGHJLNPQRSTUWXYZ'), r.choice('ABDEFGHJLNPQRSTUWXYZ'))
+
+    def Date(self):
+        return (datetime.date(1990, 1, 1) +
+                datetime.timedelta(days=self.random.randint(0, 10000))).isoformat()
+
+    def Key(self, code):
+        self.keys += 1
+        return '{}{}{:08d}'.format(Codes['LOCAL_CUSTODIAN_CODE'], code, self.keys)[:14]
+
+    def UPRN(self):
+        return self.random.choice(self.uprns) if self.uprns else self.nextuprn
+
+    def Value(self, rt, field):
+        """
+        Returns a value for the field of the given record type as a string,
+        from its name where that means anything or else from its column type.
+        """
+        r = self.random
+        column = rt.mapping.__table__.columns[field]
+        if field == 'PRO_ORDER':
+            self.order += 1
+            return str(self.order)
+        if field in ('UPRN', 'CUSTODIAN_UPRN'):
+            return str(self.UPRN())
+        if field == 'USRN':
+            return str(r.choice(self.usrns) if self.usrns else self.nextusrn)
+        if field in ('PARENT_UPRN', 'SUCCESSOR'):
+            return str(self.UPRN()) if self.uprns and r.random() < 0.2 else ''
+        if field.endswith('_KEY'):
+            return self.Key(rt.code)
+        if field in ('POSTCODE', 'POSTCODE_LOCATOR'):
+            return self.Postcode()
+        if field == 'CLASSIFICATION_CODE':
+            return r.choice(Classes)
+        if field in ('POST_TOWN', 'TOWN_NAME', 'ADMINISTRATIVE_AREA'):
+            return r.choice(Towns)
+        if field in ('THOROUGHFARE', 'STREET_DESCRIPTION'):
+            return '{} {}'.format(r.choice(Streets), r.choice(Suffixes))
+        if field in ('BUILDING_NAME', 'PAO_TEXT'):
+            return r.choice(Buildings) if r.random() < 0.3 else ''
+        if field in ('BUILDING_NUMBER', 'PAO_START_NUMBER'):
+            return str(r.randint(1, 250))
+        if field in ('X_COORDINATE', 'STREET_START_X', 'STREET_END_X'):
+            return '{:.2f}'.format(r.uniform(100000, 650000))
+        if field in ('Y_COORDINATE', 'STREET_START_Y', 'STREET_END_Y'):
+            return '{:.2f}'.format(r.uniform(10000, 1200000))
+        if field in ('LATITUDE', 'STREET_START_LAT', 'STREET_END_LAT'):
+            return '{:.7f}'.format(r.uniform(50.0, 58.5))
+        if field in ('LONGITUDE', 'STREET_START_LONG', 'STREET_END_LONG'):
+            return '{:.7f}'.format(r.uniform(-5.5, 1.7))
+        if field in Codes:
+            return Codes[field]
+        if field == 'VERSION': # An integer, except in the Header
+            return '2.0' if rt.code == '10' else '1'
+        if field in ('END_DATE', 'STREET_END_DATE'):
+            return '' # Current records don't have an end date
+        if isinstance(column.type, DateTime):
+            return datetime.datetime(2017, 1, 1, 12).isoformat()
+        if isinstance(column.type, Date):
+            return self.Date()
+        if isinstance(column.type, Time):
+            return '{:02d}:{:02d}:{:02d}'.format(r.randint(0, 23), r.randint(0, 59), r.randint(0, 59))
+        if isinstance(column.type, Integer):
+            return str(r.randint(0, 9))
+        if isinstance(column.type, Numeric):
+            return '0'
+        # Any other string: a few random letters, most of them left empty
+        if r.random() < 0.7:
+            return ''
+        length = min(column.type.length or 10, 20)
+        return ''.join(r.choice('ABCDEFGHIJKLMNOPRSTUVWY ') for i in range(length)).strip()
+
+    def Record(self, code):
+        """
+        Returns a complete record (list of strings including the record
+        identifier) of the given type.
+        """
+        rt = self.RecTypes[code]
+        row = [code] + [self.Value(rt, f) for f in rt.fields]
+        if code == '21': # New BLPU, so a new UPRN which others may refer to
+            uprn = self.nextuprn
+            self.nextuprn += 1
+            row[rt.fields.index('UPRN') + 1] = str(uprn)
+            self.uprns.append(uprn)
+            self.postcode[uprn] = row[rt.fields.index('POSTCODE_LOCATOR') + 1]
+        elif code == '11': # New street
+            usrn = self.nextusrn
+            self.nextusrn += 1
+            row[rt.fields.index('USRN') + 1] = str(usrn)
+            self.usrns.append(usrn)
+        elif code == '28': # DPAs share their BLPU's postcode
+            uprn = int(row[rt.fields.index('UPRN') + 1])
+            if uprn in self.postcode:
+                row[rt.fields.index('POSTCODE') + 1] = self.postcode[uprn]
+        elif code == '30' and not row[rt.fields.index('SUCCESSOR') + 1]:
+            row[rt.fields.index('SUCCESSOR') + 1] = str(self.UPRN())
+        return row
+
+
+def Counts(rows, mix=None):
+    """
+    Splits the total number of rows between the record types in proportion
+    to the mix (a dictionary of record type code to weight). Every type in
+    the mix gets at least one row, and Streets and BLPUs come first so that
+    there's something for the others to refer to.
+    """
+    mix = mix or DefaultMix
+    total = sum(mix.values())
+    order = sorted(mix, key=lambda c: (c not in ('11', '21'), c))
+    return [(c, max(1, int(round(rows * mix[c] / total)))) for c in order if mix[c] > 0]
+
+
+def GenerateFile(path, rows, mix=None, seed=0, firstuprn=10000000):
+    """
+    Writes a synthetic ABP CSV file of (about) the given number of data rows
+    with the record types in the proportions of mix. Returns a dictionary of
+    the number of records of each type written (including Header, MetaData
+    and Trailer).
+    """
+    generator = Generator(seed, firstuprn=firstuprn, firstusrn=firstuprn * 2)
+    written = {'10': 1, '29': 1}
+    with open(path, 'w', encoding='latin-1', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(generator.Record('10'))
+        writer.writerow(generator.Record('29'))
+        for code, n in Counts(rows, mix):
+            if code in ('10', '29', '99'):
+                continue
+            for i in range(n):
+                writer.writerow(generator.Record(code))
+            written[code] = n
+        trailer = generator.Record('99')
+        trailer[generator.RecTypes['99'].fields.index('RECORD_COUNT') + 1] = str(sum(written.values()) + 1)
+        writer.writerow(trailer)
+        written['99'] = 1
+    logger.info("Wrote {:,} records to {}".format(sum(written.values()), path))
+    return written
+
+
+def ParseMix(text):
+    """
+    Parses a mix given on the command line as e.g. '21=1,24=1.2,28=0.8'
+    """
+    mix = {}
+    for item in text.split(','):
+        code, weight = item.split('=')
+        mix[code.strip()] = float(weight)
+    return mix
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Generate synthetic ABP files')
+    parser.add_argument('files',   help='CSV files to write', nargs='+')
+    parser.add_argument('--rows',  help='Number of data rows per file',
+                        type=int, default=100000)
+    parser.add_argument('--mix',   help='Record type weights e.g. 21=1,24=1.2,28=0.8')
+    parser.add_argument('--seed',  help='Random seed', type=int, default=0)
+    args = parser.parse_args()
+
+    mix = ParseMix(args.mix) if args.mix else None
+    unknown = set(mix or {}) - set(CreateRecordTypes())
+    if unknown:
+        logger.error('Unknown record types {}'.format(', '.join(sorted(unknown))))
+        sys.exit()
+    for i, file in enumerate(args.files):
+        # Give each file its own range of UPRNs so that they don't collide
+        GenerateFile(file, args.rows, mix, seed=args.seed + i,
+                     firstuprn=10000000 * (i + 1))
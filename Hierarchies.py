@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+The hierarchy of the BLPUs' PARENT_UPRNs (e.g. the flats in a block), for
+finding all the units under a building, the building a unit is in, or the
+other units in it without recursive queries (which MySQL does badly).
+
+It's worked out once into the hierarchy table (see AddressBase.Hierarchy),
+a closure table with a row for every ancestor of every UPRN with a parent,
+so that Descendants, Ancestors, Root and Siblings are each a single indexed
+query. The table can be rebuilt after a load (BuildHierarchy) or kept up to
+date file by file, redoing just the UPRNs whose BLPUs each file touched and
+everything under them (RefreshHierarchy). See the --hierarchy option of
+BuildAddressBaseTables.
+
+HierarchyIndex does the same in memory with NumPy arrays: the UPRNs are
+numbered in depth-first order, so everything under a UPRN is a contiguous
+slice (its nested interval). e.g.
+
+    BuildHierarchy(engine)
+    Descendants(connection, 10000001)
+
+    index = HierarchyIndex.FromDatabase(engine)
+    index.Descendants(10000001), index.Root(10000002), index.Siblings(10000002)
+"""
+
+import sys
+import logging
+import argparse
+
+from AddressBase import logger, BLPU, Hierarchy
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    logging.error('Can\'t import NumPy. Aborting.')
+    sys.exit()
+
+from sqlalchemy import create_engine, select
+
+from Addresses import Current
+from Successors import Pick
+
+MaxDepth = 32          # Levels above which a chain of parents must be a cycle
+HierarchyChunk = 10000 # Rows inserted, or UPRNs refreshed, at a time
+
+
+class HierarchyIndex:
+    """
+    The PARENT_UPRN hierarchy in memory. Build it with FromDatabase or
+    FromPairs, or Load one which was Saved.
+    """
+    def __init__(self, nodes, parents, depths, preorder, left, sizes):
+        self.nodes    = nodes    # Sorted UPRNs in the hierarchy
+        self.parents  = parents  # Index of each one's parent (-1 if none)
+        self.depths   = depths   # Levels below its root
+        self.preorder = preorder # Indexes in depth-first order
+        self.left     = left     # Position of each in preorder
+        self.sizes    = sizes    # Number of UPRNs under each
+
+    @classmethod
+    def FromPairs(cls, uprns, parents, current=None, order=None):
+        """
+        Builds the index from arrays of UPRNs and their PARENT_UPRNs (-1 for
+        none), and optionally whether each is current and its PRO_ORDER to
+        choose between the versions of a BLPU.
+        """
+        uprns = np.asarray(uprns, dtype=np.int64)
+        parents = np.asarray(parents, dtype=np.int64)
+        current = np.ones(len(uprns), dtype=bool) if current is None else np.asarray(current)
+        order = np.zeros(len(uprns), dtype=np.int64) if order is None else np.asarray(order)
+        uprns, parents = Pick(uprns, parents, current, order)
+        keep = (parents >= 0) & (parents != uprns)
+        uprns, parents = uprns[keep], parents[keep]
+        nodes = np.union1d(uprns, parents)
+        up = np.full(len(nodes), -1, dtype=np.int64)
+        up[np.searchsorted(nodes, uprns)] = np.searchsorted(nodes, parents)
+        # Ancestors at each level up, cutting any cycles and trying again
+        while True:
+            levels = [np.arange(len(nodes))]
+            while len(levels) <= MaxDepth and (levels[-1] >= 0).any():
+                levels.append(np.where(levels[-1] >= 0, up[levels[-1]], -1))
+            if not (levels[-1] >= 0).any():
+                break
+            cycles = (np.array(levels[1:]) == levels[0]).any(axis=0)
+            if not cycles.any(): # Just very deep, so cut it at MaxDepth
+                cycles[levels[-2][levels[-1] >= 0]] = True
+            logger.warning("Cutting {:,} UPRNs whose parents go round in circles".format(int(cycles.sum())))
+            up[cycles] = -1
+        ancestors = np.array(levels) # Level 0 is each UPRN itself
+        depths = (ancestors[1:] >= 0).sum(axis=0)
+        # Sorting on the path down from the root puts each UPRN's descendants
+        # straight after it
+        path = np.full(ancestors.shape, -1, dtype=np.int64)
+        for j in range(len(ancestors)):
+            at = np.flatnonzero(depths >= j)
+            path[j, at] = ancestors[depths[at] - j, at]
+        preorder = np.lexsort(path[::-1])
+        left = np.empty(len(nodes), dtype=np.int64)
+        left[preorder] = np.arange(len(nodes))
+        above = ancestors[1:][ancestors[1:] >= 0]
+        sizes = np.bincount(above, minlength=len(nodes))
+        logger.info("{:,} UPRNs in {:,} hierarchies up to {} deep".format(
+            len(nodes), int((up < 0).sum()), int(depths.max()) if len(nodes) else 0))
+        return cls(nodes, up, depths, preorder, left, sizes)
+
+    @classmethod
+    def FromDatabase(cls, engine):
+        """
+        Builds the index from the blpus table.
+        """
+        with engine.connect() as connection:
+            rows = connection.execute(select(BLPU.UPRN, BLPU.PARENT_UPRN, BLPU.END_DATE,
+                                             BLPU.PRO_ORDER).where(BLPU.UPRN != None)).all()
+        return cls.FromPairs([r.UPRN for r in rows], [r.PARENT_UPRN or -1 for r in rows],
+                             [r.END_DATE is None for r in rows], [r.PRO_ORDER or 0 for r in rows])
+
+    def Save(self, path):
+        """
+        Saves the index to a single (.npz) file.
+        """
+        np.savez(path, nodes=self.nodes, parents=self.parents, depths=self.depths,
+                 preorder=self.preorder, left=self.left, sizes=self.sizes)
+
+    @classmethod
+    def Load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            return cls(f['nodes'], f['parents'], f['depths'], f['preorder'], f['left'], f['sizes'])
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def Closure(self):
+        """
+        Yields the (ancestor, descendant, depth) of every UPRN with a parent,
+        i.e. the rows of the hierarchy table.
+        """
+        level, depth = np.arange(len(self.nodes)), 0
+        while True:
+            level, depth = np.where(level >= 0, self.parents[level], -1), depth + 1
+            at = np.flatnonzero(level >= 0)
+            if not len(at):
+                return
+            for a, d in zip(self.nodes[level[at]].tolist(), self.nodes[at].tolist()):
+                yield a, d, depth
+
+    def Index(self, uprn):
+        """
+        Returns the index of a UPRN, or None if it's not in a hierarchy.
+        """
+        i = int(np.searchsorted(self.nodes, uprn))
+        return i if i < len(self.nodes) and self.nodes[i] == uprn else None
+
+    def Descendants(self, uprn):
+        """
+        Returns the array of UPRNs under uprn (at any depth), depth first.
+        """
+        i = self.Index(uprn)
+        if i is None:
+            return np.array([], dtype=np.int64)
+        return self.nodes[self.preorder[self.left[i] + 1:self.left[i] + 1 + self.sizes[i]]]
+
+    def Children(self, uprn):
+        """
+        Returns the array of UPRNs whose parent is uprn.
+        """
+        i = self.Index(uprn)
+        if i is None:
+            return np.array([], dtype=np.int64)
+        under = self.preorder[self.left[i] + 1:self.left[i] + 1 + self.sizes[i]]
+        return self.nodes[under[self.depths[under] == self.depths[i] + 1]]
+
+    def Ancestors(self, uprn):
+        """
+        Returns the list of UPRNs above uprn, its parent first.
+        """
+        i, ancestors = self.Index(uprn), []
+        while i is not None and self.parents[i] >= 0:
+            i = int(self.parents[i])
+            ancestors.append(int(self.nodes[i]))
+        return ancestors
+
+    def Root(self, uprn):
+        """
+        Returns the UPRN at the top of uprn's hierarchy (itself if it has no
+        parent).
+        """
+        ancestors = self.Ancestors(uprn)
+        return ancestors[-1] if ancestors else uprn
+
+    def Siblings(self, uprn):
+        """
+        Returns the array of the other UPRNs with the same parent as uprn.
+        """
+        i = self.Index(uprn)
+        if i is None or self.parents[i] < 0:
+            return np.array([], dtype=np.int64)
+        children = self.Children(int(self.nodes[self.parents[i]]))
+        return children[children != uprn]
+
+
+def BuildHierarchy(engine):
+    """
+    Rebuilds the whole hierarchy table from the blpus table.
+    """
+    table = Hierarchy.__table__
+    table.create(bind=engine, checkfirst=True)
+    index = HierarchyIndex.FromDatabase(engine)
+    built = 0
+    with engine.begin() as connection:
+        connection.execute(table.delete())
+        rows = []
+        for ancestor, descendant, depth in index.Closure():
+            rows.append({'ANCESTOR': ancestor, 'DESCENDANT': descendant, 'DEPTH': depth})
+            if len(rows) >= HierarchyChunk:
+                connection.execute(table.insert(), rows)
+                built += len(rows)
+                rows = []
+        if rows:
+            connection.execute(table.insert(), rows)
+            built += len(rows)
+    logger.info("Built {:,} rows of the hierarchy".format(built))
+    return built
+
+
+def Parents(connection, uprns):
+    """
+    Returns a dictionary of the current PARENT_UPRN (or None) of each of
+    uprns which has a BLPU.
+    """
+    versions = {}
+    uprns = sorted(uprns)
+    for i in range(0, len(uprns), HierarchyChunk):
+        for row in connection.execute(select(BLPU.UPRN, BLPU.PARENT_UPRN, BLPU.END_DATE, BLPU.PRO_ORDER)
+                                      .where(BLPU.UPRN.in_(uprns[i:i + HierarchyChunk]))).mappings():
+            versions.setdefault(row['UPRN'], []).append(row)
+    return {u: Current(rows)['PARENT_UPRN'] for u, rows in versions.items()}
+
+
+def RefreshHierarchy(connection, uprns):
+    """
+    Redoes the hierarchy of the given UPRNs (e.g. those whose BLPUs a file
+    touched) and everything under them, in the connection's transaction.
+    """
+    table = Hierarchy.__table__
+    affected = set(uprns)
+    uprns = sorted(affected)
+    for i in range(0, len(uprns), HierarchyChunk):
+        affected.update(connection.execute(select(table.c.DESCENDANT).where(
+            table.c.ANCESTOR.in_(uprns[i:i + HierarchyChunk]))).scalars())
+    affected = sorted(affected)
+    for i in range(0, len(affected), HierarchyChunk):
+        connection.execute(table.delete().where(table.c.DESCENDANT.in_(affected[i:i + HierarchyChunk])))
+    # Climb from each of them a level at a time, keeping the chain of
+    # ancestors so far. The UPRNs on a cycle have no parent, as in
+    # HierarchyIndex.FromPairs, so a chain which comes back on itself stops
+    # where it joined the cycle (or is empty if it started on it).
+    parents = {}
+    chains = {u: [] for u in affected}
+    pending = affected
+    cycles = 0
+    while pending:
+        tops = {u: chains[u][-1] if chains[u] else u for u in pending}
+        parents.update(Parents(connection, set(tops.values()) - set(parents)))
+        climbing = []
+        for u in pending:
+            parent = parents.get(tops[u])
+            if parent is None or parent == tops[u]:
+                continue
+            chain = chains[u]
+            if parent == u or parent in chain:
+                chains[u] = chain[:chain.index(parent) + 1] if parent != u else []
+                cycles += 1
+            elif len(chain) >= MaxDepth:
+                logger.warning("The parents of {} go more than {} deep".format(u, MaxDepth))
+            else:
+                chain.append(parent)
+                climbing.append(u)
+        pending = climbing
+    if cycles:
+        logger.warning("The parents of {:,} UPRNs go round in circles".format(cycles))
+    rows = [{'ANCESTOR': a, 'DESCENDANT': u, 'DEPTH': depth}
+            for u, chain in chains.items() for depth, a in enumerate(chain, 1)]
+    for i in range(0, len(rows), HierarchyChunk):
+        connection.execute(table.insert(), rows[i:i + HierarchyChunk])
+    logger.info("Refreshed the hierarchy of {:,} UPRNs".format(len(affected)))
+
+
+def Descendants(connection, uprn):
+    """
+    Returns the list of UPRNs under uprn, at any depth.
+    """
+    table = Hierarchy.__table__
+    return connection.execute(select(table.c.DESCENDANT).where(table.c.ANCESTOR == uprn)
+                              .order_by(table.c.DEPTH, table.c.DESCENDANT)).scalars().all()
+
+
+def Ancestors(connection, uprn):
+    """
+    Returns the list of UPRNs above uprn, its parent first.
+    """
+    table = Hierarchy.__table__
+    return connection.execute(select(table.c.ANCESTOR).where(table.c.DESCENDANT == uprn)
+                              .order_by(table.c.DEPTH)).scalars().all()
+
+
+def Root(connection, uprn):
+    """
+    Returns the UPRN at the top of uprn's hierarchy (itself if it has no
+    parent).
+    """
+    ancestors = Ancestors(connection, uprn)
+    return ancestors[-1] if ancestors else uprn
+
+
+def Siblings(connection, uprn):
+    """
+    Returns the list of the other UPRNs with the same parent as uprn.
+    """
+    table = Hierarchy.__table__
+    parent = table.alias('parent')
+    return connection.execute(select(table.c.DESCENDANT).join(
+        parent, parent.c.ANCESTOR == table.c.ANCESTOR).where(
+        parent.c.DESCENDANT == uprn, parent.c.DEPTH == 1, table.c.DEPTH == 1,
+        table.c.DESCENDANT != uprn).order_by(table.c.DESCENDANT)).scalars().all()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Build the PARENT_UPRN hierarchy')
+    parser.add_argument('--url',   help='SQLAlchemy URL of the database')
+    parser.add_argument('--index', help='Build an in-memory index and save it to this file (.npz) instead')
+    args = parser.parse_args()
+
+    if not args.url:
+        logger.error('Requires --url. See --help option for details.')
+        sys.exit()
+    if args.index:
+        HierarchyIndex.FromDatabase(create_engine(args.url)).Save(args.index)
+    else:
+        BuildHierarchy(create_engine(args.url))
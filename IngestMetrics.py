@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Collects metrics of the ingest: rows and rows/sec per record type, how the
+time splits between parsing, building rows/objects, flushing them to the
+database and committing, rows with the wrong number of fields and so on.
+
+Each file's figures are logged, and can also be appended to a JSON-lines
+file and/or served as Prometheus-style text from a local HTTP endpoint.
+Progress, with an estimate of when the load will finish, is logged
+periodically.
+"""
+
+import json
+import time
+import threading
+import http.server
+
+from AddressBase import logger
+
+ProgressInterval = 60  # Seconds between progress reports
+Phases = ('parse', 'build', 'flush', 'commit')
+
+
+class Metrics:
+    """
+    Metrics of an ingest run. The ingest calls Plan once it knows how much
+    there is to load, Progress every so often while it's reading a file and
+    FileDone (with the stats filled in by ImportFile) after each file.
+    """
+    def __init__(self, path=None, port=None, interval=ProgressInterval):
+        self.lock       = threading.Lock()
+        self.interval   = interval
+        self.start      = time.time()
+        self.lastreport = self.start
+        self.files      = 0
+        self.totalfiles = None
+        self.rows       = {}   # Record type name -> rows
+        self.seconds    = {p: 0.0 for p in Phases}
+        self.mismatched = 0
+        self.errors     = 0
+        self.totalbytes = 0
+        self.donebytes  = 0
+        self.donerows   = 0
+        self.out        = open(path, 'a') if path else None
+        self.server     = None
+        if port:
+            self.Serve(port)
+
+    def Plan(self, files, totalbytes):
+        """
+        Records how many files (and bytes) there are to load, for the ETA.
+        """
+        self.totalfiles = files
+        self.totalbytes = totalbytes
+        self.Write({'event': 'start', 'files': files, 'bytes': totalbytes})
+
+    def ETA(self, donebytes):
+        """
+        Returns the estimated number of seconds until the load finishes, or
+        None if we can't tell yet.
+        """
+        elapsed = time.time() - self.start
+        if not donebytes or not self.totalbytes or not elapsed:
+            return None
+        return max(0, (self.totalbytes - donebytes) * elapsed / donebytes)
+
+    def Progress(self, rows):
+        """
+        Called while a file is being read with the number of rows read from it
+        so far. Logs progress if it's been long enough since the last report.
+        """
+        now = time.time()
+        if now - self.lastreport < self.interval:
+            return
+        self.lastreport = now
+        # Guess how far through the current file we are from the size of the
+        # rows of the files done so far
+        donebytes = self.donebytes
+        if self.donerows:
+            donebytes += rows * self.donebytes / self.donerows
+        self.Report(self.donerows + rows, self.ETA(donebytes))
+
+    def Report(self, rows, eta):
+        elapsed = time.time() - self.start
+        logger.info("Progress: {}/{} files {:,} rows in {:.0f}s ({:,.0f} rows/sec) ETA {}".format(
+            self.files, self.totalfiles or '?', rows, elapsed,
+            rows / elapsed if elapsed else 0,
+            '{:.0f}s'.format(eta) if eta is not None else 'unknown'))
+        self.Write({'event': 'progress', 'files': self.files, 'rows': rows,
+                    'elapsed': elapsed, 'eta': eta})
+
+    def FileDone(self, stats):
+        """
+        Adds the stats of a file (see ImportFile) to the totals, writes them
+        out and logs a summary.
+        """
+        with self.lock:
+            self.files += 1
+            for name, n in stats['rows'].items():
+                self.rows[name] = self.rows.get(name, 0) + n
+            for p in Phases:
+                self.seconds[p] += stats.get(p, 0)
+            self.mismatched += stats['mismatched']
+            self.errors     += stats['errors']
+            self.donebytes  += stats['bytes']
+            self.donerows   += sum(stats['rows'].values())
+        seconds = stats['seconds'] + stats.get('commit', 0)
+        stats = dict(stats, event='file',
+                     rates={k: v / seconds if seconds else 0 for k, v in stats['rows'].items()})
+        self.Write(stats)
+        logger.info("{}: {:,} rows in {:.1f}s ({}) {} mismatched, {} errors, peak memory {}".format(
+            stats['file'], sum(stats['rows'].values()), seconds,
+            ', '.join('{} {:.1f}s'.format(p, stats.get(p, 0)) for p in Phases),
+            stats['mismatched'], stats['errors'],
+            '{:,.1f} MB'.format(stats['peak'] / 2**20) if stats.get('peak') else 'unknown'))
+        self.lastreport = time.time()
+        self.Report(self.donerows, self.ETA(self.donebytes))
+
+    def Write(self, record):
+        if self.out:
+            with self.lock:
+                self.out.write(json.dumps(dict(record, time=time.time()), default=str) + '\n')
+                self.out.flush()
+
+    def Prometheus(self):
+        """
+        Returns the totals in the Prometheus text exposition format.
+        """
+        with self.lock:
+            lines = ['# TYPE abp_files_total counter',
+                     'abp_files_total {}'.format(self.files),
+                     '# TYPE abp_rows_total counter']
+            lines += ['abp_rows_total{{record_type="{}"}} {}'.format(k, v)
+                      for k, v in sorted(self.rows.items())]
+            lines += ['# TYPE abp_phase_seconds_total counter']
+            lines += ['abp_phase_seconds_total{{phase="{}"}} {:.3f}'.format(p, self.seconds[p])
+                      for p in Phases]
+            lines += ['# TYPE abp_rows_mismatched_total counter',
+                      'abp_rows_mismatched_total {}'.format(self.mismatched),
+                      '# TYPE abp_rows_errors_total counter',
+                      'abp_rows_errors_total {}'.format(self.errors),
+                      '# TYPE abp_bytes_done gauge',
+                      'abp_bytes_done {}'.format(self.donebytes),
+                      '# TYPE abp_bytes_total gauge',
+                      'abp_bytes_total {}'.format(self.totalbytes)]
+        return '\n'.join(lines) + '\n'
+
+    def Serve(self, port):
+        """
+        Serves the Prometheus metrics on http://localhost:port/metrics from
+        a background thread.
+        """
+        metrics = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.Prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self.server = http.server.ThreadingHTTPServer(('localhost', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info("Serving metrics on http://localhost:{}/metrics".format(port))
+
+    def Close(self):
+        elapsed = time.time() - self.start
+        rows = sum(self.rows.values())
+        self.Write({'event': 'end', 'files': self.files, 'rows': rows, 'elapsed': elapsed,
+                    'seconds': self.seconds, 'mismatched': self.mismatched, 'errors': self.errors})
+        if self.out:
+            self.out.close()
+        if self.server:
+            self.server.shutdown()
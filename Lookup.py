@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+A read-through cache for looking up properties by UPRN and streets by
+USRN, so that an application doesn't make a database round trip (and more
+for the related records) for every lookup.
+
+A Property is a BLPU with all of its LPIs, DPAs, Organisations,
+Classifications and Application Cross References, plus the descriptors of
+the streets its LPIs are on. A StreetRecord is a Street with its
+descriptors and the UPRNs of the LPIs on it. Looking up many at once
+(GetMany) fetches whichever aren't cached with a query per record type
+for each batch of LookupChunk keys, rather than a query per key.
+
+Results are cached in a least-recently-used cache of a given size with a
+time to live, and the whole cache is dropped when a file is loaded (the
+files table is checked every so often), e.g.
+
+    lookup = Lookup(engine, size=100000, ttl=3600)
+    p = lookup.GetByUPRN(10000001)
+    p.BLPU.POSTCODE_LOCATOR, [d.THOROUGHFARE for d in p.DPAs]
+    lookup.GetMany([10000001, 10000002])   # -> {uprn: Property or None}
+    lookup.Stats()
+"""
+
+import time
+import threading
+import collections
+
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+from AddressBase import File, Street, StreetDescriptor, BLPU, LPI
+from AddressBase import DeliveryPointAddress, Organisation, Classification
+from AddressBase import ApplicationCrossReference
+
+LookupChunk = 500      # Keys per IN query
+LookupCacheSize = 100000 # Entries in the cache
+LookupTTL = 3600       # Seconds before an entry expires
+FileCheckInterval = 10 # Seconds between checks for new files
+
+
+class Property:
+    """
+    Everything about a UPRN. The records are detached ORM objects.
+    """
+    def __init__(self, uprn):
+        self.UPRN            = uprn
+        self.BLPU            = None # The current one if there's more than one
+        self.BLPUs           = []
+        self.LPIs            = []
+        self.DPAs            = []
+        self.Organisations   = []
+        self.Classifications = []
+        self.XRefs           = []
+        self.Streets         = {}   # USRN -> StreetDescriptors
+
+    def __repr__(self):
+        return "{} {}".format(self.UPRN, self.DPAs[0] if self.DPAs else self.BLPU)
+
+
+class StreetRecord:
+    """
+    Everything about a USRN. The records are detached ORM objects.
+    """
+    def __init__(self, usrn):
+        self.USRN        = usrn
+        self.Street      = None # The current one if there's more than one
+        self.Streets     = []
+        self.Descriptors = []
+        self.UPRNs       = []   # Of the LPIs on the street
+
+    def __repr__(self):
+        return "{} {}".format(self.USRN, self.Descriptors[0] if self.Descriptors else self.Street)
+
+
+def Current(records):
+    """
+    Returns the current one of several versions of a record: preferably one
+    without an END_DATE (or STREET_END_DATE), then the latest by PRO_ORDER.
+    """
+    return max(records, key=lambda r: (getattr(r, 'END_DATE', getattr(r, 'STREET_END_DATE', None)) is None,
+                                       r.PRO_ORDER or 0)) if records else None
+
+
+class Lookup:
+    """
+    Cached lookups of Properties by UPRN and StreetRecords by USRN. It's
+    safe to share between threads.
+    """
+    def __init__(self, engine, size=LookupCacheSize, ttl=LookupTTL, check=FileCheckInterval):
+        self.Session   = sessionmaker(bind=engine, expire_on_commit=False)
+        self.size      = size
+        self.ttl       = ttl
+        self.check     = check
+        self.cache     = collections.OrderedDict() # (kind, key) -> (expiry, value)
+        self.lock      = threading.Lock()
+        self.checked   = 0    # When we last checked the files table
+        self.files     = None # and what it said
+        self.stats     = collections.Counter()
+
+    def Stats(self):
+        """
+        Returns a dictionary of hits, misses, evictions, expiries,
+        invalidations, queries, the number of entries and the hit rate.
+        """
+        with self.lock:
+            stats = {k: self.stats[k] for k in
+                     ('hits', 'misses', 'evictions', 'expiries', 'invalidations', 'queries')}
+            stats['entries'] = len(self.cache)
+        lookups = stats['hits'] + stats['misses']
+        stats['hitrate'] = stats['hits'] / lookups if lookups else None
+        return stats
+
+    def Count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def Invalidate(self):
+        """
+        Empties the cache.
+        """
+        with self.lock:
+            self.cache.clear()
+            self.stats['invalidations'] += 1
+
+    def CheckFiles(self, session):
+        """
+        Empties the cache if a file has been loaded since we last looked.
+        Only actually looks every so often.
+        """
+        now = time.monotonic()
+        if now - self.checked < self.check:
+            return
+        self.checked = now
+        files = session.query(func.count(File.id), func.max(File.CreateEnd)).one()
+        self.Count('queries')
+        if self.files is not None and tuple(files) != self.files:
+            self.Invalidate()
+        self.files = tuple(files)
+
+    def Get(self, kind, key):
+        """
+        Returns (True, value) if key is cached, otherwise (False, None)
+        """
+        with self.lock:
+            entry = self.cache.get((kind, key))
+            if entry is None:
+                self.stats['misses'] += 1
+                return False, None
+            if entry[0] < time.monotonic():
+                del self.cache[(kind, key)]
+                self.stats['expiries'] += 1
+                self.stats['misses'] += 1
+                return False, None
+            self.cache.move_to_end((kind, key))
+            self.stats['hits'] += 1
+            return True, entry[1]
+
+    def Put(self, kind, key, value):
+        with self.lock:
+            self.cache[(kind, key)] = (time.monotonic() + self.ttl, value)
+            self.cache.move_to_end((kind, key))
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def Query(self, session, model, column, keys):
+        """
+        Returns the records of model whose column is in keys, a query per
+        LookupChunk of them.
+        """
+        records = []
+        for i in range(0, len(keys), LookupChunk):
+            records += session.query(model).filter(column.in_(keys[i:i + LookupChunk])).all()
+            self.Count('queries')
+        return records
+
+    def FetchProperties(self, session, uprns):
+        properties = {u: Property(u) for u in uprns}
+        for model, attribute in ((BLPU, 'BLPUs'), (LPI, 'LPIs'), (DeliveryPointAddress, 'DPAs'),
+                                 (Organisation, 'Organisations'), (Classification, 'Classifications'),
+                                 (ApplicationCrossReference, 'XRefs')):
+            for record in self.Query(session, model, model.UPRN, uprns):
+                getattr(properties[record.UPRN], attribute).append(record)
+        usrns = sorted({l.USRN for p in properties.values() for l in p.LPIs if l.USRN})
+        streets = collections.defaultdict(list)
+        for descriptor in self.Query(session, StreetDescriptor, StreetDescriptor.USRN, usrns):
+            streets[descriptor.USRN].append(descriptor)
+        for p in properties.values():
+            p.BLPU = Current(p.BLPUs)
+            p.Streets = {l.USRN: streets[l.USRN] for l in p.LPIs if l.USRN in streets}
+        return {u: p if p.BLPUs else None for u, p in properties.items()}
+
+    def FetchStreets(self, session, usrns):
+        records = {u: StreetRecord(u) for u in usrns}
+        for street in self.Query(session, Street, Street.USRN, usrns):
+            records[street.USRN].Streets.append(street)
+        for descriptor in self.Query(session, StreetDescriptor, StreetDescriptor.USRN, usrns):
+            records[descriptor.USRN].Descriptors.append(descriptor)
+        for i in range(0, len(usrns), LookupChunk):
+            for usrn, uprn in session.query(LPI.USRN, LPI.UPRN).filter(
+                    LPI.USRN.in_(usrns[i:i + LookupChunk])).distinct():
+                records[usrn].UPRNs.append(uprn)
+            self.Count('queries')
+        for r in records.values():
+            r.Street = Current(r.Streets)
+        return {u: r if r.Streets or r.Descriptors else None for u, r in records.items()}
+
+    def GetMany(self, keys, kind='UPRN'):
+        """
+        Returns a dictionary of each of keys (UPRNs, or USRNs if kind is
+        'USRN') to its Property (StreetRecord) or None if there isn't one,
+        from the cache where possible and otherwise from the database.
+        """
+        results = {}
+        session = self.Session()
+        try:
+            self.CheckFiles(session)
+            missing = []
+            for key in dict.fromkeys(keys):
+                found, value = self.Get(kind, key)
+                if found:
+                    results[key] = value
+                else:
+                    missing.append(key)
+            if missing:
+                Fetch = self.FetchStreets if kind == 'USRN' else self.FetchProperties
+                fetched = Fetch(session, sorted(missing))
+                session.expunge_all()
+                for key, value in fetched.items():
+                    self.Put(kind, key, value)
+                results.update(fetched)
+        finally:
+            session.close()
+        return results
+
+    def GetByUPRN(self, uprn):
+        """
+        Returns the Property of a UPRN, or None if there isn't one.
+        """
+        return self.GetMany([uprn])[uprn]
+
+    def GetByUSRN(self, usrn):
+        """
+        Returns the StreetRecord of a USRN, or None if there isn't one.
+        """
+        return self.GetMany([usrn], 'USRN')[usrn]
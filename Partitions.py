@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+PostgreSQL declarative partitioning of the biggest tables (blpus, lpis,
+dpaddresses and classifications), by LOCAL_CUSTODIAN_CODE or by postcode
+area, so that vacuuming, reindexing or reloading one local authority (or
+area) only touches its own partitions rather than the whole table.
+
+Each of the tables is partitioned by list of our own PARTITION_KEY column:
+the custodian code (e.g. '5900') or postcode area (e.g. 'SW') of the
+property, or Unknown if it hasn't got one. Only the BLPU has the
+LOCAL_CUSTODIAN_CODE, so the other records of a property go into the
+partition of its BLPU (a DPA's postcode area is its own POSTCODE's). The
+loader fills in PARTITION_KEY and creates each partition the first time it
+has a row for it (see Partitioner in BuildAddressBaseTables), and PostgreSQL
+puts each row into its partition.
+
+How the tables are partitioned is kept in the comment on each of them, so
+later loads carry on the same way without being told. e.g.
+
+    python BuildAddressBaseTables.py --connector postgresql ... --partition custodian *.csv
+    python BuildAddressBaseTables.py --connector postgresql ... --reload-partition 5900 *.csv
+    python Partitions.py --url postgresql://... --list
+"""
+
+import re
+import sys
+import argparse
+
+from sqlalchemy import create_engine, inspect, text, MetaData, PrimaryKeyConstraint
+
+from AddressBase import logger, BLPU, LPI, DeliveryPointAddress, Classification
+
+Tables = (BLPU, LPI, DeliveryPointAddress, Classification)
+Column = 'PARTITION_KEY'
+Methods = ('custodian', 'area')
+Unknown = 'NONE'                # Key of the properties without a custodian/area
+Comment = 'Partitioned by {}'   # The comment on each partitioned table
+KeyRegexp = re.compile('^[A-Z0-9]{1,4}$')
+
+
+def PartitionedTable(mapping, method):
+    """
+    Returns a copy of a mapped class's table (in a MetaData of its own)
+    declared as partitioned by list of PARTITION_KEY. PostgreSQL insists
+    that the primary key includes the partition key, so it's
+    (id, PARTITION_KEY).
+    """
+    table = mapping.__table__.to_metadata(MetaData())
+    key = table.c[Column]
+    key.primary_key = True
+    key.nullable = False
+    table.append_constraint(PrimaryKeyConstraint(table.c.id, key))
+    table.c.id.autoincrement = True
+    table.dialect_kwargs['postgresql_partition_by'] = 'LIST ("{}")'.format(Column)
+    table.comment = Comment.format(method)
+    return table
+
+
+def CreatePartitionedTables(engine, method):
+    """
+    Creates whichever of the partitioned tables don't exist, partitioned by
+    'custodian' or 'area'.
+    """
+    for mapping in Tables:
+        if not inspect(engine).has_table(mapping.__tablename__):
+            logger.info("Creating {} partitioned by {}".format(mapping.__tablename__, method))
+            PartitionedTable(mapping, method).create(bind=engine)
+
+
+def Method(engine):
+    """
+    Returns how the tables are partitioned ('custodian' or 'area'), or None
+    if they aren't.
+    """
+    if engine.dialect.name != 'postgresql':
+        return None
+    inspector = inspect(engine)
+    if not inspector.has_table(BLPU.__tablename__):
+        return None
+    comment = inspector.get_table_comment(BLPU.__tablename__).get('text') or ''
+    method = comment[len(Comment.format('')):]
+    return method if comment.startswith(Comment.format('')) and method in Methods else None
+
+
+def Key(value):
+    """
+    Returns a custodian code or postcode area as a partition key, or Unknown
+    if it won't do as one.
+    """
+    value = (value or '').strip().upper()
+    if value.isdigit():
+        value = str(int(value)) # Custodian codes without leading zeros
+    return value if KeyRegexp.match(value) else Unknown
+
+
+def PartitionName(table, key):
+    """
+    Returns the name of the partition of a table holding key e.g. blpus_5900
+    """
+    return '{}_{}'.format(table.name, key.lower())
+
+
+def CreatePartitions(connection, table, keys):
+    """
+    Creates the partitions of a table for any of keys which haven't got one.
+    The keys (see Key) are only letters and digits, and DDL can't have
+    parameters, so they're written into the statement.
+    """
+    quote = connection.dialect.identifier_preparer
+    for key in keys:
+        connection.execute(text("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES IN ('{}')".format(
+            quote.quote(PartitionName(table, key)), quote.format_table(table), key)))
+
+
+def ListPartitions(connection, table):
+    """
+    Returns the sorted list of the names of a table's partitions.
+    """
+    return sorted(connection.execute(text(
+        'SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+        'JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :table'),
+        {'table': table.name}).scalars())
+
+
+def DropPartition(connection, key):
+    """
+    Drops the partition holding key from each of the partitioned tables,
+    leaving the rest of each table alone.
+    """
+    quote = connection.dialect.identifier_preparer
+    for mapping in Tables:
+        name = PartitionName(mapping.__table__, key)
+        logger.info("Dropping partition {}".format(name))
+        connection.execute(text('DROP TABLE IF EXISTS {}'.format(quote.quote(name))))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('List or drop partitions of the partitioned tables')
+    parser.add_argument('--url',  help='SQLAlchemy URL of the (PostgreSQL) database')
+    parser.add_argument('--list', help='List the partitions of each table', action='store_true')
+    parser.add_argument('--drop', help='Drop the partitions of this custodian code or postcode area')
+    args = parser.parse_args()
+
+    if not args.url or not (args.list or args.drop):
+        logger.error('Requires --url and --list or --drop. See --help option for details.')
+        sys.exit()
+    engine = create_engine(args.url)
+    if not Method(engine):
+        logger.error('The tables aren\'t partitioned. Aborting.')
+        sys.exit()
+    if args.drop:
+        with engine.begin() as connection:
+            DropPartition(connection, Key(args.drop))
+    if args.list:
+        with engine.connect() as connection:
+            for mapping in Tables:
+                print("{}: {}".format(mapping.__tablename__,
+                                      ' '.join(ListPartitions(connection, mapping.__table__))))
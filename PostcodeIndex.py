@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory index of postcode to UPRNs, for answering "all the addresses
+in postcode X" (or in a sector or district) without going to the database.
+
+The index is held in three NumPy arrays rather than as Python objects per
+address: the sorted, normalised postcodes, the UPRNs of each postcode in
+turn (sorted within each postcode) and the offset into the UPRNs at which
+each postcode starts. So the UPRNs of the i'th postcode are
+
+    uprns[offsets[i]:offsets[i + 1]]
+
+and as postcodes sort by district then sector, all the postcodes of a
+sector or district are next to each other and their UPRNs are a single
+slice too. Looking anything up is a binary search or two.
+
+The postcodes are taken from both DeliveryPointAddress.POSTCODE and
+BLPU.POSTCODE_LOCATOR, and the index can be built from the loaded tables
+or straight from the CSVs, e.g.
+
+    index = PostcodeIndex.FromDatabase(engine)
+    index.Save('postcodes.npz')
+    ...
+    index = PostcodeIndex.Load('postcodes.npz')
+    index.Lookup('sw1a1aa')   # -> array of UPRNs
+    index.Sector('SW1A 1')
+    index.District('SW1A')
+"""
+
+import re
+import sys
+import logging
+import argparse
+
+from AddressBase import logger, BLPU, DeliveryPointAddress
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    logging.error('Can\'t import NumPy. Aborting.')
+    sys.exit()
+
+from sqlalchemy import create_engine, select
+
+from BuildAddressBaseTables import CreateRecordTypes, ReadRecords
+
+ChunkRows = 1000000  # Rows gathered into each array while building
+
+
+def NormalisePostcode(postcode):
+    """
+    Returns a postcode upper case with a single space before the inward
+    code (the last three characters), e.g. 'sw1a1aa' -> 'SW1A 1AA'.
+    """
+    postcode = re.sub(r'\s+', '', postcode or '').upper()
+    if len(postcode) > 3:
+        postcode = postcode[:-3] + ' ' + postcode[-3:]
+    return postcode
+
+
+class PostcodeIndex:
+    """
+    Postcode -> UPRNs index. Build it with FromDatabase, FromCSV or
+    FromPairs, or Load one which was Saved earlier.
+    """
+    def __init__(self, postcodes, offsets, uprns):
+        self.postcodes = postcodes  # Sorted unique postcodes (bytes, 'S8')
+        self.offsets   = offsets    # Start of each postcode's UPRNs, plus the end
+        self.uprns     = uprns      # UPRNs, grouped by postcode
+
+    @classmethod
+    def FromPairs(cls, chunks):
+        """
+        Builds the index from an iterable of (postcodes, UPRNs) pairs of
+        arrays, the postcodes already normalised.
+        """
+        postcodes, uprns = [], []
+        for p, u in chunks:
+            postcodes.append(np.asarray(p, dtype='S8'))
+            uprns.append(np.asarray(u, dtype=np.int64))
+        postcodes = np.concatenate(postcodes) if postcodes else np.array([], dtype='S8')
+        uprns = np.concatenate(uprns) if uprns else np.array([], dtype=np.int64)
+        keep = postcodes != b''
+        postcodes, uprns = postcodes[keep], uprns[keep]
+        # Sort by postcode then UPRN and drop duplicates (e.g. the same
+        # address with a DPA and a BLPU)
+        order = np.lexsort((uprns, postcodes))
+        postcodes, uprns = postcodes[order], uprns[order]
+        if len(uprns):
+            new = np.ones(len(uprns), dtype=bool)
+            new[1:] = (postcodes[1:] != postcodes[:-1]) | (uprns[1:] != uprns[:-1])
+            postcodes, uprns = postcodes[new], uprns[new]
+        keys, starts = np.unique(postcodes, return_index=True)
+        offsets = np.append(starts, len(uprns)).astype(np.int64)
+        logger.info("Indexed {:,} UPRNs in {:,} postcodes".format(len(uprns), len(keys)))
+        return cls(keys, offsets, uprns)
+
+    @classmethod
+    def FromDatabase(cls, engine):
+        """
+        Builds the index from the dpaddresses and blpus tables.
+        """
+        def Chunks():
+            with engine.connect() as connection:
+                for column, uprn in ((DeliveryPointAddress.POSTCODE, DeliveryPointAddress.UPRN),
+                                     (BLPU.POSTCODE_LOCATOR, BLPU.UPRN)):
+                    result = connection.execution_options(yield_per=ChunkRows).execute(
+                        select(column, uprn).where(column != None, uprn != None))
+                    for rows in result.partitions():
+                        yield [NormalisePostcode(r[0]) for r in rows], [r[1] for r in rows]
+        return cls.FromPairs(Chunks())
+
+    @classmethod
+    def FromCSV(cls, patterns):
+        """
+        Builds the index straight from the BLPU and DPA records in the CSVs
+        matching patterns (which may be gzipped or zipped). Deletions in
+        Change-Only Update files are left out.
+        """
+        RecTypes = CreateRecordTypes()
+        fields = {code: (RecTypes[code].fields.index(postcode) + 1,
+                         RecTypes[code].fields.index('UPRN') + 1,
+                         RecTypes[code].fields.index('CHANGE_TYPE') + 1)
+                  for code, postcode in (('21', 'POSTCODE_LOCATOR'), ('28', 'POSTCODE'))}
+        def Chunks():
+            postcodes, uprns = [], []
+            for rec in ReadRecords(patterns, fields):
+                p, u, c = fields[rec[0]]
+                if rec[u] and rec[c] != 'D':
+                    postcodes.append(NormalisePostcode(rec[p]))
+                    uprns.append(int(rec[u]))
+                    if len(uprns) >= ChunkRows:
+                        yield postcodes, uprns
+                        postcodes, uprns = [], []
+            yield postcodes, uprns
+        return cls.FromPairs(Chunks())
+
+    def Save(self, path):
+        """
+        Saves the index to a single (.npz) file.
+        """
+        np.savez(path, postcodes=self.postcodes, offsets=self.offsets, uprns=self.uprns)
+
+    @classmethod
+    def Load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            return cls(f['postcodes'], f['offsets'], f['uprns'])
+
+    def __len__(self):
+        return len(self.postcodes)
+
+    def __contains__(self, postcode):
+        return self.Range(NormalisePostcode(postcode), True)[0] is not None
+
+    def Range(self, key, exact=False):
+        """
+        Returns the (first, last + 1) indexes of the postcodes which equal
+        key (if exact) or start with it, or (None, None) if there are none.
+        """
+        key = key.encode('latin-1')
+        first = int(np.searchsorted(self.postcodes, key, 'left'))
+        if exact:
+            last = first + 1
+            if first == len(self.postcodes) or self.postcodes[first] != key:
+                return None, None
+        else:
+            last = int(np.searchsorted(self.postcodes, key + b'\xff', 'left'))
+            if last == first:
+                return None, None
+        return first, last
+
+    def UPRNs(self, key, exact=False):
+        first, last = self.Range(key, exact)
+        if first is None:
+            return np.array([], dtype=np.int64)
+        uprns = self.uprns[self.offsets[first]:self.offsets[last]]
+        # Within one postcode they're sorted and unique already, but a UPRN
+        # can be in more than one postcode of a sector or district.
+        return uprns if exact else np.unique(uprns)
+
+    def Lookup(self, postcode):
+        """
+        Returns the sorted array of UPRNs in the given postcode (which need
+        not be normalised).
+        """
+        return self.UPRNs(NormalisePostcode(postcode), True)
+
+    def Sector(self, sector):
+        """
+        Returns the sorted array of UPRNs in the given postcode sector, which
+        is the outward code and first character of the inward code, e.g.
+        'SW1A 1'.
+        """
+        sector = re.sub(r'\s+', '', sector).upper()
+        return self.UPRNs(sector[:-1] + ' ' + sector[-1:])
+
+    def District(self, district):
+        """
+        Returns the sorted array of UPRNs in the given postcode district,
+        i.e. outward code, e.g. 'SW1A'.
+        """
+        return self.UPRNs(re.sub(r'\s+', '', district).upper() + ' ')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Build a postcode index')
+    parser.add_argument('index',   help='Index file to write (.npz)')
+    parser.add_argument('--url',   help='SQLAlchemy URL of the database to build it from')
+    parser.add_argument('--csv',   help='CSV files to build it from instead', nargs='+')
+    args = parser.parse_args()
+
+    if args.csv:
+        index = PostcodeIndex.FromCSV(args.csv)
+    elif args.url:
+        index = PostcodeIndex.FromDatabase(create_engine(args.url))
+    else:
+        logger.error('Requires --url or --csv. See --help option for details.')
+        sys.exit()
+    index.Save(args.index)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Builds a standalone SQLite copy of the tables of AddressBase.py from a
+loaded database, to be shipped to the machines which only need to look
+things up, so that their lookups are local and need no connection to the
+central database. e.g.
+
+    python SQLiteReplica.py abp.sqlite --url postgresql://...
+
+    replica = OpenReplica('abp.sqlite')
+    Lookup(replica).GetByUPRN(10000001)                    # see Lookup.py
+
+The copy is built for speed rather than safety, since if it fails it's
+simply built again: the pages are bigger than the default, the journal is
+WAL, nothing is synced to disk until the end and the rows are written a
+chunk at a time in transactions of many chunks. The tables are created
+without their indexes, which are built once they're full. As well as the
+indexes of AddressBase.py there are covering indexes (see Covering) for
+the usual lookups, by UPRN, USRN and postcode, so that those are answered
+from the index alone without reading the table. The tables' own indexes
+which the covering ones make redundant aren't built (nor are unique ones,
+as nothing's going to write to it). Finally it's ANALYZEd, so that
+SQLite's planner knows about the data, and switched back to a rollback
+journal so that it's a single file which can be opened read-only (see
+OpenReplica).
+
+It's written under a temporary name and only renamed to the path it's for
+once it's finished, so nothing ever sees half a replica.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+from sqlalchemy import create_engine, event, select, inspect, text, Index
+from sqlalchemy.schema import CreateTable
+
+from AddressBase import logger, Base, Snapshot
+
+ReplicaChunk = 10000       # Rows fetched and inserted at a time
+ReplicaCommit = 100        # Chunks per transaction
+ReplicaPageSize = 8192     # Bytes
+ReplicaCache = 256 * 1024  # KiB of page cache while building
+ReplicaMmap = 2**30        # Bytes of the replica memory-mapped by readers
+
+# Covering indexes of each table: the key looked up followed by the columns
+# which the lookup wants
+Covering = {
+    'blpus':             [('UPRN', 'X_COORDINATE', 'Y_COORDINATE', 'LATITUDE', 'LONGITUDE',
+                           'POSTCODE_LOCATOR', 'END_DATE'),
+                          ('POSTCODE_LOCATOR', 'UPRN')],
+    'lpis':              [('USRN', 'UPRN')],
+    'dpaddresses':       [('POSTCODE', 'UPRN', 'UDPRN')],
+    'streetdescriptors': [('USRN', 'STREET_DESCRIPTION', 'LOCALITY_NAME', 'TOWN_NAME', 'LANGUAGE')],
+    'addresses':         [('POSTCODE', 'UPRN', 'ADDRESS'),
+                          ('UPRN', 'ADDRESS', 'POSTCODE', 'LATITUDE', 'LONGITUDE')]}
+
+
+def BuildPragmas(dbapi_connection, record):
+    """
+    Sets up each connection to a replica being built. The page size has to
+    be set before anything is written.
+    """
+    cursor = dbapi_connection.cursor()
+    for pragma in ('page_size = {}'.format(ReplicaPageSize), 'journal_mode = WAL',
+                   'synchronous = OFF', 'cache_size = -{}'.format(ReplicaCache)):
+        cursor.execute('PRAGMA ' + pragma)
+    cursor.close()
+
+
+def ReadPragmas(dbapi_connection, record):
+    """
+    Sets up each connection to a finished replica.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA query_only = ON')
+    cursor.execute('PRAGMA mmap_size = {}'.format(ReplicaMmap))
+    cursor.close()
+
+
+def CoveringIndexes(table):
+    """
+    Returns the list of the covering indexes of a table.
+    """
+    return [Index('cx_{}_{}'.format(table.name, columns[0]), *[table.c[c] for c in columns])
+            for columns in Covering.get(table.name, ())]
+
+
+def Indexes(table):
+    """
+    Returns the list of the indexes to build on a table: the covering ones
+    and those of its own which aren't the start of one of them.
+    """
+    covering = CoveringIndexes(table)
+    prefixes = {tuple(c.name for c in list(i.columns)[:n]) for i in covering
+                for n in range(1, len(i.columns) + 1)}
+    own = [i for i in table.indexes if tuple(c.name for c in i.columns) not in prefixes]
+    return sorted(own, key=lambda i: i.name) + covering
+
+
+def CopyTable(source, replica, table):
+    """
+    Copies the rows of a table from the source connection to the replica
+    engine, returning the number of rows. Only the columns the source has
+    are copied, so a database created by an earlier version will do.
+    """
+    names = {c['name'] for c in inspect(source).get_columns(table.name)}
+    columns = [c for c in table.columns if c.name in names]
+    result = source.execution_options(yield_per=ReplicaChunk).execute(
+        select(*columns).order_by(table.primary_key.columns.values()[0]))
+    rows = 0
+    connection = replica.connect()
+    try:
+        transaction = connection.begin()
+        for i, chunk in enumerate(result.partitions()):
+            connection.execute(table.insert(), [dict(zip(r._fields, r)) for r in chunk])
+            rows += len(chunk)
+            if not (i + 1) % ReplicaCommit:
+                transaction.commit()
+                transaction = connection.begin()
+        transaction.commit()
+    finally:
+        connection.close()
+    return rows
+
+
+def BuildReplica(engine, path, tables=None):
+    """
+    Builds a SQLite replica at path of the named tables (all the tables of
+    AddressBase.py if None) of the database, all read from one snapshot of
+    it (see Snapshot) so they're consistent. Returns a dictionary of the
+    number of rows of each table.
+    """
+    tables = tables or [t.name for t in Base.metadata.sorted_tables]
+    building = path + '.building'
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(building + suffix):
+            os.remove(building + suffix)
+    replica = create_engine('sqlite:///' + building)
+    event.listen(replica, 'connect', BuildPragmas)
+    existing = set(inspect(engine).get_table_names())
+    counts = {}
+    start = time.time()
+    try:
+        with Snapshot(engine) as source:
+            for name in tables:
+                if name not in existing:
+                    logger.warning("No {} table. Skipping.".format(name))
+                    continue
+                table = Base.metadata.tables[name]
+                t = time.time()
+                with replica.begin() as connection:
+                    connection.execute(CreateTable(table)) # Without its indexes
+                counts[name] = CopyTable(source, replica, table)
+                logger.info("Copied {:,} rows of {} in {:.1f}s".format(counts[name], name, time.time() - t))
+        for name in counts:
+            for index in Indexes(Base.metadata.tables[name]):
+                t = time.time()
+                index.create(bind=replica)
+                logger.debug("Built index {} in {:.1f}s".format(index.name, time.time() - t))
+        with replica.connect() as connection:
+            connection.execute(text('ANALYZE'))
+            connection.execute(text('PRAGMA journal_mode = DELETE'))
+            connection.commit()
+    finally:
+        replica.dispose()
+    os.replace(building, path)
+    logger.info("Built replica {} ({:,} bytes) in {:.1f}s".format(path, os.path.getsize(path),
+                                                                   time.time() - start))
+    return counts
+
+
+def OpenReplica(path):
+    """
+    Returns an engine reading a replica, read-only and memory-mapped.
+    """
+    replica = create_engine('sqlite:///file:{}?mode=ro&uri=true'.format(os.path.abspath(path)))
+    event.listen(replica, 'connect', ReadPragmas)
+    return replica
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Build a SQLite replica of the AddressBase tables')
+    parser.add_argument('replica',  help='SQLite file to write')
+    parser.add_argument('--url',    help='SQLAlchemy URL of the database to copy')
+    parser.add_argument('--tables', help='Only copy these tables', nargs='+')
+    args = parser.parse_args()
+
+    if not args.url:
+        logger.error('Requires --url. See --help option for details.')
+        sys.exit()
+    BuildReplica(create_engine(args.url), args.replica, args.tables)
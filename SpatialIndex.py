@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+An in-memory spatial index of the BLPUs' coordinates (British National
+Grid easting and northing), for nearest-address, radius and bounding box
+queries without a full scan of the blpus table or PostGIS.
+
+The points are bucketed in a grid of square cells (CellSize metres) and
+held in NumPy arrays sorted by cell, column by column, with the offset at
+which each occupied cell starts, in the same way as PostcodeIndex. So the
+points in a column of cells are a single slice, found by binary search,
+and a query only has to look at the points in the cells around it.
+
+Nearest does the k nearest neighbours of a point; NearestMany does the
+same for arrays of points at once, which is the way to geocode millions
+of them. e.g.
+
+    index = SpatialIndex.FromDatabase(engine)
+    uprns, distances = index.Nearest(530000, 180000, k=5)
+    uprns = index.BBox(529000, 179000, 531000, 181000)
+    uprns, distances = index.NearestMany(eastings, northings)
+"""
+
+import sys
+import logging
+import argparse
+
+from AddressBase import logger, BLPU
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    logging.error('Can\'t import NumPy. Aborting.')
+    sys.exit()
+
+from sqlalchemy import create_engine, select
+
+from BuildAddressBaseTables import CreateRecordTypes, ReadRecords
+
+CellSize = 100       # Metres along the side of a grid cell
+Stride = 2**24       # Cell key = column * Stride + row
+QueryChunk = 4096    # Queries whose candidates are gathered at once
+MaxRing = 256        # Rings of cells NearestMany searches before looking at every point
+
+
+def Ranges(starts, ends):
+    """
+    Returns the concatenation of np.arange(s, e) for each start and end.
+    """
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if not total:
+        return np.array([], dtype=np.int64)
+    shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return shift + np.arange(total)
+
+
+class SpatialIndex:
+    """
+    Grid index of the BLPUs' eastings and northings, keyed by UPRN. Build it
+    with FromDatabase, FromCSV or FromArrays, or Load one which was Saved.
+    """
+    def __init__(self, cellsize, keys, offsets, uprns, x, y):
+        self.cellsize = cellsize
+        self.keys     = keys      # Sorted keys of the occupied cells
+        self.offsets  = offsets   # Start of each cell's points, plus the end
+        self.uprns    = uprns     # The points, sorted by cell
+        self.x        = x
+        self.y        = y
+        if len(keys):
+            cols, rows = keys // Stride, keys % Stride
+            self.extent = (cols.min(), rows.min(), cols.max(), rows.max())
+        else:
+            self.extent = (0, 0, -1, -1)
+
+    @classmethod
+    def FromArrays(cls, uprns, x, y, cellsize=CellSize):
+        uprns = np.asarray(uprns, dtype=np.int64)
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        keep = ~(np.isnan(x) | np.isnan(y))
+        uprns, x, y = uprns[keep], x[keep], y[keep]
+        cells = (x // cellsize).astype(np.int64) * Stride + (y // cellsize).astype(np.int64)
+        order = np.argsort(cells, kind='stable')
+        cells, uprns, x, y = cells[order], uprns[order], x[order], y[order]
+        keys, starts = np.unique(cells, return_index=True)
+        offsets = np.append(starts, len(uprns)).astype(np.int64)
+        logger.info("Indexed {:,} points in {:,} cells".format(len(uprns), len(keys)))
+        return cls(cellsize, keys, offsets, uprns, x, y)
+
+    @classmethod
+    def FromDatabase(cls, engine, cellsize=CellSize):
+        """
+        Builds the index from the blpus table.
+        """
+        with engine.connect() as connection:
+            rows = connection.execute(
+                select(BLPU.UPRN, BLPU.X_COORDINATE, BLPU.Y_COORDINATE).where(
+                    BLPU.UPRN != None, BLPU.X_COORDINATE != None,
+                    BLPU.Y_COORDINATE != None)).all()
+        return cls.FromArrays([r[0] for r in rows], [float(r[1]) for r in rows],
+                              [float(r[2]) for r in rows], cellsize)
+
+    @classmethod
+    def FromCSV(cls, patterns, cellsize=CellSize):
+        """
+        Builds the index straight from the BLPU records in the CSVs matching
+        patterns (which may be gzipped or zipped), leaving out deletions.
+        """
+        fields = CreateRecordTypes()['21'].fields
+        u, x, y, c = (fields.index(f) + 1 for f in
+                      ('UPRN', 'X_COORDINATE', 'Y_COORDINATE', 'CHANGE_TYPE'))
+        uprns, xs, ys = [], [], []
+        for rec in ReadRecords(patterns, ('21',)):
+            if rec[u] and rec[x] and rec[y] and rec[c] != 'D':
+                uprns.append(int(rec[u]))
+                xs.append(float(rec[x]))
+                ys.append(float(rec[y]))
+        return cls.FromArrays(uprns, xs, ys, cellsize)
+
+    def Save(self, path):
+        """
+        Saves the index to a single (.npz) file.
+        """
+        np.savez(path, cellsize=self.cellsize, keys=self.keys, offsets=self.offsets,
+                 uprns=self.uprns, x=self.x, y=self.y)
+
+    @classmethod
+    def Load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            return cls(float(f['cellsize']), f['keys'], f['offsets'],
+                       f['uprns'], f['x'], f['y'])
+
+    def __len__(self):
+        return len(self.uprns)
+
+    def Cells(self, col0, row0, col1, row1):
+        """
+        Returns the indexes of the points in the cells from (col0, row0) to
+        (col1, row1) inclusive.
+        """
+        col0, row0 = max(col0, self.extent[0]), max(row0, self.extent[1])
+        col1, row1 = min(col1, self.extent[2]), min(row1, self.extent[3])
+        if col0 > col1 or row0 > row1:
+            return np.array([], dtype=np.int64)
+        cols = np.arange(col0, col1 + 1, dtype=np.int64) * Stride
+        first = np.searchsorted(self.keys, cols + row0, 'left')
+        last = np.searchsorted(self.keys, cols + row1, 'right')
+        return Ranges(self.offsets[first], self.offsets[last])
+
+    def Within(self, x0, y0, x1, y1):
+        """
+        Returns the indexes of the points in the box (x0, y0) - (x1, y1).
+        """
+        s = self.cellsize
+        i = self.Cells(int(x0 // s), int(y0 // s), int(x1 // s), int(y1 // s))
+        x, y = self.x[i], self.y[i]
+        return i[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+
+    def BBox(self, x0, y0, x1, y1):
+        """
+        Returns the sorted array of UPRNs in the box (x0, y0) - (x1, y1).
+        """
+        return np.sort(self.uprns[self.Within(x0, y0, x1, y1)])
+
+    def Radius(self, x, y, radius):
+        """
+        Returns the arrays of UPRNs and their distances within radius metres
+        of (x, y), nearest first.
+        """
+        i = self.Within(x - radius, y - radius, x + radius, y + radius)
+        d = np.hypot(self.x[i] - x, self.y[i] - y)
+        keep = d <= radius
+        i, d = i[keep], d[keep]
+        order = np.argsort(d, kind='stable')
+        return self.uprns[i[order]], d[order]
+
+    def Nearest(self, x, y, k=1):
+        """
+        Returns the arrays of the UPRNs of the k points nearest to (x, y) and
+        their distances, nearest first.
+        """
+        uprns, distances = self.NearestMany([x], [y], k)
+        found = uprns[0] >= 0
+        return uprns[0][found], distances[0][found]
+
+    def NearestMany(self, xs, ys, k=1):
+        """
+        Returns (n, k) arrays of the UPRNs of the k nearest points to each of
+        the n points (xs, ys), and their distances, nearest first. Where
+        there are fewer than k points in the index the rest of the row is
+        -1 (and the distance inf).
+
+        Each query starts with the candidates in its own cell and goes out a
+        ring of cells at a time, doubling, until its k'th nearest candidate 
+        is no further away than the edge of the block of cells searched
+        (anything outside the block being further still). Each round is
+        done for all the queries still outstanding at once. The rings stop
+        at MaxRing (or the size of the grid if that's smaller), and any
+        queries still outstanding, e.g. bad coordinates miles from any
+        BLPU, are compared with every point instead.
+        """
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        uprns = np.full((len(xs), k), -1, dtype=np.int64)
+        distances = np.full((len(xs), k), np.inf)
+        if not len(self.uprns):
+            return uprns, distances
+        s = self.cellsize
+        cols = (np.nan_to_num(xs) // s).astype(np.int64)
+        rows = (np.nan_to_num(ys) // s).astype(np.int64)
+        pending = np.flatnonzero(~(np.isnan(xs) | np.isnan(ys)))
+        cap = min(MaxRing, max(self.extent[2] - self.extent[0], self.extent[3] - self.extent[1]) + 1)
+        ring = 0
+        while len(pending) and ring <= cap:
+            span = np.arange(-ring, ring + 1)
+            # The block searched covers everything once it covers the extent
+            everything = ((cols[pending] - ring <= self.extent[0]) & (rows[pending] - ring <= self.extent[1]) &
+                          (cols[pending] + ring >= self.extent[2]) & (rows[pending] + ring >= self.extent[3]))
+            # Distance from each query to the nearest edge of its block
+            edge = np.minimum.reduce([xs[pending] - (cols[pending] - ring) * s,
+                                      (cols[pending] + ring + 1) * s - xs[pending],
+                                      ys[pending] - (rows[pending] - ring) * s,
+                                      (rows[pending] + ring + 1) * s - ys[pending]])
+            again = []
+            for i in range(0, len(pending), QueryChunk):
+                q = pending[i:i + QueryChunk]
+                keys = (cols[q, None] + span) * Stride
+                first = np.searchsorted(self.keys, keys + np.maximum(rows[q] - ring, 0)[:, None], 'left')
+                last = np.searchsorted(self.keys, keys + np.minimum(rows[q] + ring, Stride - 1)[:, None], 'right')
+                starts, ends = self.offsets[first].ravel(), self.offsets[last].ravel()
+                lengths = (ends - starts).reshape(len(q), -1).sum(axis=1)
+                candidates = Ranges(starts, ends)
+                owner = np.repeat(np.arange(len(q)), lengths)
+                d = np.hypot(xs[q][owner] - self.x[candidates], ys[q][owner] - self.y[candidates])
+                # Nearest first within each query, then the first k of each
+                order = np.lexsort((d, owner))
+                rank = np.arange(len(order)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+                top = rank < k
+                n = np.minimum(lengths, k)
+                kth = np.full(len(q), np.inf)
+                found = n > 0
+                kth[found] = d[order[(np.cumsum(lengths) - lengths + n - 1)[found]]]
+                done = everything[i:i + len(q)] | ((n == k) & (kth <= edge[i:i + len(q)]))
+                top &= done[owner]
+                row, column = q[owner[top]], rank[top]
+                uprns[row, column] = self.uprns[candidates[order[top]]]
+                distances[row, column] = d[order[top]]
+                again.append(q[~done])
+            pending = np.concatenate(again)
+            ring = ring * 2 or 1
+        for q in pending:
+            d = np.hypot(xs[q] - self.x, ys[q] - self.y)
+            n = min(k, len(d))
+            nearest = np.argpartition(d, n - 1)[:n]
+            nearest = nearest[np.argsort(d[nearest], kind='stable')]
+            uprns[q, :n] = self.uprns[nearest]
+            distances[q, :n] = d[nearest]
+        return uprns, distances
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Build a spatial index of BLPUs')
+    parser.add_argument('index',       help='Index file to write (.npz)')
+    parser.add_argument('--url',       help='SQLAlchemy URL of the database to build it from')
+    parser.add_argument('--csv',       help='CSV files to build it from instead', nargs='+')
+    parser.add_argument('--cell-size', help='Metres along the side of a grid cell',
+                        type=float, default=CellSize, dest='cellsize')
+    args = parser.parse_args()
+
+    if args.csv:
+        index = SpatialIndex.FromCSV(args.csv, args.cellsize)
+    elif args.url:
+        index = SpatialIndex.FromDatabase(create_engine(args.url), args.cellsize)
+    else:
+        logger.error('Requires --url or --csv. See --help option for details.')
+        sys.exit()
+    index.Save(args.index)
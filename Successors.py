@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Resolves retired UPRNs to their current successors by following the
+Successor Cross References (succxrefs), which map a UPRN to its SUCCESSOR,
+however many hops the chain runs to, without a query per hop.
+
+The graph is held in NumPy arrays, in the same way as PostcodeIndex: the
+sorted UPRNs which appear in it (nodes) and for each the index of its
+direct successor and of its terminal successor, the end of its chain.
+The terminals are worked out for all of the nodes at once by pointer
+jumping (every node's pointer is replaced by its pointer's pointer until
+nothing changes), which is union-find's path compression done in a few
+vectorised passes. The chains which never end are cycles, and resolve to
+-1. Where a UPRN has more than one successor the current one (without an
+END_DATE, then the latest by PRO_ORDER) is followed.
+
+After another file has been loaded Update brings the resolver up to date:
+new cross references onto the ends of chains are simply added to it, and
+anything else (e.g. Change-Only Updates of existing ones) rebuilds it. e.g.
+
+    resolver = SuccessorResolver.FromDatabase(engine)
+    resolver.Resolve(10000001)
+    resolver.ResolveMany(uprns)    # -> array of the current UPRNs
+    ...
+    resolver.Update(engine)
+"""
+
+import sys
+import logging
+import argparse
+
+from AddressBase import logger, SuccessorCrossReference
+
+try:
+    import numpy as np
+except ModuleNotFoundError:
+    logging.error('Can\'t import NumPy. Aborting.')
+    sys.exit()
+
+from sqlalchemy import create_engine, select, func
+
+
+def Pick(sources, successors, current, order):
+    """
+    Returns the sources and successors with only one successor per source,
+    the current one then the latest by order, sorted by source.
+    """
+    i = np.lexsort((order, current, sources))
+    sources, successors = sources[i], successors[i]
+    last = np.ones(len(sources), dtype=bool)
+    last[:-1] = sources[1:] != sources[:-1]
+    return sources[last], successors[last]
+
+
+def Jump(pointers, successors):
+    """
+    Returns the index of the terminal of each node, given pointers to nodes
+    somewhere along their chains (to start with, their successors), or -1
+    for the nodes whose chain runs into a cycle.
+    """
+    for i in range(int(np.log2(len(pointers) + 1)) + 2):
+        jumped = pointers[pointers]
+        if np.array_equal(jumped, pointers):
+            break
+        pointers = jumped
+    # A terminal has no successor. Anything else is on a cycle.
+    return np.where(successors[pointers] == pointers, pointers, -1)
+
+
+def Edges(rows):
+    """
+    Returns arrays of the UPRNs, successors, whether current and PRO_ORDER
+    of the rows of the succxrefs table which have both.
+    """
+    rows = [r for r in rows if r.UPRN is not None and r.SUCCESSOR is not None]
+    return (np.array([r.UPRN for r in rows], dtype=np.int64),
+            np.array([r.SUCCESSOR for r in rows], dtype=np.int64),
+            np.array([r.END_DATE is None for r in rows], dtype=bool),
+            np.array([r.PRO_ORDER or 0 for r in rows], dtype=np.int64))
+
+
+class SuccessorResolver:
+    """
+    The successor graph, fully compressed. Build it with FromDatabase or
+    FromEdges, or Load one which was Saved.
+    """
+    def __init__(self, nodes, successors, terminals, rows=0, lastid=0):
+        self.nodes      = nodes      # Sorted UPRNs in the graph
+        self.successors = successors # Index of each node's successor (itself if none)
+        self.terminals  = terminals  # Index of the end of its chain (-1 if a cycle)
+        self.rows       = rows       # Rows of the succxrefs table it was built from
+        self.lastid     = lastid     # and the highest id
+
+    @classmethod
+    def FromEdges(cls, sources, successors, current=None, order=None, rows=0, lastid=0):
+        """
+        Builds the resolver from arrays of UPRNs and their successors (and
+        optionally whether each is current and its PRO_ORDER, to choose
+        between several successors of a UPRN).
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        successors = np.asarray(successors, dtype=np.int64)
+        current = np.ones(len(sources), dtype=bool) if current is None else np.asarray(current)
+        order = np.zeros(len(sources), dtype=np.int64) if order is None else np.asarray(order)
+        sources, successors = Pick(sources, successors, current, order)
+        nodes = np.union1d(sources, successors)
+        pointers = np.arange(len(nodes))
+        pointers[np.searchsorted(nodes, sources)] = np.searchsorted(nodes, successors)
+        resolver = cls(nodes, pointers, Jump(pointers, pointers), rows, lastid)
+        resolver.Report()
+        return resolver
+
+    @classmethod
+    def FromDatabase(cls, engine):
+        """
+        Builds the resolver from the succxrefs table.
+        """
+        table = SuccessorCrossReference.__table__
+        with engine.connect() as connection, connection.begin():
+            rows, lastid = connection.execute(select(func.count(), func.max(table.c.id))).one()
+            edges = Edges(connection.execute(select(table.c.UPRN, table.c.SUCCESSOR,
+                                                    table.c.END_DATE, table.c.PRO_ORDER)))
+        return cls.FromEdges(*edges, rows=rows, lastid=lastid or 0)
+
+    def Report(self):
+        cycles = int((self.terminals < 0).sum())
+        logger.info("{:,} UPRNs, {:,} with successors".format(
+            len(self.nodes), int((self.successors != np.arange(len(self.nodes))).sum())))
+        if cycles:
+            logger.warning("{:,} UPRNs have successors which go round in circles".format(cycles))
+
+    def Add(self, sources, successors, current=None, order=None):
+        """
+        Adds cross references from UPRNs at the ends of chains (or new ones)
+        to their successors, returning False (having done nothing) if any of
+        them already has a successor.
+        """
+        sources = np.asarray(sources, dtype=np.int64)
+        successors = np.asarray(successors, dtype=np.int64)
+        current = np.ones(len(sources), dtype=bool) if current is None else np.asarray(current)
+        order = np.zeros(len(sources), dtype=np.int64) if order is None else np.asarray(order)
+        sources, successors = Pick(sources, successors, current, order)
+        if len(self.nodes):
+            at = np.minimum(np.searchsorted(self.nodes, sources), len(self.nodes) - 1)
+            if np.any((self.nodes[at] == sources) & (self.successors[at] != at)):
+                return False
+        # Make room for any new UPRNs
+        nodes = np.union1d(self.nodes, np.concatenate([sources, successors]))
+        moved = np.searchsorted(nodes, self.nodes)
+        pointers = np.arange(len(nodes))
+        pointers[moved] = moved[self.successors]
+        terminals = np.arange(len(nodes))
+        terminals[moved] = np.where(self.terminals >= 0, moved[self.terminals], moved[self.successors])
+        # The old terminals are still on the chains, so jump from them
+        s, t = np.searchsorted(nodes, sources), np.searchsorted(nodes, successors)
+        pointers[s] = t
+        terminals[s] = t
+        self.nodes, self.successors = nodes, pointers
+        self.terminals = Jump(terminals, pointers)
+        return True
+
+    def Update(self, engine):
+        """
+        Brings the resolver up to date with the succxrefs table, adding the
+        rows added since it was built where it can and otherwise rebuilding
+        it. Returns whether anything changed.
+        """
+        table = SuccessorCrossReference.__table__
+        with engine.connect() as connection, connection.begin():
+            rows, lastid = connection.execute(select(func.count(), func.max(table.c.id))).one()
+            lastid = lastid or 0
+            if rows == self.rows and lastid == self.lastid:
+                return False
+            new = connection.execute(select(table.c.UPRN, table.c.SUCCESSOR, table.c.END_DATE,
+                                            table.c.PRO_ORDER).where(table.c.id > self.lastid)).all()
+        if rows == self.rows + len(new) and self.Add(*Edges(new)):
+            logger.info("Added {:,} successors".format(len(new)))
+            self.rows, self.lastid = rows, lastid
+            self.Report()
+        else: # Something's been changed or deleted
+            logger.info("Successors have changed. Rebuilding.")
+            self.__dict__.update(SuccessorResolver.FromDatabase(engine).__dict__)
+        return True
+
+    def Save(self, path):
+        """
+        Saves the resolver to a single (.npz) file.
+        """
+        np.savez(path, nodes=self.nodes, successors=self.successors, terminals=self.terminals,
+                 rows=self.rows, lastid=self.lastid)
+
+    @classmethod
+    def Load(cls, path):
+        with np.load(path, allow_pickle=False) as f:
+            return cls(f['nodes'], f['successors'], f['terminals'], int(f['rows']), int(f['lastid']))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def ResolveMany(self, uprns):
+        """
+        Returns an array of the current UPRN of each of uprns: the end of its
+        chain of successors, itself if it hasn't got one, or -1 if the chain
+        goes round in a circle.
+        """
+        uprns = np.asarray(uprns, dtype=np.int64)
+        resolved = uprns.copy()
+        if not len(self.nodes):
+            return resolved
+        at = np.minimum(np.searchsorted(self.nodes, uprns), len(self.nodes) - 1)
+        found = self.nodes[at] == uprns
+        terminals = self.terminals[at[found]]
+        resolved[found] = np.where(terminals >= 0, self.nodes[terminals], -1)
+        return resolved
+
+    def Resolve(self, uprn):
+        """
+        Returns the current UPRN of uprn (see ResolveMany).
+        """
+        return int(self.ResolveMany([uprn])[0])
+
+    def Cycles(self):
+        """
+        Returns the sorted array of UPRNs whose successors go round in circles.
+        """
+        return self.nodes[self.terminals < 0]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser('Build, update or use a UPRN successor resolver')
+    parser.add_argument('index',     help='Resolver file (.npz) to write or use')
+    parser.add_argument('--url',     help='SQLAlchemy URL of the database to build it from')
+    parser.add_argument('--update',  help='Bring an existing resolver up to date from --url',
+                        action='store_true')
+    parser.add_argument('--resolve', help='UPRNs to resolve', nargs='+', type=int)
+    args = parser.parse_args()
+
+    if args.url:
+        if args.update:
+            resolver = SuccessorResolver.Load(args.index)
+            resolver.Update(create_engine(args.url))
+        else:
+            resolver = SuccessorResolver.FromDatabase(create_engine(args.url))
+        resolver.Save(args.index)
+    elif args.resolve:
+        resolver = SuccessorResolver.Load(args.index)
+        for uprn, current in zip(args.resolve, resolver.ResolveMany(args.resolve)):
+            print("{} {}".format(uprn, current))
+    else:
+        logger.error('Requires --url or --resolve. See --help option for details.')
+        sys.exit()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of CSVIndex against a small supply written on the fly.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import CSVIndex as csvindex
+from BuildAddressBaseTables import CreateRecordTypes
+from CSVIndex import CSVIndex
+
+
+def Record(rt, values):
+    """
+    Returns a CSV line of a record of type rt with the given fields set.
+    """
+    return ','.join([rt.code] + [values.get(f, '') for f in rt.fields]) + '\r\n'
+
+
+def test_non_ascii_record(tmp_path):
+    RecTypes = CreateRecordTypes()
+    path = tmp_path / 'supply.csv'
+    with open(path, 'w', encoding='latin-1', newline='') as f:
+        f.write(Record(RecTypes['28'], {'CHANGE_TYPE': 'I', 'UPRN': '10000001', 'UDPRN': '1',
+                                        'ORGANISATION_NAME': 'CAFÉ ROUGE', 'POSTCODE': 'LS1 1AA'}))
+        f.write(Record(RecTypes['28'], {'CHANGE_TYPE': 'I', 'UPRN': '10000002', 'UDPRN': '2',
+                                        'THOROUGHFARE': 'HIGH STREET'}))
+    index = CSVIndex.FromFiles([str(path)])
+    try:
+        records = index.Records('28', 10000001)
+        assert len(records) == 1
+        assert records[0]['ORGANISATION_NAME'] == 'CAFÉ ROUGE'
+        assert records[0]['POSTCODE'] == 'LS1 1AA'
+        assert index.Records('28', 10000002)[0]['THOROUGHFARE'] == 'HIGH STREET'
+    finally:
+        index.Close()
+
+
+def test_line_longer_than_chunk(tmp_path, monkeypatch):
+    monkeypatch.setattr(csvindex, 'ScanChunk', 64)
+    RecTypes = CreateRecordTypes()
+    path = tmp_path / 'supply.csv'
+    with open(path, 'w', encoding='latin-1', newline='') as f:
+        for uprn in range(10000001, 10000006):
+            f.write(Record(RecTypes['28'], {'CHANGE_TYPE': 'I', 'UPRN': str(uprn), 'UDPRN': str(uprn),
+                                            'ORGANISATION_NAME': 'ACME ' * 40, 'POSTCODE': 'LS1 1AA'}))
+    index = CSVIndex.FromFiles([str(path)])
+    try:
+        for uprn in range(10000001, 10000006):
+            records = index.Records('28', uprn)
+            assert len(records) == 1
+            assert records[0]['UDPRN'] == uprn
+    finally:
+        index.Close()
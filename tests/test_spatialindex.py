@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of SpatialIndex against a brute force search of random points.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SpatialIndex import SpatialIndex
+
+
+def BruteForce(uprns, x, y, qx, qy, k):
+    """
+    Returns the distances of the k nearest of the points to (qx, qy).
+    """
+    return np.sort(np.hypot(x - qx, y - qy))[:k]
+
+
+def test_out_of_extent_query():
+    random = np.random.default_rng(0)
+    x = random.uniform(525000, 535000, 2000)
+    y = random.uniform(175000, 185000, 2000)
+    uprns = np.arange(10000001, 10002001)
+    index = SpatialIndex.FromArrays(uprns, x, y)
+    qx = np.array([530000.0, 0.0, 700000.0])
+    qy = np.array([180000.0, 0.0, 1200000.0])
+    found, distances = index.NearestMany(qx, qy, k=3)
+    for i in range(len(qx)):
+        assert np.allclose(distances[i], BruteForce(uprns, x, y, qx[i], qy[i], 3))
+        assert np.allclose(np.hypot(x[found[i] - 10000001] - qx[i], y[found[i] - 10000001] - qy[i]),
+                           distances[i])